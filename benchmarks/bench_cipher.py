@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from libLora import libCipher
+
+
+
+
+"""
+Previous cipherXor implementation (reference)
+"""
+class LegacyXor():
+    def __init__(self, key):
+        self.key = key
+
+    def cipher(self, data):
+        keystream = self.key
+        while len(keystream) < len(data):
+            keystream += self.key
+
+        clear_data = b""
+        i = 0
+        while i < len(data):
+            clear_data += struct.pack("B", (data[i] ^ keystream[i]))
+            i += 1
+
+        return clear_data
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of XOR cipher")
+    parser.add_argument('-k', '--key', default="0123456789abcdef", help="cipher key")
+    parser.add_argument('-n', '--number', type=int, default=2000, help="packets per measure")
+    args = parser.parse_args()
+
+    key = bytes(args.key, "utf-8")
+    legacy = LegacyXor(key)
+    xor = libCipher.cipherXor(key)
+
+    print("%6s %14s %14s %8s" % ("size", "legacy (us)", "cipherXor (us)", "speedup"))
+    for sz in (16, 64, 128, 255, 512, 1500):
+        data = os.urandom(sz)
+        assert xor.cipher(data) == legacy.cipher(data)
+        assert xor.cipher(memoryview(bytearray(data))) == legacy.cipher(data)
+
+        t_legacy = min(timeit.repeat(lambda: legacy.cipher(data), number=args.number, repeat=3)) / args.number
+        t_xor = min(timeit.repeat(lambda: xor.cipher(data), number=args.number, repeat=3)) / args.number
+        print("%6d %14.2f %14.2f %7.1fx" % (sz, t_legacy * 1e6, t_xor * 1e6, t_legacy / t_xor))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
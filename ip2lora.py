@@ -19,6 +19,9 @@ from libUtils import libUtils
 
 IS_RUNNING = True
 
+# period (s) of counters log in debug mode
+STATS_PERIOD = 60
+
 def sigint_handler(signum, frame):
     global IS_RUNNING
 
@@ -27,11 +30,27 @@ def sigint_handler(signum, frame):
 
 
 
+"""
+Read compression dictionaries (one path or list of paths)
+"""
+def load_dicts(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    dicts = []
+    for path in paths:
+        with open(path, "rb") as f:
+            dicts.append(f.read())
+    return dicts
+
+
+
 def main():
     global IS_RUNNING
 
     parser = argparse.ArgumentParser(description="Gateway Lora/IP")
     parser.add_argument('-d', '--debug', default=False, action="store_true", help="Enable debug tracing")
+    parser.add_argument('-e', '--engine', default="thread", choices=["thread", "asyncio"],
+                        help="Gateway engine: one thread per component (default) or asyncio event loop")
     parser.add_argument('configfile', type=str, help="config file (python module) - must be in the same directory")
 
 
@@ -152,34 +171,145 @@ def main():
         "configTx": d_configTx,
     }
 
+    if "recv_buf_sz" in dir(config_user):
+        d_config.update({"recvBufSz": config_user.recv_buf_sz})
+
+    if "nfqueue_max_len" in dir(config_user):
+        d_config.update({"nfqueueMaxLen": config_user.nfqueue_max_len})
+
+    if "nfqueue_bypass" in dir(config_user):
+        d_config.update({"nfqueueBypass": config_user.nfqueue_bypass})
+
+    if "tx_queue_len" in dir(config_user):
+        d_config.update({"txQueueLen": config_user.tx_queue_len})
+
+    if "tx_queue_drop" in dir(config_user):
+        d_config.update({"txQueueDrop": config_user.tx_queue_drop})
+
+    if "tx_queue_discipline" in dir(config_user):
+        d_config.update({"txQueueDiscipline": config_user.tx_queue_discipline})
+
+    if "codel_target" in dir(config_user):
+        d_config.update({"codelTarget": config_user.codel_target})
+
+    if "codel_interval" in dir(config_user):
+        d_config.update({"codelInterval": config_user.codel_interval})
+
+    # replace queued pure TCP ACKs by newer ACKs of their flow
+    if "ack_thinning" in dir(config_user):
+        d_config.update({"ackThinning": config_user.ack_thinning})
+
+    # aggregation of small packets (hold time in s, 0: disabled)
+    if "aggregate_hold" in dir(config_user):
+        d_config.update({"aggregateHold": config_user.aggregate_hold})
+
+    # format of sent frames: 1 (default) or 2 (header check, crc over on air bytes)
+    # gateways receive both: upgrade all gateways before sending v2
+    if "frame_version" in dir(config_user):
+        d_config.update({"frameVersion": config_user.frame_version})
+
+    # envelope length: "standard" (default), "compact" (varint) or "compact_nolen" (RAK811/LoStick only)
+    # all gateways must use the same envelope
+    if "envelope" in dir(config_user):
+        d_config.update({"envelope": config_user.envelope})
+
+    # radio checks crc of frames instead of software crc16 (not on RAK811)
+    if "radio_crc" in dir(config_user) and config_user.radio_crc:
+        d_configTx["crcOn"] = 1
+        d_configRx["crcOn"] = 1
+        d_config.update({"radioCrc": True})
+
+    # duty cycle of TX channel: "eu868" (sub-bands limits) or one duty cycle (0.01: 1%) (see libDutyCycle)
+    # duty_cycle_reserve: part of budget kept for the highest traffic class
+    # duty_cycle_max_wait: (s) longer waits for budget drop the envelope
+    if "duty_cycle" in dir(config_user):
+        d_config.update({"dutyCycle": config_user.duty_cycle})
+        if "duty_cycle_reserve" in dir(config_user):
+            d_config.update({"dutyCycleReserve": config_user.duty_cycle_reserve})
+        if "duty_cycle_max_wait" in dir(config_user):
+            d_config.update({"dutyCycleMaxWait": config_user.duty_cycle_max_wait})
+
+    # split-TCP PEP: TCP connections to pep_networks are relayed between gateways (see libPep)
+    if "pep" in dir(config_user):
+        d_config.update({"pep": config_user.pep})
+        if "pep_networks" in dir(config_user):
+            d_config.update({"pepNetworks": config_user.pep_networks})
+
+    # strict priority traffic classes (see libClassifier)
+    if "tx_classes" in dir(config_user):
+        d_config.update({"txClasses": config_user.tx_classes})
+        if "tx_rules" in dir(config_user):
+            d_config.update({"txRules": config_user.tx_rules})
+        if "tx_default_class" in dir(config_user):
+            d_config.update({"txDefaultClass": config_user.tx_default_class})
+
     if "rohc_compression" in dir(config_user):
         d_config.update({"rohc_compression": config_user.rohc_compression})
     else:
         d_config.update({"rohc_compression": False})
 
+    # built-in per flow IPv4/TCP/UDP header compression (see libHeaderComp), not with ROHC
+    if "header_compression" in dir(config_user):
+        d_config.update({"headerCompression": config_user.header_compression})
+
 
     if "compress_mode" in dir(config_user):
         if config_user.compress_mode == "zlib":
             d_config.update({"func_decompress": libUtils.zlib_decompress})
             d_config.update({"func_compress": libUtils.zlib_compress})
+        elif config_user.compress_mode == "zlib_stream":
+            # deflate contexts per peer (both ends must use zlib_stream)
+            d_config.update({"compressStream": True})
+            if "compress_epoch_len" in dir(config_user):
+                d_config.update({"compressEpochLen": config_user.compress_epoch_len})
+        elif config_user.compress_mode in ["zlib_dict", "zstd_dict"]:
+            # preset dictionaries trained by ip2lora_dict.py (same files, same order on both ends)
+            d_config.update({"compressDicts": load_dicts(config_user.compress_dict)})
+            d_config.update({"compressDictCodec": config_user.compress_mode[:-len("_dict")]})
+        elif config_user.compress_mode == "adaptive":
+            # codec chosen per flow (same compress_codecs on both ends, see libCompress.CODECS)
+            codecs = ["zlib9", "lzma"]
+            if "compress_dict" in dir(config_user):
+                codecs.append("dict")
+                d_config.update({"compressDicts": load_dicts(config_user.compress_dict)})
+                if "compress_dict_codec" in dir(config_user):
+                    d_config.update({"compressDictCodec": config_user.compress_dict_codec})
+            if "compress_codecs" in dir(config_user):
+                d_config.update({"compressCodecs": config_user.compress_codecs})
+            else:
+                d_config.update({"compressCodecs": codecs})
 
 
     cipher = None
     if "cipher_mode" in dir(config_user):
         if config_user.cipher_mode == "xor":
             cipher = libCipher.cipherXor(config_user.cipher_key)
+        elif config_user.cipher_mode == "aes-ctr":
+            cipher = libCipher.cipherAesCtr(config_user.cipher_key, nodeId=int(config_user.ip_address.split(".")[-1]))
+        elif config_user.cipher_mode == "aes-gcm":
+            cipher = libCipher.cipherAesGcm(config_user.cipher_key, nodeId=int(config_user.ip_address.split(".")[-1]))
 
     if cipher:
         d_config.update({"func_cipher": cipher.cipher})
         d_config.update({"func_uncipher": cipher.uncipher})
+        d_config.update({"cipherAead": cipher.bAead})
 
 
-    ip2lora = libIp2Lora.Ip2Lora(config=d_config)
+    if args.engine == "asyncio":
+        from libLora import libAsyncIp2Lora
+        ip2lora = libAsyncIp2Lora.AsyncIp2Lora(config=d_config)
+    else:
+        ip2lora = libIp2Lora.Ip2Lora(config=d_config)
     ip2lora.start()
 
     signal.signal(signal.SIGINT, sigint_handler)
+    i = 0
     while IS_RUNNING:
         time.sleep(1)
+        i += 1
+        if args.debug and i >= STATS_PERIOD:
+            log.debug("stats: %s" % ip2lora.get_stats())
+            i = 0
 
     ip2lora.stop()
     ip2lora.join()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import argparse
+import struct
+import sys
+
+from libLora import libCompress
+
+
+
+
+# pcap link types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+DICT_SZ = 1024
+
+
+
+"""
+Read IPv4 packets of a pcap file (classic format)
+Capture IP2LoRa traffic on dummy interface: tcpdump -i dummy1 -w traffic.pcap
+"""
+def read_pcap(path):
+    packets = []
+    with open(path, "rb") as f:
+        hdr = f.read(24)
+        if len(hdr) < 24:
+            raise ValueError("%s: not a pcap file" % path)
+        magic = struct.unpack("<I", hdr[:4])[0]
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            endian = "<"
+        elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+            endian = ">"
+        else:
+            raise ValueError("%s: not a pcap file (pcapng is not supported)" % path)
+        linktype = struct.unpack(endian + "I", hdr[20:24])[0]
+
+        while True:
+            rec = f.read(16)
+            if len(rec) < 16:
+                break
+            caplen = struct.unpack(endian + "I", rec[8:12])[0]
+            data = f.read(caplen)
+            if len(data) < caplen:
+                break
+
+            if linktype == LINKTYPE_ETHERNET:
+                if len(data) < 14 or data[12:14] != b"\x08\x00":
+                    continue
+                data = data[14:]
+            elif linktype == LINKTYPE_LINUX_SLL:
+                if len(data) < 16 or data[14:16] != b"\x08\x00":
+                    continue
+                data = data[16:]
+            elif linktype not in (LINKTYPE_RAW, LINKTYPE_IPV4):
+                raise ValueError("%s: unsupported link type %d" % (path, linktype))
+
+            if len(data) < 20 or data[0] >> 4 != 4:
+                continue
+            total_len = struct.unpack("!H", data[2:4])[0]
+            packets.append(data[:total_len])
+    return packets
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a compression dictionary on captured IP2LoRa traffic")
+    parser.add_argument('-o', '--output', required=True, help="dictionary file (compress_dict of config.py)")
+    parser.add_argument('-s', '--size', type=int, default=DICT_SZ, help="dictionary size (default: %d)" % DICT_SZ)
+    parser.add_argument('-c', '--codec', default=libCompress.DICT_ZLIB,
+                        choices=[libCompress.DICT_ZLIB, libCompress.DICT_ZSTD],
+                        help="zlib (default) or zstd (needs python module zstandard)")
+    parser.add_argument('pcap', nargs="+", help="capture files (pcap)")
+
+    args = parser.parse_args()
+
+    samples = []
+    for path in args.pcap:
+        try:
+            samples += read_pcap(path)
+        except (OSError, ValueError) as e:
+            print(e)
+            exit(1)
+    print("%d packets, %d bytes" % (len(samples), sum(len(s) for s in samples)))
+
+    try:
+        if args.codec == libCompress.DICT_ZSTD:
+            import zstandard
+            d = zstandard.train_dictionary(args.size, samples).as_bytes()
+        else:
+            d = libCompress.train_dictionary(samples, args.size)
+    except ImportError:
+        print("zstd dictionaries need python module zstandard")
+        exit(1)
+    except Exception as e:
+        print("Training failed: %s" % e)
+        exit(1)
+
+    with open(args.output, "wb") as f:
+        f.write(d)
+
+    # ratio of per packet compression, without and with dictionary
+    c = libCompress.DictCompressor([d], codec=args.codec)
+    sz_clear = sum(len(s) for s in samples)
+    sz_dict = sum(len(c.compress(s)) for s in samples)
+    sz_nodict = sum(min(len(s), len(libCompress.DictCompressor([b""]).compress(s))) for s in samples)
+    print("dictionary: %s (%d bytes)" % (args.output, len(d)))
+    print("per packet: clear %d bytes - zlib %d bytes - dictionary %d bytes" % (sz_clear, sz_nodict, sz_dict))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
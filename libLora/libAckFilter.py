@@ -0,0 +1,59 @@
+from libLora import libPacket
+
+
+# max number of tracked TCP flows (table is flushed when full)
+MAX_FLOWS = 4096
+
+
+
+
+"""
+TCP ACK thinning and duplicate ACK suppression
+A queued pure ACK of a flow is replaced in place by the next pure ACK of the same
+flow (newest cumulative ACK and window, one airtime slot instead of several).
+Supersede key of a flow changes (queued ACK is kept) when:
+ - a segment of the flow is not a pure ACK (data, SYN/FIN/RST/URG, ECE/CWR, SACK...)
+ - ACK number goes backward (reordering)
+so ACKs are never moved after others segments of their flow.
+"""
+class AckFilter():
+    def __init__(self):
+        self._flows = {}    # flow => [generation, last ack]
+
+        self.nb_pure_acks = 0
+        self.nb_dup_acks = 0
+
+
+    """
+    Get supersede key of TCP segment (None if segment must not be replaced)
+    flow: key of flow (destination and 5-tuple)
+    """
+    def supersede_key(self, flow, ip, tcp):
+        state = self._flows.get(flow)
+        if state is None:
+            if len(self._flows) >= MAX_FLOWS:
+                self._flows.clear()
+            state = [0, None]
+            self._flows[flow] = state
+
+        if not libPacket.is_pure_ack(ip, tcp):
+            state[0] += 1
+            state[1] = None
+            return None
+
+        self.nb_pure_acks += 1
+        if state[1] is not None:
+            if tcp.ack == state[1]:
+                self.nb_dup_acks += 1
+            elif not libPacket.seq_after(tcp.ack, state[1]):
+                state[0] += 1
+        state[1] = tcp.ack
+        return (flow, state[0])
+
+
+    def get_stats(self):
+        return {
+            "tcp_ack_pure": self.nb_pure_acks,
+            "tcp_ack_dup": self.nb_dup_acks,
+            "tcp_ack_flows": len(self._flows),
+        }
@@ -0,0 +1,160 @@
+import struct
+
+
+# flag of envelope (high nibble of addr/flags byte): payload is several IPv4 packets
+FLAG_AGGREGATE = 1
+
+# (s) default max time a packet waits for others packets to the same destination
+AGGREGATE_HOLD = 0.1
+
+_TOTAL_LEN = struct.Struct("!H")
+
+
+
+
+class _Pending():
+    __slots__ = ("packets", "size", "deadline", "flow", "keys")
+
+    def __init__(self, flow, deadline):
+        self.packets = []
+        self.size = 0
+        self.deadline = deadline
+        self.flow = flow
+        self.keys = []
+
+
+
+
+"""
+Aggregation of small packets to the same LoRa destination (and traffic class)
+Packets are held until maxSz bytes are pending or hold time of first packet
+is elapsed: one envelope (one preamble, one header, one compression) is sent
+for all of them.
+Not thread safe: packets and timers must be handled by the same thread.
+Output items are (dst, cls, flow, packets).
+A pending packet added with a supersede key is replaced by next packet of same key.
+"""
+class Aggregator():
+    def __init__(self, maxSz, hold=AGGREGATE_HOLD):
+        if maxSz < 20 or hold <= 0:
+            raise ValueError("Invalid aggregation parameters")
+        self._maxSz = maxSz
+        self._hold = hold
+        self._pending = {}      # (dst, cls) => _Pending
+        self._supersede = {}    # supersede key => (_Pending, index of packet)
+
+        self.nb_packets = 0
+        self.nb_aggregates = 0  # envelopes with more than one packet
+        self.nb_superseded = 0
+
+
+    def _flush(self, key, out):
+        p = self._pending.pop(key, None)
+        if p is None:
+            return
+        for k in p.keys:
+            del self._supersede[k]
+        if len(p.packets) > 1:
+            self.nb_aggregates += 1
+        out.append((key[0], key[1], p.flow, p.packets))
+
+
+    """
+    Add packet (clear IPv4 packet)
+    Return list of items to send now
+    """
+    def add(self, dst, cls, flow, data, now, supersede=None):
+        out = []
+        key = (dst, cls)
+        self.nb_packets += 1
+
+        if supersede is not None and supersede in self._supersede:
+            p, i = self._supersede[supersede]
+            sz = p.size + len(data) - len(p.packets[i])
+            if sz <= self._maxSz:
+                p.packets[i] = data
+                p.size = sz
+                self.nb_superseded += 1
+                return out
+            # no room: pending packet is kept, new one is added
+            p.keys.remove(supersede)
+            del self._supersede[supersede]
+
+        if len(data) > self._maxSz:
+            # sent alone, after pending packets (keep order)
+            self._flush(key, out)
+            out.append((dst, cls, flow, [data]))
+            return out
+
+        p = self._pending.get(key)
+        if p is not None and p.size + len(data) > self._maxSz:
+            self._flush(key, out)
+            p = None
+        if p is None:
+            p = _Pending(flow, now + self._hold)
+            self._pending[key] = p
+
+        if supersede is not None:
+            p.keys.append(supersede)
+            self._supersede[supersede] = (p, len(p.packets))
+        p.packets.append(data)
+        p.size += len(data)
+        if p.size == self._maxSz:
+            self._flush(key, out)
+        return out
+
+
+    """
+    Return list of items whose hold time is elapsed
+    """
+    def pop_expired(self, now):
+        out = []
+        for key in [k for k, p in self._pending.items() if p.deadline <= now]:
+            self._flush(key, out)
+        return out
+
+
+    """
+    Time (s) before next hold time expires (None if nothing is pending)
+    """
+    def next_delay(self, now):
+        if len(self._pending) == 0:
+            return None
+        return max(0.0, min(p.deadline for p in self._pending.values()) - now)
+
+
+    def get_stats(self):
+        return {
+            "agg_packets": self.nb_packets,
+            "agg_aggregates": self.nb_aggregates,
+            "agg_pending": len(self._pending),
+            "agg_superseded": self.nb_superseded,
+        }
+
+
+
+
+"""
+Build payload of aggregate (IPv4 packets are concatenated, total length of
+IPv4 header delimits them)
+"""
+def join_packets(packets):
+    return b"".join(packets)
+
+
+"""
+Split payload of aggregate in IPv4 packets
+Return None if payload is not a valid aggregate
+"""
+def split_packets(data):
+    packets = []
+    i = 0
+    while i < len(data):
+        if len(data) - i < 20:
+            return None
+        total_len = _TOTAL_LEN.unpack_from(data, i + 2)[0]
+        if total_len < 20 or i + total_len > len(data):
+            return None
+        packets.append(data[i:i + total_len])
+        i += total_len
+    return packets
@@ -0,0 +1,100 @@
+import bisect
+
+
+# bandwidth (kHz) of bandwidth index of radio config (0:125kHz, 1:250kHz, 2:500kHz)
+BANDWIDTHS = (125, 250, 500)
+
+# max payload of a LoRa frame
+MAX_PAYLOAD = 255
+
+# (s) low data rate optimization is mandatory when symbol duration exceeds 16 ms
+# (SF11/SF12 at 125 kHz, SF12 at 250 kHz)
+LDR_SYMBOL_TIME = 0.016
+
+
+
+
+"""
+Airtime (s) of a LoRa frame (SX127x datasheet, integer symbol count)
+Args:
+    PL: payload size in bytes
+    SF: SF7...SF12
+    BW: Bandwidth in kHz: 125 - 250 - 500
+    CR: Coding rate (5:4/5 - 6:4/6 - 7:4/7 - 8:4/8)
+    NP: Number of symbols in preamble
+    EH: 1:Implicit header mode (no hdr) - 0:Explicit header mode
+    CRC: payload CRC (0:off 1:on)
+    LDR: Low data rate optimization (0:off 1:on, None: derived from symbol duration)
+"""
+def lora_airtime(PL, SF=7, BW=125, CR=5, NP=8, EH=0, CRC=1, LDR=None):
+    Ts = (1 << SF) / (BW * 1000.0)
+    if LDR is None:
+        LDR = int(Ts > LDR_SYMBOL_TIME)
+    num = 8 * PL - 4 * SF + 28 + 16 * CRC - 20 * EH
+    den = 4 * (SF - 2 * LDR)
+    nbPayloadSymbols = 8 + max(-(-num // den) * CR, 0)
+    return (NP + 4.25 + nbPayloadSymbols) * Ts
+
+
+
+
+"""
+Airtime of frames of one radio configuration
+Airtime of each payload size is computed once (table): no float math per frame.
+Models are shared (see get_model): device drivers, TX path and tools use the
+same numbers.
+"""
+class AirtimeModel():
+    def __init__(self, SF=7, BW=125, CR=5, NP=8, EH=0, CRC=1, LDR=None, maxPL=MAX_PAYLOAD):
+        self.symbol_time = (1 << SF) / (BW * 1000.0)
+        if LDR is None:
+            LDR = int(self.symbol_time > LDR_SYMBOL_TIME)
+        self.ldr = LDR
+        self._params = dict(SF=SF, BW=BW, CR=CR, NP=NP, EH=EH, CRC=CRC, LDR=LDR)
+        self._maxPL = maxPL
+        self._table = [lora_airtime(PL, **self._params) for PL in range(maxPL + 1)]
+
+
+    """
+    Airtime (s) of a frame of PL bytes
+    """
+    def airtime(self, PL):
+        if PL <= self._maxPL:
+            return self._table[PL]
+        return lora_airtime(PL, **self._params)
+
+
+    """
+    Largest payload sent within airtime (s), -1 if none
+    """
+    def max_payload(self, airtime):
+        return bisect.bisect_right(self._table, airtime) - 1
+
+
+    def __repr__(self):
+        return "AirtimeModel(%s)" % ", ".join("%s=%s" % kv for kv in self._params.items())
+
+
+
+
+_models = {}
+
+
+"""
+Get (shared) airtime model of TX configuration
+config_tx: radio configuration (datarate, bandwidth index, coderate index, preambleLen,
+fixLen, crcOn, optional lowDatarateOptimize: 0/1 to force LDR)
+"""
+def get_model(config_tx):
+    LDR = None
+    if "lowDatarateOptimize" in config_tx:
+        LDR = config_tx["lowDatarateOptimize"]
+    key = (config_tx["datarate"], config_tx["bandwidth"], config_tx["coderate"], config_tx["preambleLen"],
+           config_tx["fixLen"], config_tx["crcOn"], LDR)
+    model = _models.get(key)
+    if model is None:
+        model = AirtimeModel(SF=config_tx["datarate"], BW=BANDWIDTHS[config_tx["bandwidth"]],
+                             CR=4 + config_tx["coderate"], NP=config_tx["preambleLen"], EH=config_tx["fixLen"],
+                             CRC=config_tx["crcOn"], LDR=LDR)
+        model = _models.setdefault(key, model)
+    return model
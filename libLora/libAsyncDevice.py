@@ -0,0 +1,584 @@
+
+import asyncio
+import serial
+import time
+import random
+import re
+
+from libLora import libAirtime
+from libLora import libDevice
+
+
+# max number of bytes waiting to be written on serial before writers wait
+MAX_TX_BUF_SZ = 0x1000
+
+
+
+
+"""
+Generic asyncio serial Device class
+No thread: serial fd is watched by the event loop of the gateway
+ - received radio frames are given to on_radio_frame callback
+ - command responses are sent to an asyncio queue when a command is pending
+ - data is written without blocking when serial fd is writable
+asyncio objects are created by open(), inside the event loop.
+"""
+class AsyncSerialDev(libDevice.SerialDispatch):
+    def __init__(self, config={}):
+        configSerial = config["configSerial"]
+        self._name = configSerial["name"]
+        self.log = configSerial["log"]
+        self._timeout = configSerial["timeout"]
+        self.config_tx = config["configTx"]
+        self.config_rx = config["configRx"]
+        self.airtime_model = libAirtime.get_model(self.config_tx)
+        self.max_time_transmission = self.airtime_model.airtime(config["maxLoraFrameSz"])
+        self._isRunning = False
+
+        try:
+            self._serial = serial.Serial(port=configSerial["port"],
+                                        baudrate=configSerial["baudrate"],
+                                        bytesize=configSerial["bytesize"],
+                                        parity=configSerial["parity"],
+                                        stopbits=configSerial["stopbits"],
+                                        xonxoff=configSerial["xonxoff"],
+                                        rtscts=configSerial["rtscts"],
+                                        timeout=0,
+                                        write_timeout=0)
+        except Exception as e:
+            self.log.error("%s:AsyncSerialDev_init:Failed to open serial: %s" % (self._name, str(e)))
+            exit(1)
+
+        self._loop = None
+        self._on_radio_frame = None
+        self._resp_queue = None
+        self._cmd_lock = None
+        self.radio_tx_lock = None
+        self._cmd_pending = False
+        self._line_buf = b""
+        self._tx_buf = bytearray()
+        self._tx_waiters = []
+
+        self.nb_rx_bytes = 0
+        self.nb_rx_frames = 0
+        self.nb_tx_bytes = 0
+        self.nb_tx_writes = 0
+        self.nb_tx_errors = 0
+        self._tx_latency = libDevice.LatencyStats()
+
+
+    """
+    Register serial in event loop and init board
+    on_radio_frame(data) is called for each received radio frame
+    Return False if board init failed
+    """
+    async def open(self, on_radio_frame):
+        self._loop = asyncio.get_running_loop()
+        self._on_radio_frame = on_radio_frame
+        self._resp_queue = asyncio.Queue()
+        self._cmd_lock = asyncio.Lock()
+        self.radio_tx_lock = asyncio.Lock()
+
+        while not self._serial.is_open:
+            self.log.debug(self._name+":Opening...")
+            self._serial.open()
+        self._loop.add_reader(self._serial.fileno(), self._on_readable)
+
+        if not await self._init_stuff():
+            self.close()
+            return False
+
+        self._isRunning = True
+        return True
+
+
+    async def _init_stuff(self):
+        # implemented by child class
+        return True
+
+
+    async def _destroy_stuff(self):
+        # implemented by child class
+        return
+
+
+    async def stop(self):
+        self._isRunning = False
+        await self._destroy_stuff()
+        self.close()
+
+
+    def close(self):
+        fd = self._serial.fileno()
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+        self._release_tx_waiters(False)
+        self._serial.close()
+        self.log.debug(self._name + ":End")
+
+
+    def isRunning(self):
+        return self._isRunning
+
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(max(1, self._serial.in_waiting))
+        except Exception as e:
+            self.log.error("%s:Error on serial read: %s" % (self._name, str(e)))
+            return
+        if len(data) > 0:
+            self._on_serial_data(data)
+
+
+    def _push_radio_frame(self, data):
+        self.nb_rx_frames += 1
+        self._on_radio_frame(data)
+
+
+    def _on_writable(self):
+        try:
+            n = self._serial.write(self._tx_buf)
+        except Exception as e:
+            self.nb_tx_errors += 1
+            self.log.error("%s:send_serial:Error on serial write: %s" % (self._name, str(e)))
+            self._tx_buf = bytearray()
+            self._loop.remove_writer(self._serial.fileno())
+            self._release_tx_waiters(False)
+            return
+
+        if n is None:
+            n = len(self._tx_buf)
+        del self._tx_buf[:n]
+        self.nb_tx_bytes += n
+        if len(self._tx_buf) == 0:
+            self._loop.remove_writer(self._serial.fileno())
+            self._release_tx_waiters(True)
+
+
+    def _release_tx_waiters(self, res):
+        waiters = self._tx_waiters
+        self._tx_waiters = []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(res)
+
+
+    """
+    Write data on serial (non blocking)
+    Wait if too much data is not written yet (backpressure)
+    bWait: return only when data is written
+    Return False on write error
+    """
+    async def send_serial(self, data, bWait=False):
+        self.log.debug(self._name+":Sending: %s", data)
+        t_req = time.monotonic()
+        if len(self._tx_buf) > MAX_TX_BUF_SZ:
+            await self._wait_written()
+
+        if len(self._tx_buf) == 0:
+            self._loop.add_writer(self._serial.fileno(), self._on_writable)
+        self._tx_buf += data
+        self.nb_tx_writes += 1
+
+        if not bWait:
+            return True
+        res = await self._wait_written()
+        self._tx_latency.add(time.monotonic() - t_req)
+        return res
+
+
+    async def _wait_written(self):
+        fut = self._loop.create_future()
+        self._tx_waiters.append(fut)
+        return await fut
+
+
+    async def send_radio_frame(self, data):
+        self.t_last_radio_tx = time.monotonic()
+        # wait data is written to start airtime accounting
+        return await self.send_serial(data, bWait=True)
+
+
+    """
+    Start a command: data received is sent to responses queue until _end_cmd
+    """
+    async def _begin_cmd(self):
+        await self._cmd_lock.acquire()
+        self._flush_resp()
+        self._cmd_pending = True
+
+
+    def _end_cmd(self):
+        self._cmd_pending = False
+        self._cmd_lock.release()
+
+
+    def _flush_resp(self):
+        while True:
+            try:
+                self._resp_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+
+    """
+    Get next command response
+    Wait until timeout (s) - Return b"" if no response
+    """
+    async def recv_serial(self, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
+        try:
+            return await asyncio.wait_for(self._resp_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return b""
+
+
+    """
+    Send periodic small LoRa data (task)
+    Skipped if radio was used recently or airtime budget is exhausted
+    """
+    async def _send_periodic_data(self, data, period):
+        while self._isRunning:
+            await asyncio.sleep(period)
+            if self._keepalive_allowed(data, period):
+                await self.send_radio_frame(data)
+
+
+    def get_stats(self):
+        stats = {
+            "dev_rx_bytes": self.nb_rx_bytes,
+            "dev_rx_frames": self.nb_rx_frames,
+            "dev_tx_bytes": self.nb_tx_bytes,
+            "dev_tx_writes": self.nb_tx_writes,
+            "dev_tx_errors": self.nb_tx_errors,
+            "dev_tx_buf_len": len(self._tx_buf),
+            "dev_keepalive_sent": self.nb_keepalive_sent,
+            "dev_keepalive_skipped": self.nb_keepalive_skipped,
+        }
+        stats.update(self._tx_latency.get_stats("dev_tx"))
+        return stats
+
+
+
+
+"""
+asyncio driver for B-L072Z-LRWAN1 board
+"""
+class AsyncL072Z(AsyncSerialDev):
+    def __init__(self, config={}):
+        AsyncSerialDev.__init__(self, config=config)
+        self._keepalive_task = None
+
+
+    """
+    Apply RX and TX configuration on init
+    """
+    async def _init_stuff(self):
+        if self.config_tx:
+            if not await self._send_config(libDevice.l072z_tx_config_cmd(self.config_tx)):
+                return False
+        await asyncio.sleep(0.5)
+        if self.config_rx:
+            if not await self._send_config(libDevice.l072z_rx_config_cmd(self.config_rx)):
+                return False
+        await asyncio.sleep(0.5)
+
+        # for unknown reason, on inactivity board not listen until it send a frame...
+        # TODO: correct this bug and remove this task
+        self._keepalive_task = self._loop.create_task(self._send_periodic_data(b"A", 30))
+        return True
+
+
+    async def _destroy_stuff(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+
+
+    """
+    Send LoRa frames
+    wait until transmission ended
+    wait a time slot to give a chance to others LoRa node to reply (avoid collision)
+    """
+    async def send_radio_frame(self, data):
+        async with self.radio_tx_lock:
+            # airtime of radio payload (not of serial command)
+            ts = self.airtime_model.airtime(len(data))
+            data = libDevice.l072z_send_cmd(data)
+            await AsyncSerialDev.send_radio_frame(self, data)
+            # wait until frame is transmitted
+            await asyncio.sleep(ts)
+            # (half-duplex) give a chance to others node to send response
+            await asyncio.sleep(self.max_time_transmission + ts * random.random())
+
+
+    """
+    Send config to board
+    """
+    async def _send_config(self, raw_config, nbTry=10):
+        bConfigOk = False
+        await self._begin_cmd()
+        n = 0
+        while not bConfigOk and n < nbTry:
+            self._flush_resp()
+            await self.send_serial(raw_config)
+            # wait response (1s max)
+            d = b""
+            t_end = time.time() + 1
+            while time.time() < t_end:
+                d += await self.recv_serial()
+                if b"CONFIG_OK" in d:
+                    bConfigOk = True
+                    break
+            n += 1
+
+        self._end_cmd()
+        return bConfigOk
+
+
+
+
+"""
+asyncio driver for Wisnode board
+"""
+class AsyncRAK811(AsyncSerialDev):
+    LINE_MODE = True
+    FRAME_BOUNDARY = True
+    RADIO_CRC = False
+
+    """
+    On init:
+    - Init board (check version, set p2p mode, ...)
+    - Set LoRa configuration
+    """
+    async def _init_stuff(self):
+        if not await self.init_lorap2p():
+            return False
+
+        r, resp = await self._send_at_cmd(libDevice.rak811_rx_config_cmd(self.config_rx, self.config_tx), maxTry=40)
+        if not r:
+            self.log.error("%s: set_rx_config Failed" % self._name)
+            return False
+
+        await self.set_rx_mode()
+        return True
+
+
+    def _on_serial_line(self, line):
+        data = libDevice.rak811_parse_recv(line, self.log, self._name)
+        if data is None:
+            AsyncSerialDev._on_serial_line(self, line)
+        elif len(data) > 0:
+            self._push_radio_frame(data)
+
+
+    """
+    Send AT command to board
+    """
+    async def _send_at_cmd(self, cmd, maxTry=10):
+        await self._begin_cmd()
+        await self.send_serial(b"at+"+bytes(cmd, encoding="utf8")+b"\r\n")
+        t = 0
+        data = ""
+        while t < maxTry:
+            bData = await self.recv_serial()
+            if len(bData) > 0:
+                data += bData.decode("utf8") + "\r\n"
+                if re.match(".*OK .*", data, re.MULTILINE|re.DOTALL):
+                    self._end_cmd()
+                    return True, data
+            t += 1
+        self._end_cmd()
+        return False, data
+
+
+    """
+    Initialize Board (see RAK811.init_lorap2p)
+    """
+    async def init_lorap2p(self):
+        r, version = await self._send_at_cmd("version")
+        if r is False:
+            self.log.error("%s:Unable to get version (Maybe we are in BOOT mode (at+run))" % self._name)
+            if re.match(".* Bootloader .*", version) is None:
+                return False
+            r, run = await self._send_at_cmd("run")
+            if r is False:
+                return False
+            r, version = await self._send_at_cmd("version")
+            if r is False:
+                return False
+        if re.match('^.* V3\.0\.0\..*$', version) is None:
+            self.log.error("%s:Unsupported version: %s" % (self._name, version))
+            return False
+
+        for cmd in ("set_config=lora:work_mode:1",
+                    "set_config=device:sleep:0",
+                    libDevice.rak811_region_cmd(self.config_rx)):
+            r, resp = await self._send_at_cmd(cmd)
+            if not r:
+                return False
+
+        return True
+
+
+    """
+    Send data on LoRa
+    """
+    async def send_radio_frame(self, data):
+        async with self.radio_tx_lock:
+            await self.set_tx_mode()
+            r, resp = await self._send_at_cmd("send=lorap2p:"+data.hex(), maxTry=80)
+            if not r:
+                self.log.warn("%s:send_radio_frame: send frame failed: %s" % (self._name, data.hex()))
+                await self.set_rx_mode()
+                return
+            await self.set_rx_mode()
+
+            # (half-duplex) give a chance to others node to send responses
+            await asyncio.sleep(self.max_time_transmission)
+
+
+    async def set_rx_mode(self):
+        r, resp = await self._send_at_cmd("set_config=lorap2p:transfer_mode:1", maxTry=80)
+        if not r:
+            self.log.error("%s: set_rx_mode Failed" % self._name)
+        return r
+
+
+    async def set_tx_mode(self):
+        r, resp = await self._send_at_cmd("set_config=lorap2p:transfer_mode:2")
+        if not r:
+            self.log.error("%s: set_tx_mode Failed" % self._name)
+        return r
+
+
+
+
+"""
+asyncio driver for LoStick
+Board leaves receive mode after each received frame/error => a task puts it back
+in receive mode
+"""
+class AsyncLoStick(AsyncSerialDev):
+    LINE_MODE = True
+    FRAME_BOUNDARY = True
+
+    def __init__(self, config={}):
+        AsyncSerialDev.__init__(self, config=config)
+        self._rx_mode_task = None
+
+
+    async def _init_stuff(self):
+        if not await self.init_lorap2p():
+            return False
+
+        await self.set_rx_mode()
+        return True
+
+
+    async def _destroy_stuff(self):
+        if self._rx_mode_task is not None:
+            self._rx_mode_task.cancel()
+            self._rx_mode_task = None
+
+
+    def _on_serial_line(self, line):
+        if line == b"radio_tx_ok":
+            # ignore radio_tx_ok msg
+            return
+
+        data = libDevice.lostick_parse_recv(line, self.log, self._name)
+        if data is None and self._cmd_pending:
+            self._resp_queue.put_nowait(line)
+            return
+
+        if data is None:
+            self.log.debug("%s:recv_radio_frame:Unexpected command recv: %s" % (self._name, line))
+        elif len(data) > 0:
+            self._push_radio_frame(data)
+
+        if self._isRunning and (self._rx_mode_task is None or self._rx_mode_task.done()):
+            self._rx_mode_task = self._loop.create_task(self.set_rx_mode())
+
+
+    """
+    Send command to board
+    """
+    async def _send_cmd(self, cmd, maxTry=10, bExpectOk=False):
+        await self._begin_cmd()
+        await self.send_serial(bytes(cmd, encoding="utf8")+b"\r\n")
+        t = 0
+        while t < maxTry:
+            bData = await self.recv_serial()
+            if len(bData) > 0:
+                self._end_cmd()
+                data = bData.decode("utf8")
+                if data == "ok":
+                    return True, data
+                elif data == "invalid_param":
+                    return False, data
+                return not bExpectOk, data
+            t += 1
+        self._end_cmd()
+        return False, ""
+
+
+    """
+    Initialize Board (see LoStick.init_lorap2p)
+    """
+    async def init_lorap2p(self):
+        r, version = await self._send_cmd("sys reset")
+        if r is False:
+            self.log.error("%s:Unable to get version" % self._name)
+            return False
+        if re.match("^RN2483 1\.0\.5 .*$", version) is None:
+            self.log.error("%s:Version not supported: %s" % (self._name, version))
+            return False
+
+        for cmd in libDevice.lostick_radio_cmds(self.config_rx, self.config_tx):
+            r, data = await self._send_cmd(cmd)
+            if not r:
+                return False
+
+        return True
+
+
+    """
+    Send data on LoRa
+    """
+    async def send_radio_frame(self, data):
+        async with self.radio_tx_lock:
+            await self.set_tx_mode()
+            r, resp = await self._send_cmd("radio tx "+data.hex(), maxTry=80)
+            if not r:
+                self.log.warn("%s:send_radio_frame: send frame failed: %s" % (self._name, data.hex()))
+            await self.set_rx_mode()
+
+            # (half-duplex) give a chance to others node to send responses
+            await asyncio.sleep(self.max_time_transmission)
+
+
+    async def set_rx_mode(self):
+        r = False
+        while not r and self._serial.is_open:
+            r, resp = await self._send_cmd("radio rx 0", bExpectOk=True)
+        return r
+
+
+    async def set_tx_mode(self):
+        r, resp = await self._send_cmd("radio rxstop", bExpectOk=True)
+        return r
+
+
+
+
+"""
+asyncio driver of each threaded device class
+"""
+ASYNC_DEVICES = {
+    libDevice.L072Z: AsyncL072Z,
+    libDevice.RAK811: AsyncRAK811,
+    libDevice.LoStick: AsyncLoStick,
+}
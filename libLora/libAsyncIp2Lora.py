@@ -0,0 +1,187 @@
+
+import asyncio
+
+from libLora import libIp2Lora
+from libLora import libAsyncDevice
+
+
+
+
+"""
+asyncio gateway engine (alternative to the thread per component model)
+One thread runs an event loop which handles:
+ - NFQUEUE fd (packets from dummy interface)
+ - serial fd of LoRa device (asyncio drivers)
+ - route/neighbour netlink events
+ - TX scheduler task sending queued LoRa frames
+Packet processing (envelope, compression, cipher, injection) is shared with Ip2Lora.
+"""
+class AsyncIp2Lora(libIp2Lora.Ip2Lora):
+    def __init__(self, config={}):
+        libIp2Lora.Ip2Lora.__init__(self, config=config)
+        self._loop = None
+        self._stop_event = None
+        self._tx_event = None
+        self._bStop = False
+        self._bInjectPending = False
+        self._timer = None
+
+        self.nb_tx_sent = 0
+        self.nb_tx_errors = 0
+
+
+    def _create_device(self, config):
+        return libAsyncDevice.ASYNC_DEVICES[config["deviceClass"]](config=config)
+
+
+    """
+    Queue data to send on LoRa (called from event loop) and wake up TX scheduler
+    """
+    def _send_lora(self, data, flow=None, cls=0, supersede=None):
+        libIp2Lora.Ip2Lora._send_lora(self, data, flow=flow, cls=cls, supersede=supersede)
+        self._tx_event.set()
+
+
+    """
+    TX scheduler task: send queued data on LoRa (one radio frame at a time)
+    """
+    async def _tx_scheduler(self):
+        while True:
+            item = self._txQueue.pop()
+            if item is None:
+                self._tx_event.clear()
+                delay = self._txQueue.ready_delay()
+                if delay is None:
+                    await self._tx_event.wait()
+                else:
+                    # queued data is not ready yet (rate cap, airtime budget)
+                    try:
+                        await asyncio.wait_for(self._tx_event.wait(), max(delay, 0.01))
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            data, flow, cls = item
+            try:
+                frames = self._radio_frames(data, flow)
+                if len(frames) == 0:
+                    # envelope dropped when encoded (see _radio_frames)
+                    self.nb_tx_errors += 1
+                    continue
+                delay = self._budget_delay(data, frames, cls)
+                if delay is None:
+                    continue
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                for frame in frames:
+                    await self._t_dev.send_radio_frame(frame)
+            except Exception as e:
+                self._discard_radio(data)
+                self.nb_tx_errors += 1
+                self.log.error("%s:Error on send: %s" % (self._name, str(e)))
+                continue
+            self.nb_tx_sent += 1
+
+
+    """
+    Radio frame received by device (called from event loop)
+    Injection is deferred to handle all frames of one loop iteration at once
+    """
+    def _cbOnRadioFrame(self, data):
+        self._feed_radio(data)
+        if not self._bInjectPending:
+            self._bInjectPending = True
+            self._loop.call_soon(self._injectPendingFrames)
+
+
+    def _injectPendingFrames(self):
+        self._bInjectPending = False
+        self._injectRecvFrames()
+
+
+    """
+    Handle packets of NFQUEUE and (re)arm timer of gateway (aggregation hold time)
+    """
+    def _onNfqueueReadable(self):
+        self._t_recv_ip_from_dummy.process()
+        self._armTimer()
+
+
+    def _armTimer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        delay = self._cbOnTimer()
+        if delay is not None:
+            self._timer = self._loop.call_later(delay, self._armTimer)
+
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._tx_event = asyncio.Event()
+
+        if not await self._t_dev.open(on_radio_frame=self._cbOnRadioFrame):
+            self.log.error("%s:Unable to init LoRa device" % self._name)
+            return
+
+        self._isRunning = True
+
+        # Init dummy iface
+        self._init_dummy_eth()
+        self._injector.open()
+        self._routeCache.open()
+        mon_fd = self._routeCache.open_monitor()
+        self._loop.add_reader(mon_fd, self._routeCache.process_events)
+
+        nfq = self._t_recv_ip_from_dummy
+        nfq_fd = nfq.open()
+        self._loop.add_reader(nfq_fd, self._onNfqueueReadable)
+
+        tx_task = self._loop.create_task(self._tx_scheduler())
+
+        # PEP runs its own selector thread
+        if self._t_pep is not None:
+            self._t_pep.start()
+
+        if not self._bStop:
+            await self._stop_event.wait()
+
+        if self._t_pep is not None:
+            self._t_pep.stop()
+            self._t_pep.join()
+        self._loop.remove_reader(nfq_fd)
+        if self._timer is not None:
+            self._timer.cancel()
+        nfq.close()
+        tx_task.cancel()
+
+        self._rm_dummy_eth()
+        self._injector.close()
+
+        self._loop.remove_reader(mon_fd)
+        self._routeCache.close()
+
+        await self._t_dev.stop()
+
+
+    def run(self):
+        self.log.debug(self._name+":Starting (asyncio)")
+        asyncio.run(self._main())
+        self.log.debug(self._name + ":End")
+
+
+    def stop(self):
+        self._isRunning = False
+        self._bStop = True
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+
+    def get_stats(self):
+        stats = libIp2Lora.Ip2Lora.get_stats(self)
+        # TX scheduler is a task, not the thread of Ip2Lora
+        stats.update({
+            "tx_sent": self.nb_tx_sent,
+            "tx_errors": self.nb_tx_errors,
+        })
+        return stats
@@ -1,38 +1,201 @@
 from Crypto.Cipher import AES
-import struct
+import collections
+import threading
+import time
 
 
+# keystream is cached for packets up to this size (extended for larger packets)
+XOR_KEYSTREAM_SZ = 0x800
+
+
+
+
+"""
+XOR cipher (key repeated over data)
+Key repeated up to XOR_KEYSTREAM_SZ is cached as one big integer: a packet is
+ciphered with one XOR of integers (data is read in place: bytes, bytearray
+or memoryview).
+"""
 class cipherXor():
+    bAead = False
 
-    def __init__(self, key):
+    def __init__(self, key, keystreamSz=XOR_KEYSTREAM_SZ):
         if type(key) == str:
             self.key = bytes(key, "utf-8")
         elif type(key) == bytes:
             self.key = key
         else:
             raise ValueError("Invalid key format")
+        if len(self.key) == 0:
+            raise ValueError("Empty key")
+
+        self._keystream = None
+        self._set_keystream(keystreamSz)
+
+
+    def _set_keystream(self, sz):
+        nb = (sz + len(self.key) - 1) // len(self.key)
+        keystream = self.key * nb
+        # (size, value) replaced at once: cipher/uncipher may run in other threads
+        self._keystream = (len(keystream), int.from_bytes(keystream, "big"))
 
 
     def cipher(self, data):
         if type(data) == str:
             data = bytes(data, "utf-8")
-        elif type(data) == bytes:
-            pass
-        else:
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
             raise ValueError("Invalid data format")
 
-        keystream = self.key
-        while len(keystream) < len(data):
-            keystream += self.key
-
-        clear_data = b""
-        i = 0
-        while i < len(data):
-            clear_data += struct.pack("B", (data[i] ^ keystream[i]))
-            i += 1
+        sz = len(data)
+        if sz == 0:
+            return b""
+        ks_sz, ks = self._keystream
+        if sz > ks_sz:
+            self._set_keystream(sz)
+            ks_sz, ks = self._keystream
 
-        return clear_data
+        # first sz bytes of keystream
+        return (int.from_bytes(data, "big") ^ (ks >> (8 * (ks_sz - sz)))).to_bytes(sz, "big")
 
 
     def uncipher(self, data):
         return self.cipher(data)
+
+
+
+
+# per packet nonce (on air): src LoRa address (4 bits) | counter (36 bits)
+AES_NONCE_SZ = 5
+AES_COUNTER_MASK = (1 << 36) - 1
+
+# counter is seeded from time (AES_COUNTER_RATE per second since 2020):
+# nonces are not reused after a restart
+AES_COUNTER_EPOCH = 1577836800
+AES_COUNTER_RATE = 64
+
+# packets whose keystream is computed by one AES call (AES-CTR)
+AES_BATCH = 16
+
+# max packet size of precomputed keystreams (AES-CTR)
+AES_KEYSTREAM_SZ = 0x200
+
+AES_GCM_TAG_SZ = 8
+
+
+
+
+"""
+Key and nonces of AES ciphers
+nodeId: LoRa address of gateway (nonces of gateways never collide)
+"""
+class _cipherAes():
+
+    def __init__(self, key, nodeId):
+        if type(key) == str:
+            key = bytes(key, "utf-8")
+        if type(key) != bytes or len(key) not in (16, 24, 32):
+            raise ValueError("Invalid AES key (16, 24 or 32 bytes)")
+        self.key = key
+        self._nodeId = nodeId & 0xf
+        self._counter = int((time.time() - AES_COUNTER_EPOCH) * AES_COUNTER_RATE) & AES_COUNTER_MASK
+        self._lock = threading.Lock()
+
+
+    def _next_nonce(self):
+        nonce = ((self._nodeId << 36) | self._counter).to_bytes(AES_NONCE_SZ, "big")
+        self._counter = (self._counter + 1) & AES_COUNTER_MASK
+        return nonce
+
+
+
+
+"""
+AES-CTR cipher: nonce (5 bytes) | data XOR keystream
+Counter block: nonce (5 bytes) | 0 (3 bytes) | block index (8 bytes)
+Keystreams of next packets are computed ahead, AES_BATCH packets at once (one
+AES-ECB call on all counter blocks): ciphering a packet is one XOR.
+Integrity is checked by envelope crc.
+"""
+class cipherAesCtr(_cipherAes):
+    bAead = False
+
+    def __init__(self, key, nodeId, keystreamSz=AES_KEYSTREAM_SZ, batch=AES_BATCH):
+        _cipherAes.__init__(self, key, nodeId)
+        self._ecb = AES.new(self.key, AES.MODE_ECB)
+        self._nbBlocks = (keystreamSz + 15) // 16
+        self._batch = batch
+        self._pool = collections.deque()    # (nonce, keystream as int)
+        self._prefill()
+
+
+    def _counter_blocks(self, nonce, nbBlocks):
+        prefix = nonce + bytes(3)
+        return b"".join(prefix + i.to_bytes(8, "big") for i in range(nbBlocks))
+
+
+    def _prefill(self):
+        nonces = [self._next_nonce() for _ in range(self._batch)]
+        ks = self._ecb.encrypt(b"".join(self._counter_blocks(n, self._nbBlocks) for n in nonces))
+        sz = self._nbBlocks * 16
+        for i, nonce in enumerate(nonces):
+            self._pool.append((nonce, int.from_bytes(ks[i * sz:(i + 1) * sz], "big")))
+
+
+    def _xor(self, data, ks, ks_sz):
+        sz = len(data)
+        if sz == 0:
+            return b""
+        return (int.from_bytes(data, "big") ^ (ks >> (8 * (ks_sz - sz)))).to_bytes(sz, "big")
+
+
+    def cipher(self, data):
+        with self._lock:
+            if len(self._pool) == 0:
+                self._prefill()
+            nonce, ks = self._pool.popleft()
+
+        ks_sz = self._nbBlocks * 16
+        if len(data) > ks_sz:
+            ks_sz = (len(data) + 15) // 16 * 16
+            ks = int.from_bytes(self._ecb.encrypt(self._counter_blocks(nonce, ks_sz // 16)), "big")
+        return nonce + self._xor(data, ks, ks_sz)
+
+
+    def uncipher(self, data):
+        if len(data) < AES_NONCE_SZ:
+            raise ValueError("AES-CTR packet too short")
+        ks_sz = (len(data) - AES_NONCE_SZ + 15) // 16 * 16
+        ks = int.from_bytes(self._ecb.encrypt(self._counter_blocks(bytes(data[:AES_NONCE_SZ]), ks_sz // 16)), "big")
+        return self._xor(memoryview(data)[AES_NONCE_SZ:], ks, ks_sz)
+
+
+
+
+"""
+AES-GCM cipher: nonce (5 bytes) | ciphered data | tag (8 bytes)
+Authenticated encryption: aad (addr/flags byte of envelope) and data are checked
+by tag, envelope has no crc (bAead).
+"""
+class cipherAesGcm(_cipherAes):
+    bAead = True
+
+    def _gcm(self, nonce):
+        # 96 bits nonce (no GHASH of nonce)
+        return AES.new(self.key, AES.MODE_GCM, nonce=bytes(nonce) + bytes(12 - AES_NONCE_SZ), mac_len=AES_GCM_TAG_SZ)
+
+
+    def cipher(self, data, aad=b""):
+        with self._lock:
+            nonce = self._next_nonce()
+        c = self._gcm(nonce)
+        c.update(aad)
+        data, tag = c.encrypt_and_digest(data)
+        return nonce + data + tag
+
+
+    def uncipher(self, data, aad=b""):
+        if len(data) < AES_NONCE_SZ + AES_GCM_TAG_SZ:
+            raise ValueError("AES-GCM packet too short")
+        c = self._gcm(data[:AES_NONCE_SZ])
+        c.update(aad)
+        return c.decrypt_and_verify(data[AES_NONCE_SZ:-AES_GCM_TAG_SZ], data[-AES_GCM_TAG_SZ:])
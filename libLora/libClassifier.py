@@ -0,0 +1,179 @@
+import ipaddress
+
+from libLora import libPacket
+
+
+# max number of memoized packet keys (cache is flushed when full)
+MAX_CACHE_SZ = 4096
+
+PROTOCOLS = {
+    "icmp": libPacket.IPPROTO_ICMP,
+    "tcp": libPacket.IPPROTO_TCP,
+    "udp": libPacket.IPPROTO_UDP,
+}
+
+RULE_FIELDS = ("class", "dscp", "proto", "src", "dst", "port", "sport", "dport")
+
+
+
+
+def _to_set(value, name):
+    if isinstance(value, int):
+        return frozenset([value])
+    try:
+        return frozenset(int(v) for v in value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid value of rule field %s: %s" % (name, value))
+
+
+def _to_net(value, name):
+    try:
+        net = ipaddress.IPv4Network(value, strict=False)
+    except ValueError:
+        raise ValueError("Invalid network of rule field %s: %s" % (name, value))
+    return int(net.network_address), int(net.netmask)
+
+
+def _to_proto(value):
+    if isinstance(value, str):
+        if value.lower() not in PROTOCOLS:
+            raise ValueError("Unknown protocol: %s" % value)
+        return PROTOCOLS[value.lower()]
+    return int(value)
+
+
+
+
+"""
+Compiled classification rule
+Each field is None (any) or a set/network to match
+"""
+class _Rule():
+    __slots__ = ("cls", "dscp", "proto", "src", "dst", "port", "sport", "dport")
+
+    def __init__(self, rule, classIdx):
+        for k in rule:
+            if k not in RULE_FIELDS:
+                raise ValueError("Unknown rule field: %s" % k)
+        if "class" not in rule or rule["class"] not in classIdx:
+            raise ValueError("Rule has no valid class: %s" % rule)
+
+        self.cls = classIdx[rule["class"]]
+        self.dscp = None
+        if "dscp" in rule:
+            self.dscp = _to_set(rule["dscp"], "dscp")
+        self.proto = None
+        if "proto" in rule:
+            self.proto = _to_proto(rule["proto"])
+        self.src = None
+        if "src" in rule:
+            self.src = _to_net(rule["src"], "src")
+        self.dst = None
+        if "dst" in rule:
+            self.dst = _to_net(rule["dst"], "dst")
+        self.port = None
+        if "port" in rule:
+            self.port = _to_set(rule["port"], "port")
+        self.sport = None
+        if "sport" in rule:
+            self.sport = _to_set(rule["sport"], "sport")
+        self.dport = None
+        if "dport" in rule:
+            self.dport = _to_set(rule["dport"], "dport")
+
+
+    def match(self, dscp, src, dst, sport, dport):
+        if self.dscp is not None and dscp not in self.dscp:
+            return False
+        if self.src is not None and (src & self.src[1]) != self.src[0]:
+            return False
+        if self.dst is not None and (dst & self.dst[1]) != self.dst[0]:
+            return False
+        if self.port is not None and sport not in self.port and dport not in self.port:
+            return False
+        if self.sport is not None and sport not in self.sport:
+            return False
+        if self.dport is not None and dport not in self.dport:
+            return False
+        return True
+
+
+
+
+"""
+Traffic classifier
+classes: list of class names, by priority (first is the highest)
+rules: list of dict (see RULE_FIELDS), first matching rule gives class of packet
+    ex: {"class": "control", "proto": "tcp", "port": 502}
+        {"class": "bulk", "dscp": [8, 10], "dst": "172.16.10.0/28"}
+Rules are compiled once:
+ - rules are dispatched in tables by protocol (only rules of packet protocol are tried)
+ - class of each (dscp, proto, src, dst, sport, dport) key is memoized: next packets
+   of a flow cost one dict lookup
+"""
+class Classifier():
+    def __init__(self, classes, rules, defaultClass=None):
+        if len(classes) == 0:
+            raise ValueError("No traffic class")
+        classIdx = {}
+        for i, name in enumerate(classes):
+            classIdx[name] = i
+
+        if defaultClass is None:
+            defaultClass = classes[-1]
+        if defaultClass not in classIdx:
+            raise ValueError("Unknown default class: %s" % defaultClass)
+
+        self.classes = list(classes)
+        self._default = classIdx[defaultClass]
+
+        # dispatch tables: protocol => rules (in config order)
+        compiled = [_Rule(r, classIdx) for r in rules]
+        self._anyProto = [r for r in compiled if r.proto is None]
+        self._byProto = {}
+        for r in compiled:
+            if r.proto is not None and r.proto not in self._byProto:
+                self._byProto[r.proto] = [x for x in compiled if x.proto is None or x.proto == r.proto]
+
+        self._cache = {}
+
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_per_class = [0] * len(self.classes)
+
+
+    """
+    Get class (index in classes) of IPv4 packet
+    """
+    def classify(self, ip):
+        key = (ip.dscp,) + libPacket.flow_key(ip)
+        cls = self._cache.get(key)
+        if cls is None:
+            self.nb_misses += 1
+            cls = self._lookup(key)
+            if len(self._cache) >= MAX_CACHE_SZ:
+                self._cache.clear()
+            self._cache[key] = cls
+        else:
+            self.nb_hits += 1
+
+        self.nb_per_class[cls] += 1
+        return cls
+
+
+    def _lookup(self, key):
+        dscp, proto, src, dst, sport, dport = key
+        for r in self._byProto.get(proto, self._anyProto):
+            if r.match(dscp, src, dst, sport, dport):
+                return r.cls
+        return self._default
+
+
+    def get_stats(self):
+        stats = {
+            "classifier_hits": self.nb_hits,
+            "classifier_misses": self.nb_misses,
+        }
+        for i, name in enumerate(self.classes):
+            stats["classifier_" + name] = self.nb_per_class[i]
+        return stats
@@ -0,0 +1,582 @@
+import zlib
+import lzma
+import time
+
+
+# packets of an epoch (a new epoch restarts compression with an empty window)
+EPOCH_LEN = 32
+
+# stream header: src LoRa address (4 bits) | epoch (4 bits), seq in epoch (1 byte)
+STREAM_HDR_SZ = 2
+MAX_EPOCH_LEN = 0x100
+
+# end of each Z_SYNC_FLUSH block (not sent)
+SYNC_TAIL = b"\x00\x00\xff\xff"
+
+# raw deflate (no zlib header/adler: integrity is checked by envelope crc)
+_WBITS = -15
+
+# preset dictionaries: id of dictionary is first byte of compressed payload
+DICT_ZLIB = "zlib"
+DICT_ZSTD = "zstd"
+DICT_HDR_SZ = 1
+MAX_DICTS = 0x100
+ZLIB_MAX_DICT_SZ = 0x8000
+
+# adaptive codec selection: codec id is first byte of compressed payload
+CODEC_HDR_SZ = 1
+
+# packets of a flow between two trials of every codec
+EXPLORE_PERIOD = 32
+
+# max number of flows known by codec selector (flushed when full)
+SELECTOR_FLOWS = 256
+
+# dictionary training: k-gram size, segment size
+TRAIN_K = 6
+TRAIN_SEGMENT_SZ = 32
+
+
+
+
+class _Context():
+    __slots__ = ("epoch", "seq", "obj")
+
+    def __init__(self, epoch, obj):
+        self.epoch = epoch
+        self.seq = 0
+        self.obj = obj
+
+
+
+
+"""
+Streaming compression: one deflate context per destination
+Each packet is flushed with Z_SYNC_FLUSH: it is decoded at once but next packets
+use it as dictionary (repeated headers/payloads compress to a few bytes).
+Packets must be compressed in transmit order. Every epochLen packets (or after
+reset) a new epoch starts with a fresh context, so a receiver which lost a packet
+resyncs on next epoch.
+"""
+class StreamCompressor():
+    def __init__(self, src, epochLen=EPOCH_LEN, level=9):
+        if epochLen < 1 or epochLen > MAX_EPOCH_LEN:
+            raise ValueError("Invalid compression epoch length: %s" % epochLen)
+        self._src = src & 0xf
+        self._epochLen = epochLen
+        self._level = level
+        self._ctx = {}          # dst => _Context
+
+        self.nb_packets = 0
+        self.nb_epochs = 0
+        self.nb_bytes_in = 0
+        self.nb_bytes_out = 0
+
+
+    def compress(self, dst, data):
+        c = self._ctx.get(dst)
+        if c is None or c.seq >= self._epochLen:
+            epoch = 0
+            if c is not None:
+                epoch = (c.epoch + 1) & 0xf
+            c = _Context(epoch, zlib.compressobj(self._level, zlib.DEFLATED, _WBITS))
+            self._ctx[dst] = c
+            self.nb_epochs += 1
+
+        out = c.obj.compress(data) + c.obj.flush(zlib.Z_SYNC_FLUSH)
+        if out.endswith(SYNC_TAIL):
+            out = out[:-len(SYNC_TAIL)]
+        out = bytes([(self._src << 4) | c.epoch, c.seq]) + out
+        c.seq += 1
+
+        self.nb_packets += 1
+        self.nb_bytes_in += len(data)
+        self.nb_bytes_out += len(out)
+        return out
+
+
+    """
+    Compressed data was not sent (receiver did not see it): next packet to dst
+    starts a new epoch
+    """
+    def reset(self, dst):
+        c = self._ctx.get(dst)
+        if c is not None:
+            c.seq = self._epochLen
+
+
+    def get_stats(self):
+        return {
+            "zstream_tx_packets": self.nb_packets,
+            "zstream_tx_epochs": self.nb_epochs,
+            "zstream_tx_bytes_in": self.nb_bytes_in,
+            "zstream_tx_bytes_out": self.nb_bytes_out,
+        }
+
+
+
+
+"""
+Streaming decompression: one inflate context per source
+A packet is decoded only if it is the next one of the current epoch of its
+source; after a lost/bad packet, packets are dropped until next epoch.
+"""
+class StreamDecompressor():
+    def __init__(self, maxSz=0xffff):
+        self._maxSz = maxSz
+        self._ctx = {}          # src => _Context
+        self._last = None
+
+        self.nb_packets = 0
+        self.nb_epochs = 0
+        self.nb_desync = 0
+
+
+    def decompress(self, data):
+        self._last = None
+        if len(data) < STREAM_HDR_SZ:
+            raise ValueError("stream header too short")
+        src = data[0] >> 4
+        epoch = data[0] & 0xf
+        seq = data[1]
+
+        c = self._ctx.get(src)
+        if seq == 0:
+            c = _Context(epoch, zlib.decompressobj(_WBITS))
+            self._ctx[src] = c
+            self.nb_epochs += 1
+        elif c is None or c.epoch != epoch or c.seq != seq:
+            self.nb_desync += 1
+            self._ctx.pop(src, None)
+            raise ValueError("stream out of sync (src %d epoch %d seq %d)" % (src, epoch, seq))
+
+        try:
+            out = c.obj.decompress(bytes(data[STREAM_HDR_SZ:]) + SYNC_TAIL, self._maxSz)
+        except zlib.error:
+            self._ctx.pop(src, None)
+            raise
+        if c.obj.unconsumed_tail:
+            self._ctx.pop(src, None)
+            raise ValueError("stream packet too large")
+
+        c.seq = seq + 1
+        self._last = src
+        self.nb_packets += 1
+        return out
+
+
+    """
+    Last decoded packet is bad (crc): context of its source is lost
+    """
+    def discard_last(self):
+        if self._last is not None:
+            self._ctx.pop(self._last, None)
+            self.nb_desync += 1
+            self._last = None
+
+
+    def get_stats(self):
+        return {
+            "zstream_rx_packets": self.nb_packets,
+            "zstream_rx_epochs": self.nb_epochs,
+            "zstream_rx_desync": self.nb_desync,
+        }
+
+
+
+
+"""
+Per-packet compression with preset dictionaries (trained on traffic, see
+ip2lora_dict.py): short packets are compressed against the dictionary, each
+packet is decoded alone (no loss-fragility).
+codec: DICT_ZLIB (deflate zdict) or DICT_ZSTD (needs python module zstandard)
+dicts: list of dictionaries (bytes), index in list is dictionary id.
+Every dictionary is tried, the smallest output is sent.
+Both ends must load the same dictionaries in the same order.
+"""
+class DictCompressor():
+    def __init__(self, dicts, codec=DICT_ZLIB, level=9, maxSz=0xffff):
+        if len(dicts) == 0 or len(dicts) > MAX_DICTS:
+            raise ValueError("Invalid number of compression dictionaries: %d" % len(dicts))
+        self._dicts = [bytes(d) for d in dicts]
+        self._level = level
+        self._maxSz = maxSz
+
+        if codec == DICT_ZLIB:
+            for d in self._dicts:
+                if len(d) > ZLIB_MAX_DICT_SZ:
+                    raise ValueError("zlib dictionary larger than window (%d bytes)" % ZLIB_MAX_DICT_SZ)
+            self._compress = self._zlib_compress
+            self._decompress = self._zlib_decompress
+        elif codec == DICT_ZSTD:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd dictionaries need python module zstandard")
+            self._zstdComp = []
+            self._zstdDecomp = []
+            for d in self._dicts:
+                zd = zstandard.ZstdCompressionDict(d)
+                self._zstdComp.append(zstandard.ZstdCompressor(level=min(level, 22), dict_data=zd, write_checksum=False,
+                                                               write_content_size=False, write_dict_id=False))
+                self._zstdDecomp.append(zstandard.ZstdDecompressor(dict_data=zd))
+            self._compress = self._zstd_compress
+            self._decompress = self._zstd_decompress
+        else:
+            raise ValueError("Unknown dictionary codec: %s" % codec)
+
+        self.nb_packets = 0
+        self.nb_bytes_in = 0
+        self.nb_bytes_out = 0
+        self.nb_per_dict = [0] * len(self._dicts)
+
+
+    def _zlib_compress(self, i, data):
+        c = zlib.compressobj(self._level, zlib.DEFLATED, _WBITS, zdict=self._dicts[i])
+        return c.compress(data) + c.flush()
+
+    def _zlib_decompress(self, i, data):
+        d = zlib.decompressobj(_WBITS, zdict=self._dicts[i])
+        out = d.decompress(data, self._maxSz)
+        if d.unconsumed_tail:
+            raise ValueError("dictionary packet too large")
+        return out
+
+    def _zstd_compress(self, i, data):
+        return self._zstdComp[i].compress(data)
+
+    def _zstd_decompress(self, i, data):
+        return self._zstdDecomp[i].decompress(data, max_output_size=self._maxSz)
+
+
+    def compress(self, data):
+        best = None
+        for i in range(len(self._dicts)):
+            out = self._compress(i, data)
+            if best is None or len(out) < len(best[1]):
+                best = (i, out)
+        i, out = best
+        out = bytes([i]) + out
+
+        self.nb_packets += 1
+        self.nb_bytes_in += len(data)
+        self.nb_bytes_out += len(out)
+        self.nb_per_dict[i] += 1
+        return out
+
+
+    def decompress(self, data):
+        if len(data) < DICT_HDR_SZ or data[0] >= len(self._dicts):
+            raise ValueError("unknown compression dictionary")
+        return self._decompress(data[0], bytes(data[DICT_HDR_SZ:]))
+
+
+    def get_stats(self):
+        stats = {
+            "zdict_packets": self.nb_packets,
+            "zdict_bytes_in": self.nb_bytes_in,
+            "zdict_bytes_out": self.nb_bytes_out,
+        }
+        for i, nb in enumerate(self.nb_per_dict):
+            stats["zdict_%d" % i] = nb
+        return stats
+
+
+
+
+"""
+Train a deflate dictionary on samples (packets)
+Greedy segment selection (like zstd COVER): samples are cut in epochs, best
+segment of each epoch (sum of frequencies of its k-grams not yet covered, a
+k-gram counts once per sample) is kept. Most frequent segments are placed at
+the end of dictionary (nearest matches cost less).
+"""
+def train_dictionary(samples, size, k=TRAIN_K, segmentSz=TRAIN_SEGMENT_SZ):
+    if size < segmentSz or k > segmentSz:
+        raise ValueError("Invalid dictionary size")
+    samples = [bytes(s) for s in samples if len(s) >= k]
+    if len(samples) == 0:
+        raise ValueError("No sample to train dictionary")
+
+    freq = {}
+    for s in samples:
+        for g in set(s[i:i + k] for i in range(len(s) - k + 1)):
+            freq[g] = freq.get(g, 0) + 1
+
+    data = b"".join(samples)
+    nbEpochs = max(1, size // segmentSz)
+    epochSz = max(segmentSz, len(data) // nbEpochs)
+
+    segments = []
+    for start in range(0, len(data), epochSz):
+        epoch = data[start:start + epochSz]
+        best = None
+        for i in range(0, max(1, len(epoch) - segmentSz + 1)):
+            seg = epoch[i:i + segmentSz]
+            score = sum(freq.get(g, 0) for g in set(seg[j:j + k] for j in range(len(seg) - k + 1)))
+            if best is None or score > best[0]:
+                best = (score, seg)
+        if best is None or best[0] <= len(best[1]) - k + 1:
+            # k-grams seen once: no gain
+            continue
+        segments.append(best)
+        # covered k-grams do not count anymore
+        for j in range(len(best[1]) - k + 1):
+            freq[best[1][j:j + k]] = 0
+
+    segments.sort(key=lambda x: x[0])
+    d = b"".join(seg for _, seg in segments)
+    return d[-size:]
+
+
+
+
+"""
+Codecs of adaptive compression
+Each codec has a name and a wire id (first byte of compressed payload): ids must
+never change. compress(data) / decompress(data, maxSz)
+"""
+class ZlibCodec():
+    def __init__(self, level):
+        self._level = level
+
+    def compress(self, data):
+        c = zlib.compressobj(self._level, zlib.DEFLATED, _WBITS)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data, maxSz):
+        d = zlib.decompressobj(_WBITS)
+        out = d.decompress(data, maxSz)
+        if d.unconsumed_tail:
+            raise ValueError("packet too large")
+        return out
+
+
+
+"""
+Raw LZMA2 (no xz container) with a small dictionary (cheap per packet setup)
+"""
+class LzmaCodec():
+    _FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9, "dict_size": 0x10000}]
+
+    def compress(self, data):
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self._FILTERS)
+
+    def decompress(self, data, maxSz):
+        d = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self._FILTERS)
+        out = d.decompress(data, maxSz)
+        if not d.eof:
+            raise ValueError("packet too large or truncated")
+        return out
+
+
+
+class Lz4Codec():
+    def __init__(self):
+        import lz4.block
+        self._block = lz4.block
+
+    def compress(self, data):
+        return self._block.compress(data, mode="high_compression", store_size=False)
+
+    def decompress(self, data, maxSz):
+        return self._block.decompress(data, uncompressed_size=maxSz)
+
+
+
+class ZstdCodec():
+    def __init__(self):
+        import zstandard
+        self._comp = zstandard.ZstdCompressor(level=19, write_checksum=False, write_content_size=False)
+        self._decomp = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._comp.compress(data)
+
+    def decompress(self, data, maxSz):
+        return self._decomp.decompress(data, max_output_size=maxSz)
+
+
+
+"""
+Preset dictionaries as a codec of adaptive compression (see DictCompressor)
+"""
+class DictCodec():
+    def __init__(self, dicts, codec=DICT_ZLIB):
+        self._comp = DictCompressor(dicts, codec=codec)
+
+    def compress(self, data):
+        return self._comp.compress(data)
+
+    def decompress(self, data, maxSz):
+        out = self._comp.decompress(data)
+        if len(out) > maxSz:
+            raise ValueError("packet too large")
+        return out
+
+
+
+"""
+Registry of codecs: name => (wire id, factory)
+Factories of optional codecs raise ImportError when their module is missing.
+"""
+CODECS = {}
+
+def register_codec(name, codec_id, factory):
+    if codec_id < 1 or codec_id > 0xff:
+        raise ValueError("Invalid codec id: %d" % codec_id)
+    for n, (i, f) in CODECS.items():
+        if i == codec_id and n != name:
+            raise ValueError("Codec id %d already used by %s" % (codec_id, n))
+    CODECS[name] = (codec_id, factory)
+
+
+register_codec("zlib1", 1, lambda **kw: ZlibCodec(1))
+register_codec("zlib6", 2, lambda **kw: ZlibCodec(6))
+register_codec("zlib9", 3, lambda **kw: ZlibCodec(9))
+register_codec("lzma", 4, lambda **kw: LzmaCodec())
+register_codec("lz4", 5, lambda **kw: Lz4Codec())
+register_codec("zstd", 6, lambda **kw: ZstdCodec())
+register_codec("dict", 7, lambda **kw: DictCodec(kw["dicts"], kw.get("dictCodec", DICT_ZLIB)))
+
+
+"""
+Names of codecs usable here (optional modules installed, dictionaries given)
+"""
+def available_codecs(**kw):
+    names = []
+    for name, (codec_id, factory) in CODECS.items():
+        try:
+            factory(**kw)
+        except (ImportError, KeyError, ValueError):
+            continue
+        names.append(name)
+    return names
+
+
+
+
+class _FlowCodec():
+    __slots__ = ("nb", "best")
+
+    def __init__(self):
+        self.nb = 0
+        self.best = None        # index of codec (None: no compression)
+
+
+
+
+"""
+Adaptive per packet compression
+Cost of a packet is its airtime (airtime(sz): LoRa frame duration of an envelope
+of sz bytes) plus CPU time of its compression.
+For each flow, every codec (and no compression) is tried on one packet every
+explorePeriod packets, the cheapest one is used for next packets of the flow.
+A codec which does not reduce size triggers a new trial on next packet.
+codecs: names (see CODECS), same list on both ends
+overhead: envelope bytes added to payload
+"""
+class CodecSelector():
+    def __init__(self, codecs, airtime, overhead=0, maxSz=0xffff, explorePeriod=EXPLORE_PERIOD, **kw):
+        if len(codecs) == 0:
+            raise ValueError("No compression codec")
+        self._names = []
+        self._ids = []
+        self._codecs = []
+        self._byId = {}
+        for name in codecs:
+            if name not in CODECS:
+                raise ValueError("Unknown compression codec: %s" % name)
+            codec_id, factory = CODECS[name]
+            try:
+                codec = factory(**kw)
+            except ImportError as e:
+                raise ValueError("Compression codec %s is not available: %s" % (name, e))
+            except KeyError:
+                raise ValueError("Compression codec %s needs dictionaries" % name)
+            self._names.append(name)
+            self._ids.append(codec_id)
+            self._codecs.append(codec)
+            self._byId[codec_id] = codec
+
+        self._airtime = airtime
+        self._overhead = overhead
+        self._maxSz = maxSz
+        self._explorePeriod = explorePeriod
+        self._flows = {}        # flow => _FlowCodec
+
+        self.nb_trials = 0
+        self.nb_per_codec = [0] * len(self._codecs)
+        self.nb_none = 0
+        self.cpu_per_codec = [0.0] * len(self._codecs)
+
+
+    def _compress(self, i, data):
+        t = time.perf_counter()
+        out = self._codecs[i].compress(data)
+        t = time.perf_counter() - t
+        self.cpu_per_codec[i] += t
+        return out, t
+
+
+    def _trial(self, st, data):
+        self.nb_trials += 1
+        best = None
+        best_cost = self._airtime(self._overhead + len(data))
+        best_out = None
+        for i in range(len(self._codecs)):
+            out, t = self._compress(i, data)
+            cost = self._airtime(self._overhead + CODEC_HDR_SZ + len(out)) + t
+            if cost < best_cost:
+                best, best_cost, best_out = i, cost, out
+        st.best = best
+        return best, best_out
+
+
+    """
+    Compress packet of flow
+    Return compressed payload (codec id | data) or None if packet is sent clear
+    """
+    def compress(self, flow, data):
+        st = self._flows.get(flow)
+        if st is None:
+            if len(self._flows) >= SELECTOR_FLOWS:
+                self._flows.clear()
+            st = _FlowCodec()
+            self._flows[flow] = st
+
+        if st.nb % self._explorePeriod == 0:
+            i, out = self._trial(st, data)
+        else:
+            i = st.best
+            out = None
+            if i is not None:
+                out = self._compress(i, data)[0]
+                if CODEC_HDR_SZ + len(out) >= len(data):
+                    # flow content changed: new trial
+                    i = None
+                    st.nb = -1
+        st.nb += 1
+
+        if i is None:
+            self.nb_none += 1
+            return None
+        self.nb_per_codec[i] += 1
+        return bytes([self._ids[i]]) + out
+
+
+    def decompress(self, data):
+        if len(data) < CODEC_HDR_SZ or data[0] not in self._byId:
+            raise ValueError("unknown compression codec")
+        return self._byId[data[0]].decompress(bytes(data[CODEC_HDR_SZ:]), self._maxSz)
+
+
+    def get_stats(self):
+        stats = {
+            "codec_trials": self.nb_trials,
+            "codec_none": self.nb_none,
+        }
+        for i, name in enumerate(self._names):
+            stats["codec_" + name] = self.nb_per_codec[i]
+            stats["codec_" + name + "_cpu_ms"] = int(self.cpu_per_codec[i] * 1000)
+        return stats
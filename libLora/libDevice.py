@@ -1,50 +1,173 @@
 
 import serial
 import threading
+import queue
+import select
+import os
 import time
 import struct
 import random
-import math
 import re
 import ctypes
 
+from libLora import libAirtime
+
 
 """
-Calculate duration of LoRa frame transmission
+Calculate duration of LoRa frame transmission (see libAirtime)
 Args:
     PL: payload size in bytes
     SF: SF7...SF12
     EH: 1:Implicit header mode (no hdr) - 0:Explicit header mode
-    LDR: Low data rate (0:off 1:on)
+    LDR: Low data rate (0:off 1:on, None: mandatory LDR of SF/BW)
     CR: Coding rate (5:4/5 - 6:4/6 - 7:4/7 - 8:4/8)
     BW: Bandwidth in kHz: 125 - 250 - 500
     NP: Number of symbols in preamble 
-    
+    CRC: payload CRC (0:off 1:on)
+"""
+def calc_duration_lora_frame(PL=0, SF=7, EH=0, LDR=None, CR=5, BW=125, NP=8, CRC=1):
+    return libAirtime.lora_airtime(PL, SF=SF, BW=BW, CR=CR, NP=NP, EH=EH, CRC=CRC, LDR=LDR)
+
+
+"""
+Duration of a LoRa frame of PL bytes sent with TX configuration
+(drivers keep the airtime model of their configuration: airtime_model)
 """
-def calc_duration_lora_frame(PL=0, SF=7, EH=0, LDR=0, CR=5, BW=125, NP=8):
-    Ts = (2**SF) / float(BW * 1000)
+def calc_duration_tx(config_tx, PL):
+    return libAirtime.get_model(config_tx).airtime(PL)
+
+
+
+
+# max number of received radio frames waiting to be read by gateway
+RX_QUEUE_SZ = 64
 
-    Tpre = (NP+4.25)*Ts
+# max size of an incomplete line (line mode devices)
+MAX_LINE_SZ = 0x1000
 
-    Ns = 8 + 1 + math.ceil(((8 * float(PL) - 4 * float(SF) + 28 + 16 - 20 * EH) / (4 * (float(SF) - 2 * LDR))) * float(CR))
-    Tpay = Ts * Ns
+# max number of writes waiting to be sent on serial
+TX_QUEUE_SZ = 64
 
-    Tpacket = Tpre + Tpay
+# max wait (s) of a writer when serial write queue is full (then data is dropped)
+TX_QUEUE_TIMEOUT = 5
 
-    return Tpacket
+
+
+
+"""
+Latency counter (avg/max in ms)
+"""
+class LatencyStats():
+    def __init__(self):
+        self.nb = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.nb += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def get_stats(self, prefix):
+        avg = 0.0
+        if self.nb > 0:
+            avg = self.total / self.nb
+        return {
+            prefix + "_latency_avg_ms": round(avg * 1000, 3),
+            prefix + "_latency_max_ms": round(self.max * 1000, 3),
+        }
+
+
+
+
+"""
+Dispatch of data received on serial (shared by threaded and asyncio devices)
+Device must provide: LINE_MODE, _cmd_pending, _resp_queue, _line_buf, nb_rx_bytes
+and _push_radio_frame
+"""
+class SerialDispatch():
+    # True if device sends line oriented data (\r\n): data is dispatched by line
+    LINE_MODE = False
+    # True if each received radio frame is given alone (not a byte stream)
+    FRAME_BOUNDARY = False
+    # False if radio CRC (crcOn of configTx/configRx) can not be set on device
+    RADIO_CRC = True
+
+    # airtime budget shared with gateway (see libDutyCycle), None: no duty cycle
+    budget = None
+    # time of last radio frame sent (keepalive is sent only on inactivity)
+    t_last_radio_tx = 0.0
+    nb_keepalive_sent = 0
+    nb_keepalive_skipped = 0
+
+    """
+    Dispatch data received on serial (reader thread or event loop)
+    """
+    def _on_serial_data(self, data):
+        self.log.debug(self._name+":Recv   : %s", data)
+        self.nb_rx_bytes += len(data)
+        if not self.LINE_MODE:
+            if self._cmd_pending:
+                self._resp_queue.put_nowait(data)
+            else:
+                self._push_radio_frame(data)
+            return
+
+        self._line_buf += data
+        lines = self._line_buf.split(b"\r\n")
+        self._line_buf = lines[-1]
+        if len(self._line_buf) > MAX_LINE_SZ:
+            self.log.warning("%s:_on_serial_data:line too long, dropped" % self._name)
+            self._line_buf = b""
+        for line in lines[:-1]:
+            if len(line) > 0:
+                self._on_serial_line(line)
+
+
+    """
+    True if keepalive frame must be sent: no radio frame sent since period (s)
+    and airtime budget allows it (its airtime is then accounted)
+    """
+    def _keepalive_allowed(self, data, period):
+        now = time.monotonic()
+        if now - self.t_last_radio_tx < period:
+            self.nb_keepalive_skipped += 1
+            return False
+        if self.budget is not None and not self.budget.try_charge(self.config_tx["channel"],
+                                                                  self.airtime_model.airtime(len(data)), now):
+            self.nb_keepalive_skipped += 1
+            return False
+        self.nb_keepalive_sent += 1
+        return True
+
+
+    """
+    Dispatch a received line (line mode devices)
+    implemented by child class to detect received radio frames
+    """
+    def _on_serial_line(self, line):
+        if self._cmd_pending:
+            self._resp_queue.put_nowait(line)
 
 
 
 
 """
 Generic serial Device class
+Serial is full-duplex:
+A reader thread waits on serial fd and dispatches received data:
+ - to radio frames queue (read by gateway with recv_radio_frame)
+ - to command responses queue when a command is pending (read with recv_serial)
+A writer thread sends queued data (non blocking writes)
 """
-class CommSerialDev(threading.Thread):
+class CommSerialDev(SerialDispatch, threading.Thread):
     def __init__(self, config={}):
         threading.Thread.__init__(self)
         self._name = config["name"]
         self.log = config["log"]
         self._isRunning = False
+        self._timeout = config["timeout"]
 
         try:
             self._serial = serial.Serial(port=config["port"],
@@ -54,12 +177,26 @@ class CommSerialDev(threading.Thread):
                                         stopbits=config["stopbits"],
                                         xonxoff=config["xonxoff"],
                                         rtscts=config["rtscts"],
-                                        timeout=config["timeout"])
+                                        timeout=config["timeout"],
+                                        write_timeout=0)
         except Exception as e:
             self.log.error("%s:CommSerialDev_init:Failed to open serial: %s" % (self._name, str(e)))
             exit(1)
         self._lock_serial = threading.Lock()
 
+        self._rx_queue = queue.Queue(maxsize=RX_QUEUE_SZ)
+        self._resp_queue = queue.Queue()
+        self._cmd_lock = threading.Lock()
+        self._cmd_pending = False
+        self._line_buf = b""
+        self._t_reader = SerialReader(t_serial_dev=self)
+        self._t_writer = SerialWriter(t_serial_dev=self)
+
+        self.nb_rx_bytes = 0
+        self.nb_rx_frames = 0
+        self.nb_rx_dropped = 0
+        self._rx_latency = LatencyStats()
+
 
 
 
@@ -68,8 +205,11 @@ class CommSerialDev(threading.Thread):
         self.log.debug(self._name+":Start")
 
         self._open()
+        self._t_reader.start()
+        self._t_writer.start()
 
         if not self._init_stuff():
+            self._stop_io()
             raise ValueError("Unable to init LoRa device")
 
         self._isRunning = True
@@ -78,10 +218,18 @@ class CommSerialDev(threading.Thread):
             time.sleep(1)
 
         self._destroy_stuff()
+        self._stop_io()
         self._serial.close()
         self.log.debug(self._name + ":End")
 
 
+    def _stop_io(self):
+        self._t_writer.stop()
+        self._t_writer.join()
+        self._t_reader.stop()
+        self._t_reader.join()
+
+
 
 
 
@@ -110,35 +258,273 @@ class CommSerialDev(threading.Thread):
 
 
     def send_radio_frame(self, data):
-        return self.send_serial(data)
+        self.t_last_radio_tx = time.monotonic()
+        # wait data is written to start airtime accounting
+        return self.send_serial(data, bWait=True)
+
+
+    """
+    Get next received radio frame
+    Wait until timeout (s) - Return b"" if no frame
+    """
+    def recv_radio_frame(self, timeout=None):
+        data = self._get_rx_item(timeout)
+        if data is None:
+            return b""
+        return data
 
 
-    def recv_radio_frame(self):
-        return self.recv_serial()
+    def _get_rx_item(self, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
+        try:
+            if timeout <= 0:
+                data, t_recv = self._rx_queue.get_nowait()
+            else:
+                data, t_recv = self._rx_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self._rx_latency.add(time.monotonic() - t_recv)
+        return data
 
 
-    def send_serial(self, data):
+    """
+    Store received radio frame (called by reader thread)
+    Oldest frame is dropped if gateway does not read them
+    """
+    def _push_radio_frame(self, data):
+        self.nb_rx_frames += 1
+        item = (data, time.monotonic())
+        try:
+            self._rx_queue.put_nowait(item)
+        except queue.Full:
+            try:
+                self._rx_queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.nb_rx_dropped += 1
+            self._rx_queue.put_nowait(item)
+
+
+    """
+    Start a command: data received is sent to responses queue until _end_cmd
+    """
+    def _begin_cmd(self):
+        self._cmd_lock.acquire()
+        self._flush_resp()
+        self._cmd_pending = True
+
+
+    def _end_cmd(self):
+        self._cmd_pending = False
+        self._cmd_lock.release()
+
+
+    def _flush_resp(self):
+        while True:
+            try:
+                self._resp_queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+    """
+    Queue data to write on serial
+    Block if write queue is full (backpressure)
+    bWait: return only when data is written
+    Return False if data is dropped
+    """
+    def send_serial(self, data, bWait=False):
         self.log.debug(self._name+":Sending: %s", data)
-        self._lock_serial.acquire()
+        return self._t_writer.write(data, bWait=bWait)
+
+
+
+    """
+    Get next command response
+    Wait until timeout (s) - Return b"" if no response
+    """
+    def recv_serial(self, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
         try:
-            self._serial.write(data)
-        except Exception as e:
-            self.log.error("%s:send_serial:Error on serial write: %s" % (self._name, str(e)))
-        self._lock_serial.release()
+            return self._resp_queue.get(timeout=timeout)
+        except queue.Empty:
+            return b""
 
 
+    def get_stats(self):
+        stats = {
+            "dev_rx_bytes": self.nb_rx_bytes,
+            "dev_rx_frames": self.nb_rx_frames,
+            "dev_rx_dropped": self.nb_rx_dropped,
+            "dev_rx_queue_len": self._rx_queue.qsize(),
+            "dev_keepalive_sent": self.nb_keepalive_sent,
+            "dev_keepalive_skipped": self.nb_keepalive_skipped,
+        }
+        stats.update(self._rx_latency.get_stats("dev_rx"))
+        stats.update(self._t_writer.get_stats())
+        return stats
 
-    def recv_serial(self, nb=0x400):
-        self._lock_serial.acquire()
+
+
+
+"""
+Serial reader thread
+Wait (select) on serial fd and give received data to device
+"""
+class SerialReader(threading.Thread):
+    def __init__(self, t_serial_dev=None):
+        threading.Thread.__init__(self)
+        self._name = t_serial_dev._name + ":SerialReader"
+        self.t_serial_dev = t_serial_dev
+        self.log = t_serial_dev.log
+        self._isRunning = False
+
+        # pipe used to wake up thread on stop
+        self._wake_r, self._wake_w = os.pipe()
+
+
+    def run(self):
+        ser = self.t_serial_dev._serial
+
+        self._isRunning = True
+        while self._isRunning:
+            r, _, _ = select.select([ser.fileno(), self._wake_r], [], [])
+            if self._wake_r in r:
+                os.read(self._wake_r, 64)
+                continue
+
+            try:
+                data = ser.read(max(1, ser.in_waiting))
+            except Exception as e:
+                self.log.error("%s:Error on serial read: %s" % (self._name, str(e)))
+                time.sleep(0.1)
+                continue
+
+            if len(data) > 0:
+                self.t_serial_dev._on_serial_data(data)
+
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+    def stop(self):
+        self._isRunning = False
+        os.write(self._wake_w, b"s")
+
+
+
+
+"""
+Serial writer thread
+Data is queued by callers and written without blocking (select on serial fd)
+Latency is time between write request and end of write
+"""
+class SerialWriter(threading.Thread):
+    def __init__(self, t_serial_dev=None, maxLen=TX_QUEUE_SZ):
+        threading.Thread.__init__(self)
+        self._name = t_serial_dev._name + ":SerialWriter"
+        self.t_serial_dev = t_serial_dev
+        self.log = t_serial_dev.log
+        self._isRunning = False
+        self._queue = queue.Queue(maxsize=maxLen)
+
+        self.nb_bytes = 0
+        self.nb_writes = 0
+        self.nb_dropped = 0
+        self.nb_errors = 0
+        self._latency = LatencyStats()
+
+
+    """
+    Queue data to write
+    Return False if data is dropped (queue full or write error when bWait)
+    """
+    def write(self, data, bWait=False, timeout=TX_QUEUE_TIMEOUT):
+        done = None
+        if bWait:
+            done = [threading.Event(), False]
         try:
-            data = self._serial.read(nb)
-        except Exception as e:
-            self.log.error("%s:recv_serial:Error on serial read: %s" % (self._name, str(e)))
-            data = b""
-        self._lock_serial.release()
-        if len(data) > 0:
-            self.log.debug(self._name+":Recv   : %s", data)
-        return data
+            self._queue.put((data, time.monotonic(), done), timeout=timeout)
+        except queue.Full:
+            self.nb_dropped += 1
+            self.log.warning("%s:write queue full, data dropped" % self._name)
+            return False
+
+        if done is None:
+            return True
+        done[0].wait()
+        return done[1]
+
+
+    def _write_all(self, data):
+        ser = self.t_serial_dev._serial
+        view = memoryview(data)
+        while len(view) > 0:
+            # wait serial is ready (non blocking write)
+            _, w, _ = select.select([], [ser.fileno()], [], 1)
+            if len(w) == 0:
+                if not self._isRunning:
+                    return False
+                continue
+            try:
+                n = ser.write(view)
+            except Exception as e:
+                self.nb_errors += 1
+                self.log.error("%s:send_serial:Error on serial write: %s" % (self._name, str(e)))
+                return False
+            if n is None:
+                n = len(view)
+            view = view[n:]
+            self.nb_bytes += n
+        return True
+
+
+    def run(self):
+        self._isRunning = True
+        while self._isRunning:
+            item = self._queue.get()
+            if item is None:
+                continue
+
+            data, t_req, done = item
+            res = self._write_all(data)
+            self.nb_writes += 1
+            self._latency.add(time.monotonic() - t_req)
+            if done is not None:
+                done[1] = res
+                done[0].set()
+
+        # release callers still waiting
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None and item[2] is not None:
+                item[2][0].set()
+
+
+    def stop(self):
+        self._isRunning = False
+        try:
+            self._queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+
+
+    def get_stats(self):
+        stats = {
+            "dev_tx_bytes": self.nb_bytes,
+            "dev_tx_writes": self.nb_writes,
+            "dev_tx_dropped": self.nb_dropped,
+            "dev_tx_errors": self.nb_errors,
+            "dev_tx_queue_len": self._queue.qsize(),
+        }
+        stats.update(self._latency.get_stats("dev_tx"))
+        return stats
+
 
 
 
@@ -147,6 +533,65 @@ Serial class for B-L072Z-LRWAN1 board
 """
 L072Z_CMD_SEND = b"\x01"
 L072Z_CMD_CONFIG = b"\x02"
+
+"""
+L072Z firmware commands (shared by threaded and asyncio drivers)
+"""
+def l072z_send_cmd(data):
+    return L072Z_CMD_SEND + struct.pack("<H", len(data)) + data
+
+
+def _l072z_config_cmd(config):
+    return L072Z_CMD_CONFIG + struct.pack("<H", len(config)) + config
+
+
+def l072z_tx_config_cmd(config_tx):
+    config = b"TC"
+    config += struct.pack("<I", config_tx["channel"])
+    config += struct.pack("B", config_tx["modem"])
+    config += struct.pack("B", config_tx["power"])
+    config += struct.pack("B", config_tx["fdev"])
+    config += struct.pack("B", config_tx["bandwidth"])
+    config += struct.pack("B", config_tx["datarate"])
+    config += struct.pack("B", config_tx["coderate"])
+    config += struct.pack("B", config_tx["preambleLen"])
+    config += struct.pack("B", config_tx["fixLen"])
+    config += struct.pack("B", config_tx["crcOn"])
+    config += struct.pack("B", config_tx["freqHopOn"])
+    config += struct.pack("B", config_tx["hopPeriod"])
+    config += struct.pack("B", config_tx["iqInverted"])
+    config += struct.pack("<H", config_tx["timeout"])
+    return _l072z_config_cmd(config)
+
+
+def l072z_tx_channel_cmd(channel):
+    config = b"Tc"
+    config += struct.pack("<I", channel)
+    return _l072z_config_cmd(config)
+
+
+def l072z_rx_config_cmd(config_rx):
+    config = b"RC"
+    config += struct.pack("<I", config_rx["channel"])
+    config += struct.pack("B", config_rx["modem"])
+    config += struct.pack("B", config_rx["bandwidth"])
+    config += struct.pack("B", config_rx["datarate"])
+    config += struct.pack("B", config_rx["coderate"])
+    config += struct.pack("B", config_rx["bandwidthAfc"])
+    config += struct.pack("B", config_rx["preambleLen"])
+    config += struct.pack("B", config_rx["symbTimeout"])
+    config += struct.pack("B", config_rx["fixLen"])
+    config += struct.pack("B", config_rx["payloadLen"])
+    config += struct.pack("B", config_rx["crcOn"])
+    config += struct.pack("B", config_rx["freHopOn"])
+    config += struct.pack("B", config_rx["hopPeriod"])
+    config += struct.pack("B", config_rx["iqInverted"])
+    config += struct.pack("B", config_rx["rxContinuous"])
+    return _l072z_config_cmd(config)
+
+
+
+
 class L072Z(CommSerialDev):
     def __init__(self, config={}):
         CommSerialDev.__init__(self, config=config["configSerial"])
@@ -154,15 +599,8 @@ class L072Z(CommSerialDev):
         self.config_rx = config["configRx"]
         self.radio_tx_lock = threading.Lock()
 
-        self.recv_radio_frame_lock = threading.Lock() # used to lock normal received when send/recv config
-
-        self.max_time_transmission = calc_duration_lora_frame(PL=config["maxLoraFrameSz"],
-                                      SF=self.config_tx["datarate"],
-                                      EH=self.config_tx["fixLen"],
-                                      LDR=0,
-                                      CR=4 + self.config_tx["coderate"],
-                                      BW=[125, 250, 500][self.config_tx["bandwidth"]],
-                                      NP=self.config_tx["preambleLen"])
+        self.airtime_model = libAirtime.get_model(self.config_tx)
+        self.max_time_transmission = self.airtime_model.airtime(config["maxLoraFrameSz"])
 
         # send periodic small Lora data
         # for unknown reason, on inactivity board not listen until it send a frame...
@@ -205,16 +643,11 @@ class L072Z(CommSerialDev):
         #self.log.debug(self._name + ":send_radio_frame: begin")
         self.radio_tx_lock.acquire()
 
-        data = L072Z_CMD_SEND + struct.pack("<H", len(data)) + data
+        # airtime of radio payload (not of serial command)
+        ts = self.airtime_model.airtime(len(data))
+        data = l072z_send_cmd(data)
         CommSerialDev.send_radio_frame(self, data=data)
         # wait until frame is transmitted
-        ts = calc_duration_lora_frame(PL=len(data),
-                                      SF=self.config_tx["datarate"],
-                                      EH=self.config_tx["fixLen"],
-                                      LDR=0,
-                                      CR=4+self.config_tx["coderate"],
-                                      BW=[125, 250, 500][self.config_tx["bandwidth"]],
-                                      NP=self.config_tx["preambleLen"])
         time.sleep(ts)
         # (half-duplex) give a chance to others node to send response
         ts = self.max_time_transmission + ts * random.random()
@@ -226,16 +659,6 @@ class L072Z(CommSerialDev):
         return
 
 
-    """
-    Get LoRa received frame
-    """
-    def recv_radio_frame(self):
-        self.recv_radio_frame_lock.acquire()
-        r = CommSerialDev.recv_serial(self)
-        self.recv_radio_frame_lock.release()
-        return r
-
-
     """
     Set Tx Configuration
     (Channel frequency for TX and RX can be different)
@@ -244,38 +667,14 @@ class L072Z(CommSerialDev):
         if self.config_tx is None:
             return True
 
-        config = b"TC"
-        config += struct.pack("<I", self.config_tx["channel"])
-        config += struct.pack("B", self.config_tx["modem"])
-        config += struct.pack("B", self.config_tx["power"])
-        config += struct.pack("B", self.config_tx["fdev"])
-        config += struct.pack("B", self.config_tx["bandwidth"])
-        config += struct.pack("B", self.config_tx["datarate"])
-        config += struct.pack("B", self.config_tx["coderate"])
-        config += struct.pack("B", self.config_tx["preambleLen"])
-        config += struct.pack("B", self.config_tx["fixLen"])
-        config += struct.pack("B", self.config_tx["crcOn"])
-        config += struct.pack("B", self.config_tx["freqHopOn"])
-        config += struct.pack("B", self.config_tx["hopPeriod"])
-        config += struct.pack("B", self.config_tx["iqInverted"])
-        config += struct.pack("<H", self.config_tx["timeout"])
-
-        data = L072Z_CMD_CONFIG + struct.pack("<H", len(config)) + config
-        #CommSerialDev.send_radio_frame(self, data=data)
-        return self._send_config(data)
+        return self._send_config(l072z_tx_config_cmd(self.config_tx))
 
 
     """
     Change TX channel frequency 
     """
     def set_tx_channel(self, channel):
-
-        config = b"Tc"
-        config += struct.pack("<I", channel)
-
-        data = L072Z_CMD_CONFIG + struct.pack("<H", len(config)) + config
-        # CommSerialDev.send_radio_frame(self, data=data)
-        self._send_config(data)
+        self._send_config(l072z_tx_channel_cmd(channel))
 
 
     """
@@ -286,26 +685,7 @@ class L072Z(CommSerialDev):
         if self.config_rx is None:
             return True
 
-        config = b"RC"
-        config += struct.pack("<I", self.config_rx["channel"])
-        config += struct.pack("B", self.config_rx["modem"])
-        config += struct.pack("B", self.config_rx["bandwidth"])
-        config += struct.pack("B", self.config_rx["datarate"])
-        config += struct.pack("B", self.config_rx["coderate"])
-        config += struct.pack("B", self.config_rx["bandwidthAfc"])
-        config += struct.pack("B", self.config_rx["preambleLen"])
-        config += struct.pack("B", self.config_rx["symbTimeout"])
-        config += struct.pack("B", self.config_rx["fixLen"])
-        config += struct.pack("B", self.config_rx["payloadLen"])
-        config += struct.pack("B", self.config_rx["crcOn"])
-        config += struct.pack("B", self.config_rx["freHopOn"])
-        config += struct.pack("B", self.config_rx["hopPeriod"])
-        config += struct.pack("B", self.config_rx["iqInverted"])
-        config += struct.pack("B", self.config_rx["rxContinuous"])
-
-        data = L072Z_CMD_CONFIG + struct.pack("<H", len(config)) + config
-        #CommSerialDev.send_radio_frame(self, data=data)
-        return self._send_config(data)
+        return self._send_config(l072z_rx_config_cmd(self.config_rx))
 
 
     """
@@ -313,21 +693,26 @@ class L072Z(CommSerialDev):
     """
     def _send_config(self, raw_config, nbTry=10):
         bConfigOk = False
-        self.recv_radio_frame_lock.acquire()
+        self._begin_cmd()
         n = 0
         while not bConfigOk:
-            d = self.recv_serial()
+            self._flush_resp()
             CommSerialDev.send_serial(self, data=raw_config)
-            time.sleep(1)
-            d = self.recv_serial()
-            if d == b"CONFIG_OK":
-                bConfigOk = True
+            # wait response (1s max)
+            d = b""
+            t_end = time.time() + 1
+            while time.time() < t_end:
+                d += self.recv_serial()
+                if b"CONFIG_OK" in d:
+                    bConfigOk = True
+                    break
+            if bConfigOk:
                 break
             n += 1
             if n >= nbTry:
                 break
 
-        self.recv_radio_frame_lock.release()
+        self._end_cmd()
         return bConfigOk
 
 
@@ -354,7 +739,9 @@ class sendPeriodicData(threading.Thread):
             time.sleep(1)
             i += 1
             if i >= self._period:
-                self.t_serial_dev.send_radio_frame(self.data)
+                # skipped if radio was used recently or airtime budget is exhausted
+                if self.t_serial_dev._keepalive_allowed(self.data, self._period):
+                    self.t_serial_dev.send_radio_frame(self.data)
                 i = 0
 
 
@@ -369,22 +756,61 @@ class sendPeriodicData(threading.Thread):
 """
 Serial class for Wisnode board
 """
+RAK811_RE_RECV = re.compile(b"^at\\+recv=.*,.*,(.*):([0-9A-F]+)")
+
+"""
+RAK811 AT commands and received frames (shared by threaded and asyncio drivers)
+"""
+def rak811_region_cmd(config_rx):
+    if config_rx["channel"] >= 433000000 and config_rx["channel"] < 868000000:
+        return "set_config=lora:region:EU433"
+    return "set_config=lora:region:EU868"
+
+
+def rak811_rx_config_cmd(config_rx, config_tx):
+    return "set_config=lorap2p:"+str(config_rx["channel"])+":"+str(config_rx["datarate"])+":"+ \
+           str(config_rx["bandwidth"])+":"+str(config_rx["coderate"])+":"+str(config_rx["preambleLen"])+":"+\
+           str(config_tx["power"])
+
+
+"""
+Get radio frame from a line received from RAK811
+Return None if line is not a received frame, b"" if received frame is invalid
+"""
+def rak811_parse_recv(line, log, name):
+    tmp = RAK811_RE_RECV.match(line)
+    if tmp is None:
+        return None
+
+    try:
+        sz_data = int(tmp.group(1))
+        data = bytes.fromhex(tmp.group(2).decode("utf8"))
+    except Exception as e:
+        log.warn("%s:recv_radio_frame:Data recv is not a HEX string: %s" % (name, line))
+        return b""
+
+    if len(data) != sz_data:
+        log.warn("%s:recv_radio_frame: Failed to get complete frame: %s" % (name, line))
+        return b""
+
+    return data
+
+
+
+
 class RAK811(CommSerialDev):
+    LINE_MODE = True
+    FRAME_BOUNDARY = True
+    RADIO_CRC = False
+
     def __init__(self, config={}):
         CommSerialDev.__init__(self, config=config["configSerial"])
         self.config_tx = config["configTx"]
         self.config_rx = config["configRx"]
         self.radio_tx_lock = threading.Lock()
 
-        self._recv_radio_frame_lock = threading.Lock()  # used to lock normal received when send/recv config
-
-        self.max_time_transmission = calc_duration_lora_frame(PL=config["maxLoraFrameSz"],
-                                                              SF=self.config_tx["datarate"],
-                                                              EH=self.config_tx["fixLen"],
-                                                              LDR=0,
-                                                              CR=4 + self.config_tx["coderate"],
-                                                              BW=[125, 250, 500][self.config_tx["bandwidth"]],
-                                                              NP=self.config_tx["preambleLen"])
+        self.airtime_model = libAirtime.get_model(self.config_tx)
+        self.max_time_transmission = self.airtime_model.airtime(config["maxLoraFrameSz"])
         self._mode_tx_lock = threading.Lock()
         self._mode_tx = False
 
@@ -413,20 +839,20 @@ class RAK811(CommSerialDev):
     Send AT command to board
     """
     def _send_at_cmd(self, cmd, maxTry=10):
-        self._recv_radio_frame_lock.acquire()
+        self._begin_cmd()
         CommSerialDev.send_serial(self, data=b"at+"+bytes(cmd, encoding="utf8")+b"\r\n")
         t = 0
         data = ""
         while t < maxTry:
             bData = CommSerialDev.recv_serial(self)
             if len(bData) > 0:
-                data += bData.decode("utf8")
+                data += bData.decode("utf8") + "\r\n"
                 if re.match(".*OK .*", data, re.MULTILINE|re.DOTALL):
-                    self._recv_radio_frame_lock.release()
+                    self._end_cmd()
                     return True, data
 
             t += 1
-        self._recv_radio_frame_lock.release()
+        self._end_cmd()
         return False, data
 
 
@@ -466,14 +892,9 @@ class RAK811(CommSerialDev):
             return False
 
         # set region
-        if self.config_rx["channel"] >= 433000000 and self.config_rx["channel"] < 868000000:
-            r, region = self._send_at_cmd("set_config=lora:region:EU433")
-            if not r:
-                return False
-        else:
-            r, region = self._send_at_cmd("set_config=lora:region:EU868")
-            if not r:
-                return False
+        r, region = self._send_at_cmd(rak811_region_cmd(self.config_rx))
+        if not r:
+            return False
 
         return True
 
@@ -530,46 +951,14 @@ class RAK811(CommSerialDev):
 
 
     """
-    Get LoRa received frame
+    Get LoRa received frame from received line (reader thread)
     """
-    def recv_radio_frame(self):
-
-        self._recv_radio_frame_lock.acquire()
-        data = CommSerialDev.recv_serial(self)
-        data = data.decode("utf8")
-        re_at = "^at\+recv=.*,.*,(.*):([0-9A-F]+)"
-        if re.match(re_at, data) is None:
-            # print not a recv frame
-            data = b""
-            self._recv_radio_frame_lock.release()
-            return data
-
-
-        tmp = re.search(re_at, data)
-        sz_data = int(tmp.group(1)) * 2
-        data = tmp.group(2)
-
-
-        maxTry = 5
-        t = 0
-        while len(data) < sz_data:
-            data += CommSerialDev.recv_serial(self, sz_data - len(data)).decode("utf8")
-            t += 1
-            if t > maxTry:
-                self.log.warn("%s:recv_radio_frame: Failed to get complete frame: %s" % (self._name, data))
-                data = b""
-                self._recv_radio_frame_lock.release()
-                return data
-
-
-        try:
-            data = bytes.fromhex(data)
-        except Exception as e:
-            self.log.warn("%s:recv_radio_frame:Data recv is not a HEX string: %s" % (self._name, data))
-            data = b""
-
-        self._recv_radio_frame_lock.release()
-        return data
+    def _on_serial_line(self, line):
+        data = rak811_parse_recv(line, self.log, self._name)
+        if data is None:
+            CommSerialDev._on_serial_line(self, line)
+        elif len(data) > 0:
+            self._push_radio_frame(data)
 
 
 
@@ -578,10 +967,7 @@ class RAK811(CommSerialDev):
     """
     def set_rx_config(self):
 
-        config = "set_config=lorap2p:"+str(self.config_rx["channel"])+":"+str(self.config_rx["datarate"])+":"+ \
-                 str(self.config_rx["bandwidth"])+":"+str(self.config_rx["coderate"])+":"+str(self.config_rx["preambleLen"])+":"+\
-                 str(self.config_tx["power"])
-        r, resp = self._send_at_cmd(config, maxTry=40)
+        r, resp = self._send_at_cmd(rak811_rx_config_cmd(self.config_rx, self.config_tx), maxTry=40)
         if r:
             return True
 
@@ -628,87 +1014,97 @@ class RAK811(CommSerialDev):
 """
 Serial class for LoStick
 """
+LOSTICK_RE_RECV = re.compile(b"^radio_rx  ([0-9A-F]+)")
+
+"""
+LoStick radio configuration commands (shared by threaded and asyncio drivers)
+"""
+def lostick_radio_cmds(config_rx, config_tx):
+    crc = "off"
+    if config_rx["crcOn"] == 1:
+        crc = "on"
+
+    # 0:125kHz, 1:250kHz, 2:500kHz
+    bandwidth = "125"
+    if config_rx["bandwidth"] == 1:
+        bandwidth = "250"
+    elif config_rx["bandwidth"] == 2:
+        bandwidth = "500"
+
+    # 1:4/5, 2:4/6, 3:4/7, 4:4/8
+    coderate = "4/5"
+    if config_rx["coderate"] in (1, 2, 3, 4):
+        coderate = "4/" + str(4 + config_rx["coderate"])
+
+    return ["mac pause",
+            "radio set mod lora",
+            "radio set wdt 0",
+            "radio set sync 12",
+            "radio set crc "+crc,
+            "radio set bw "+bandwidth,
+            "radio set rxbw "+bandwidth,
+            "radio set sf sf"+str(config_rx["datarate"]),
+            "radio set cr "+coderate,
+            "radio set freq "+str(config_rx["channel"]),
+            "radio set prlen "+str(config_rx["preambleLen"]),
+            "radio set pwr "+str(config_tx["power"])]
+
+
+"""
+Get radio frame from a line received from LoStick
+Return None if line is not a received frame, b"" if received frame is invalid
+"""
+def lostick_parse_recv(line, log, name):
+    tmp = LOSTICK_RE_RECV.match(line)
+    if tmp is None:
+        return None
+
+    try:
+        return bytes.fromhex(tmp.group(1).decode("utf8"))
+    except Exception as e:
+        log.warn("%s:recv_radio_frame:Data recv is not a HEX string: %s" % (name, line))
+        return b""
+
+
+
+
 class LoStick(CommSerialDev):
+    LINE_MODE = True
+    FRAME_BOUNDARY = True
+
     def __init__(self, config={}):
         CommSerialDev.__init__(self, config=config["configSerial"])
         self.config_tx = config["configTx"]
         self.config_rx = config["configRx"]
         self.radio_tx_lock = threading.Lock()
 
-        self._recv_radio_frame_lock = threading.Lock()  # used to lock normal received when send/recv config
-
-        self.max_time_transmission = calc_duration_lora_frame(PL=config["maxLoraFrameSz"],
-                                                              SF=self.config_tx["datarate"],
-                                                              EH=self.config_tx["fixLen"],
-                                                              LDR=0,
-                                                              CR=4 + self.config_tx["coderate"],
-                                                              BW=[125, 250, 500][self.config_tx["bandwidth"]],
-                                                              NP=self.config_tx["preambleLen"])
+        self.airtime_model = libAirtime.get_model(self.config_tx)
+        self.max_time_transmission = self.airtime_model.airtime(config["maxLoraFrameSz"])
         self._mode_tx_lock = threading.Lock()
         self._mode_tx = False
 
 
-        # TODO add function serial_recv
-        # call CommSerialDev.recv_serial
-        #
-        self._l_recv_serial_queue = []
-        self._l_recv_serial_queue_lock = threading.Lock()
-
-
     """
-    get data from serial
-    split on \r\n and store response on queue
-    return older response
+    Dispatch received line (reader thread)
+    - radio frames are stored in radio frames queue
+    - unexpected lines (radio_err, ...) wake up gateway to put board back in receive mode
     """
-    def _recv_serial(self):
-        data = b""
-
-        self._l_recv_serial_queue_lock.acquire()
-
-        if len(self._l_recv_serial_queue) > 0:
-            data = self._l_recv_serial_queue[0]
-            self._l_recv_serial_queue = self._l_recv_serial_queue[1:]
-            self._l_recv_serial_queue_lock.release()
-            #self.log.debug("%s:_recv_serial: %s" % (self._name, data))
-            return data
-
-
-        d = CommSerialDev.recv_serial(self)
-
-        if len(d) > 0:
-            # got recv data from serial
-            maxTry = 10
-            n = 0
-            while (len(d) < 2) and (n < maxTry):
-                n += 1
-                d += CommSerialDev.recv_serial(self)
-
-            # Ensure got one or many complete responses and store them in queue
-            while (d[-2:] != b"\r\n") and (n < maxTry):
-                n += 1
-                d += CommSerialDev.recv_serial(self)
-
-            l = d.split(b"\r\n")
-            try:
-                l.remove(b"")
-            except:
-                pass
+    def _on_serial_line(self, line):
+        if line == b"radio_tx_ok":
+            # ignore radio_tx_ok msg
+            return
 
-            try:
-                # ignore radio_tx_ok msg
-                l.remove(b"radio_tx_ok")
-            except:
-                pass
+        data = lostick_parse_recv(line, self.log, self._name)
+        if data is not None:
+            self._push_radio_frame(data)
+            return
 
-            self._l_recv_serial_queue += l
+        if self._cmd_pending:
+            self._resp_queue.put_nowait(line)
+            return
 
-        if len(self._l_recv_serial_queue) > 0:
-            data = self._l_recv_serial_queue[0]
-            self._l_recv_serial_queue = self._l_recv_serial_queue[1:]
-            #self.log.debug("%s:_recv_serial: %s" % (self._name, data))
-        self._l_recv_serial_queue_lock.release()
-
-        return data
+        self.log.debug("%s:recv_radio_frame:Unexpected command recv: %s" % (self._name, line))
+        self._push_radio_frame(b"")
 
 
     def _send_serial(self, data):
@@ -734,27 +1130,25 @@ class LoStick(CommSerialDev):
     Send command to board
     """
     def _send_cmd(self, cmd, maxTry=10, bExpectOk=False):
-        self._recv_radio_frame_lock.acquire()
+        self._begin_cmd()
         self._send_serial(data=bytes(cmd, encoding="utf8")+b"\r\n")
         t = 0
         data = ""
         while t < maxTry:
-            bData = self._recv_serial()
+            bData = self.recv_serial()
             if len(bData) > 0:
                 data += bData.decode("utf8")
+                self._end_cmd()
                 if data == "ok":
-                    self._recv_radio_frame_lock.release()
                     return True, data
                 elif data == "invalid_param":
-                    self._recv_radio_frame_lock.release()
                     return False, data
                 else:
-                    self._recv_radio_frame_lock.release()
                     if bExpectOk:
                         return False, data
                     return True, data
             t += 1
-        self._recv_radio_frame_lock.release()
+        self._end_cmd()
         return False, data
 
 
@@ -776,68 +1170,11 @@ class LoStick(CommSerialDev):
             self.log.error("%s:Version not supported: %s" % (self._name, version))
             return False
 
-        # set mode LoraP2P
-        r, data = self._send_cmd("mac pause")
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set mod lora")
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set wdt 0")
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set sync 12")
-        if not r:
-            return False
-        crc = "off"
-        if self.config_rx["crcOn"] == 1:
-            crc = "on"
-        r, data = self._send_cmd("radio set crc "+crc)
-        if not r:
-            return False
-
-        bandwidth = "125"
-        if self.config_rx["bandwidth"] == 0:
-            bandwidth = "125"
-        elif self.config_rx["bandwidth"] == 1:
-            bandwidth = "250"
-        elif self.config_rx["bandwidth"] == 2:
-            bandwidth = "500"
-        # 0:125kHz, 1:250kHz, 2:500kHz
-        r, data = self._send_cmd("radio set bw "+bandwidth)
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set rxbw "+bandwidth)
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set sf sf"+str(self.config_rx["datarate"]))
-        if not r:
-            return False
-
-        coderate = "4/5" # 1:4/5, 2:4/6, 3:4/7, 4:4/8
-        if self.config_rx["coderate"] == 1:
-            coderate = "4/5"
-        elif self.config_rx["coderate"] == 2:
-            coderate = "4/6"
-        elif self.config_rx["coderate"] == 3:
-            coderate = "4/7"
-        elif self.config_rx["coderate"] == 4:
-            coderate = "4/8"
-        r, data = self._send_cmd("radio set cr "+coderate)
-
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set freq "+str(self.config_rx["channel"]))
-        if not r:
-            return False
-
-
-        r, data = self._send_cmd("radio set prlen "+str(self.config_rx["preambleLen"]))
-        if not r:
-            return False
-        r, data = self._send_cmd("radio set pwr "+str(self.config_tx["power"]))
-        if not r:
-            return False
+        # set mode LoraP2P and radio configuration
+        for cmd in lostick_radio_cmds(self.config_rx, self.config_tx):
+            r, data = self._send_cmd(cmd)
+            if not r:
+                return False
 
         return True
 
@@ -876,38 +1213,15 @@ class LoStick(CommSerialDev):
 
     """
     Get LoRa received frame
+    Board leaves receive mode after each received frame/error => put it back in receive mode
     """
-    def recv_radio_frame(self):
-
-        self._recv_radio_frame_lock.acquire()
-        data = self._recv_serial()
-        self._recv_radio_frame_lock.release()
-
-        data = data.decode("utf8")
-        if len(data) == 0:
+    def recv_radio_frame(self, timeout=None):
+        data = self._get_rx_item(timeout)
+        if data is None:
             return b""
 
-
         self.set_rx_mode()
 
-
-        re_at = "^radio_rx  ([0-9A-F]+)"
-        if re.match(re_at, data) is None:
-            # print not a recv frame
-            self.log.debug("%s:recv_radio_frame:Unexpected command recv: %s" % (self._name, data))
-            data = b""
-            return data
-
-
-        tmp = re.search(re_at, data)
-        data = tmp.group(1)
-
-        try:
-            data = bytes.fromhex(data)
-        except Exception as e:
-            self.log.warn("%s:recv_radio_frame:Data recv is not a HEX string: %s" % (self._name, data))
-            data = b""
-
         return data
 
 
@@ -0,0 +1,219 @@
+import collections
+import threading
+import time
+
+
+# (s) sliding window of duty cycle (ETSI EN 300 220: 1 hour)
+DUTY_CYCLE_WINDOW = 3600.0
+
+# part of budget only the highest traffic class can use
+BUDGET_RESERVE = 0.2
+
+# (s) max wait of a transmission for budget (longer: transmission is rejected)
+BUDGET_MAX_WAIT = 10.0
+
+"""
+EU868 sub-bands: (name, low frequency (Hz), high frequency (Hz), duty cycle)
+"""
+EU868_SUB_BANDS = [
+    ("g0", 863000000, 865000000, 0.001),
+    ("g", 865000000, 868000000, 0.01),
+    ("g1", 868000000, 868600000, 0.01),
+    ("g2", 868700000, 869200000, 0.001),
+    ("g3", 869400000, 869650000, 0.1),
+    ("g4", 869700000, 870000000, 0.01),
+]
+
+SUB_BANDS = {
+    "eu868": EU868_SUB_BANDS,
+}
+
+
+
+
+"""
+Get sub-bands of duty cycle configuration
+dutyCycle: name of sub-bands table ("eu868") or one duty cycle (0.01: 1%) for all channels
+"""
+def sub_bands(dutyCycle):
+    if isinstance(dutyCycle, str):
+        if dutyCycle not in SUB_BANDS:
+            raise ValueError("Unknown duty cycle sub-bands: %s" % dutyCycle)
+        return SUB_BANDS[dutyCycle]
+    if not 0 < dutyCycle <= 1:
+        raise ValueError("Invalid duty cycle: %s" % dutyCycle)
+    return [("all", 0, 0xffffffff, dutyCycle)]
+
+
+
+
+class _SubBand():
+    __slots__ = ("name", "dutyCycle", "used", "history")
+
+    def __init__(self, name, dutyCycle):
+        self.name = name
+        self.dutyCycle = dutyCycle
+        self.used = 0.0                         # airtime (s) in window
+        self.history = collections.deque()      # (start time, airtime, channel)
+
+
+
+
+"""
+Airtime accountant: airtime used in a sliding window per sub-band (limit) and
+per channel (stats)
+Budget of a sub-band is dutyCycle * window. Traffic classes other than the highest
+(class 0) only use budget - reserve: priority traffic has first claim on the
+remaining budget.
+Shared by gateway TX path (scheduler) and device keepalive: methods are thread safe.
+"""
+class AirtimeBudget():
+    def __init__(self, subBands=EU868_SUB_BANDS, window=DUTY_CYCLE_WINDOW, reserve=BUDGET_RESERVE):
+        if window <= 0 or not 0 <= reserve < 1:
+            raise ValueError("Invalid airtime budget parameters")
+        self._window = window
+        self._reserve = reserve
+        self._subBands = [(low, high, _SubBand(name, dutyCycle)) for name, low, high, dutyCycle in subBands]
+        self._channels = {}     # channel => _SubBand
+        self._lock = threading.Lock()
+
+        self.nb_delayed = 0
+        self.nb_rejected = 0
+
+
+    def _band(self, channel):
+        band = self._channels.get(channel)
+        if band is not None:
+            return band
+        for low, high, band in self._subBands:
+            if low <= channel < high:
+                self._channels[channel] = band
+                return band
+        raise ValueError("Channel %d Hz is not in a duty cycle sub-band" % channel)
+
+
+    def _expire(self, band, now):
+        start = now - self._window
+        while len(band.history) > 0 and band.history[0][0] <= start:
+            band.used -= band.history.popleft()[1]
+        if len(band.history) == 0:
+            band.used = 0.0
+
+
+    """
+    Budget (s of airtime in window) of traffic class on channel
+    """
+    def limit(self, channel, cls=0):
+        with self._lock:
+            return self._limit(self._band(channel), cls)
+
+
+    def _limit(self, band, cls):
+        limit = band.dutyCycle * self._window
+        if cls > 0:
+            limit *= 1 - self._reserve
+        return limit
+
+
+    """
+    Time (s) before airtime can be sent on channel by traffic class
+    0: now, None: never (airtime is larger than budget)
+    """
+    def delay(self, channel, airtime, cls=0, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            return self._delay(self._band(channel), airtime, cls, now)
+
+
+    def _delay(self, band, airtime, cls, now):
+        self._expire(band, now)
+        limit = self._limit(band, cls)
+        excess = band.used + airtime - limit
+        if excess <= 0:
+            return 0
+        if airtime > limit:
+            return None
+        # oldest transmissions leave window first (reservations may start later than
+        # next transmissions: airtime is freed when all transmissions before left)
+        freed = 0.0
+        latest = 0.0
+        for t, a, c in band.history:
+            freed += a
+            latest = max(latest, t)
+            if freed >= excess:
+                return latest + self._window - now
+        return None
+
+
+    """
+    Reserve airtime on channel for traffic class: budget is checked and airtime is
+    accounted at once (at now + delay, when it is sent), no other transmission can
+    use it meanwhile
+    Return delay (s) before sending (counted as delayed), None if it can not be sent
+    within maxWait (counted as rejected, nothing is accounted)
+    """
+    def reserve(self, channel, airtime, cls=0, maxWait=BUDGET_MAX_WAIT, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            band = self._band(channel)
+            delay = self._delay(band, airtime, cls, now)
+            if delay is None or delay > maxWait:
+                self.nb_rejected += 1
+                return None
+            if delay > 0:
+                self.nb_delayed += 1
+            self._charge(band, channel, airtime, now + delay)
+            return delay
+
+
+    """
+    Account transmission of airtime (s) on channel
+    """
+    def charge(self, channel, airtime, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._charge(self._band(channel), channel, airtime, now)
+
+
+    def _charge(self, band, channel, airtime, now):
+        band.history.append((now, airtime, channel))
+        band.used += airtime
+
+
+    """
+    Account airtime if it can be sent now (lowest priority), return False otherwise
+    """
+    def try_charge(self, channel, airtime, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            band = self._band(channel)
+            if self._delay(band, airtime, 1, now) != 0:
+                return False
+            self._charge(band, channel, airtime, now)
+            return True
+
+
+    def get_stats(self):
+        now = time.monotonic()
+        stats = {
+            "budget_delayed": self.nb_delayed,
+            "budget_rejected": self.nb_rejected,
+        }
+        channels = {}
+        with self._lock:
+            for low, high, band in self._subBands:
+                # sub-bands of used channels only
+                if band not in self._channels.values():
+                    continue
+                self._expire(band, now)
+                stats["budget_" + band.name + "_used_s"] = round(band.used, 3)
+                stats["budget_" + band.name + "_used_pct"] = round(100 * band.used / self._limit(band, 0), 1)
+                for t, a, c in band.history:
+                    channels[c] = channels.get(c, 0.0) + a
+        for c, used in channels.items():
+            stats["budget_ch%d_used_s" % c] = round(used, 3)
+        return stats
@@ -0,0 +1,177 @@
+import struct
+import time
+
+import crc16
+
+from libLora import libFrameBuf
+
+
+# flag of envelope (high nibble of addr/flags byte): frame is a fragment of a packet
+FLAG_FRAGMENT = 2
+
+# fragment header: src LoRa address, packet id, index (7 bits) | last flag
+FRAG_HDR_SZ = 3
+FRAG_LAST = 0x80
+FRAG_MAX_INDEX = 0x7f
+
+# len (2) + addr/flags (1) + fragment header + crc (2)
+FRAG_OVERHEAD = 2 + 1 + FRAG_HDR_SZ + 2
+
+# v2 frames: + header check (1)
+FRAG_OVERHEAD_V2 = FRAG_OVERHEAD + 1
+
+# (s) max time between two fragments of a packet
+REASSEMBLY_TIMEOUT = 10.0
+
+
+
+
+"""
+Cut envelope in fragment frames of maxFrameSz bytes max
+envelope: len (2) | addr/flags (1) | [header check (1)] | data | [crc (2)]
+Each fragment is a complete frame with its own crc over on air bytes:
+    len (2) | addr/flags + FLAG_FRAGMENT (1) | src (1) | pkt id (1) | index/last (1) | chunk | crc (2)
+v2 fragments (of v2 envelope) have the v2 length flag, a header check after
+addr/flags and their crc covers length too.
+Envelope after addr/flags (and header check) is the payload cut in chunks (flags of
+envelope are kept).
+bCrc: False if radio checks crc (fragments have no crc)
+"""
+def build_fragments(envelope, src, pkt_id, maxFrameSz, bCrc=True):
+    v2 = struct.unpack_from("H", envelope)[0] & libFrameBuf.FRAME_V2
+    chunkSz = maxFrameSz - FRAG_OVERHEAD
+    hdrSz = libFrameBuf.FRAME_HDR_SZ
+    if v2:
+        chunkSz = maxFrameSz - FRAG_OVERHEAD_V2
+        hdrSz += 1
+    if not bCrc:
+        chunkSz += 2
+    if chunkSz < 1:
+        raise ValueError("LoRa frame too small for fragments")
+
+    addr_flags = envelope[2] | (FLAG_FRAGMENT << 4)
+    payload = memoryview(envelope)[hdrSz:]
+    nb = (len(payload) + chunkSz - 1) // chunkSz
+    if nb > FRAG_MAX_INDEX + 1:
+        return []
+
+    frames = []
+    for i in range(nb):
+        chunk = payload[i * chunkSz:(i + 1) * chunkSz]
+        idx = i
+        if i == nb - 1:
+            idx |= FRAG_LAST
+        hdr = struct.pack("BBB", src & 0xf, pkt_id & 0xff, idx)
+        if v2:
+            head = struct.pack("HB", (len(chunk) + 5) | v2, addr_flags)
+            frame = head + bytes([libFrameBuf.header_check(head)]) + hdr + chunk
+            if bCrc:
+                frame += struct.pack("<H", crc16.crc16xmodem(frame))
+            frames.append(frame)
+        else:
+            body = bytes([addr_flags]) + hdr + chunk
+            frame = struct.pack("H", len(body)) + body
+            if bCrc:
+                frame += struct.pack("<H", crc16.crc16xmodem(body))
+            frames.append(frame)
+    return frames
+
+
+
+
+class _Pending():
+    __slots__ = ("pkt_id", "next_index", "chunks", "size", "t_last")
+
+    def __init__(self, pkt_id, now):
+        self.pkt_id = pkt_id
+        self.next_index = 0
+        self.chunks = []
+        self.size = 0
+        self.t_last = now
+
+
+
+
+"""
+Reassembly of fragmented packets
+Fragments of a packet are sent in order by one sender: one packet is pending per
+source LoRa address. A packet is dropped at once when a fragment is missing (gap
+in index or new packet id), so the next packet decodes cleanly.
+Memory is bounded: 16 sources, maxSz bytes per packet, timeout between fragments.
+"""
+class Reassembler():
+    def __init__(self, maxSz, timeout=REASSEMBLY_TIMEOUT):
+        self._maxSz = maxSz
+        self._timeout = timeout
+        self._pending = {}      # src => _Pending
+
+        self.nb_fragments = 0
+        self.nb_packets = 0
+        self.nb_dropped = 0     # incomplete packets
+        self.nb_orphans = 0     # fragments of a packet whose first fragment is lost
+        self.nb_duplicates = 0
+
+
+    def _drop(self, src):
+        del self._pending[src]
+        self.nb_dropped += 1
+
+
+    """
+    Add fragment
+    Return payload of packet when its last fragment is received, None otherwise
+    """
+    def add(self, src, pkt_id, idx_last, chunk, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.nb_fragments += 1
+        index = idx_last & FRAG_MAX_INDEX
+
+        # drop packets which will never be completed
+        for s in [s for s, p in self._pending.items() if now - p.t_last > self._timeout]:
+            self._drop(s)
+
+        p = self._pending.get(src)
+        if p is not None and p.pkt_id != pkt_id:
+            # packet of new id: end of previous packet is lost
+            self._drop(src)
+            p = None
+
+        if p is None:
+            if index != 0:
+                # first fragment(s) lost
+                self.nb_orphans += 1
+                return None
+            p = _Pending(pkt_id, now)
+            self._pending[src] = p
+        elif index < p.next_index:
+            self.nb_duplicates += 1
+            return None
+        elif index > p.next_index:
+            self._drop(src)
+            return None
+
+        p.chunks.append(bytes(chunk))
+        p.size += len(chunk)
+        p.next_index += 1
+        p.t_last = now
+        if p.size > self._maxSz:
+            self._drop(src)
+            return None
+
+        if idx_last & FRAG_LAST:
+            del self._pending[src]
+            self.nb_packets += 1
+            return b"".join(p.chunks)
+        return None
+
+
+    def get_stats(self):
+        return {
+            "frag_rx_fragments": self.nb_fragments,
+            "frag_rx_packets": self.nb_packets,
+            "frag_rx_dropped": self.nb_dropped,
+            "frag_rx_orphans": self.nb_orphans,
+            "frag_rx_duplicates": self.nb_duplicates,
+            "frag_rx_pending": len(self._pending),
+        }
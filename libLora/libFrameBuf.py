@@ -0,0 +1,175 @@
+import crc16
+
+
+
+"""
+Status returned by frame parser callback
+"""
+FRAME_OK = 0           # valid frame at offset (payload may be None if nothing to deliver)
+FRAME_BAD = 1          # no frame at offset => resync on next byte
+FRAME_NEED_MORE = 2    # frame header looks valid but frame is not complete yet
+
+
+"""
+Frame format version (bit 15 of length field)
+v1: len | addr/flags | data | crc16 (clear payload)
+v2: len | addr/flags | header check | data | crc16 (on air bytes, from len)
+    bad candidates are rejected by header check (O(1)) and crc before any decoding
+"""
+FRAME_V2 = 0x8000
+FRAME_SZ_MASK = 0x7fff
+
+# length (2) + addr/flags (1)
+FRAME_HDR_SZ = 3
+
+
+"""
+Check byte of v2 frame header (length and addr/flags bytes)
+"""
+def header_check(hdr):
+    return crc16.crc16xmodem(bytes(hdr)) & 0xff
+
+
+
+"""
+Envelope formats
+standard: 2 bytes length (v1/v2 frames)
+compact: varint length (1 byte up to 127 bytes, 2 bytes up to VARINT_MAX)
+compact_nolen: no length, devices giving radio frame boundaries only (RAK811, LoStick):
+    received radio frame is fed to receive buffer with its varint length
+"""
+ENVELOPE_STANDARD = "standard"
+ENVELOPE_COMPACT = "compact"
+ENVELOPE_COMPACT_NOLEN = "compact_nolen"
+
+VARINT_MAX = 0x3fff
+
+
+def encode_varint(n):
+    if n < 0x80:
+        return bytes([n])
+    return bytes([0x80 | (n & 0x7f), n >> 7])
+
+
+"""
+Decode varint length at offset
+Return (value, nb bytes): nb bytes is 0 if more bytes are needed, value is None if invalid
+"""
+def decode_varint(view, offset, end):
+    b = view[offset]
+    if not b & 0x80:
+        return b, 1
+    if end - offset < 2:
+        return 0, 0
+    b2 = view[offset + 1]
+    # 2 bytes max, shortest encoding only
+    if b2 & 0x80 or b2 == 0:
+        return None, 2
+    return (b & 0x7f) | (b2 << 7), 2
+
+
+
+
+"""
+Bounded receive buffer for LoRa stream
+Bytes received from radio device are appended in a bytearray.
+Scan is done in a single pass using a parser callback working on offsets of a
+memoryview (no copy of remaining data on each resync byte).
+
+parser(view, offset, end) must return (status, payload, frame_sz)
+    status: FRAME_OK, FRAME_BAD or FRAME_NEED_MORE
+    payload: decoded data or list of decoded data (only used on FRAME_OK, ignored if None)
+    frame_sz: number of bytes used by frame (only used on FRAME_OK)
+"""
+class RecvFrameBuffer():
+    def __init__(self, parser, maxSz=0x2000, minFrameSz=5):
+        if maxSz < minFrameSz:
+            raise ValueError("Invalid receive buffer size")
+
+        self._parser = parser
+        self._maxSz = maxSz
+        self._minFrameSz = minFrameSz
+        self._buf = bytearray()
+
+        self.nb_frames = 0
+        self.nb_garbage = 0      # bytes discarded while resync
+        self.nb_overflow = 0     # bytes discarded because buffer reached maxSz
+
+
+    def __len__(self):
+        return len(self._buf)
+
+
+    """
+    Append received data
+    Oldest bytes are discarded if buffer exceeds maxSz
+    """
+    def feed(self, data):
+        if len(data) == 0:
+            return
+
+        self._buf += data
+        excess = len(self._buf) - self._maxSz
+        if excess > 0:
+            # removing bytes at start of bytearray does not move remaining data
+            del self._buf[:excess]
+            self.nb_overflow += excess
+
+
+    """
+    Scan buffer and return list of all decoded payloads
+    Consumed frames and garbage bytes are removed from buffer.
+    Bytes from first incomplete frame candidate are kept for next call.
+    """
+    def pop_frames(self):
+        frames = []
+        end = len(self._buf)
+        i = 0
+        consumed = 0
+        pending = None
+
+        view = memoryview(self._buf)
+        try:
+            while end - i >= self._minFrameSz:
+                status, payload, frame_sz = self._parser(view, i, end)
+                if status == FRAME_OK:
+                    # bytes between previous frame and this frame are garbage
+                    self.nb_garbage += i - consumed
+                    self.nb_frames += 1
+                    if isinstance(payload, list):
+                        frames.extend(payload)
+                    elif payload is not None:
+                        frames.append(payload)
+                    i += frame_sz
+                    consumed = i
+                    pending = None
+                elif status == FRAME_NEED_MORE:
+                    if pending is None:
+                        pending = i
+                    i += 1
+                else:
+                    i += 1
+        finally:
+            view.release()
+
+        # Keep first incomplete candidate or unscanned tail
+        if pending is None:
+            pending = i
+        self.nb_garbage += pending - consumed
+        if pending > 0:
+            del self._buf[:pending]
+
+        return frames
+
+
+    def clear(self):
+        self._buf = bytearray()
+
+
+    def get_stats(self):
+        return {
+            "recv_buf_len": len(self._buf),
+            "recv_frames": self.nb_frames,
+            "recv_garbage_bytes": self.nb_garbage,
+            "recv_overflow_bytes": self.nb_overflow,
+        }
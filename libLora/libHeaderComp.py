@@ -0,0 +1,476 @@
+import collections
+import struct
+import time
+
+from libLora import libPacket
+
+
+"""
+Per flow IPv4/TCP/UDP header compression (built-in, no ROHC library)
+First nibble of compressed packets is never 4 (IPv4): compressed and plain packets
+are told apart by their first byte, plain packets are given unchanged.
+
+IR (full packet, (re)initializes context of flow):
+    0xF | src (1) | cid (1) | generation (1) | IPv4 packet
+IR-R (repeated context: reference headers of IR, then packet as CO body):
+    0xF | src (1) | cid (1) | 0x80 + generation (1) | reference headers | CO flags (1) | CO fields | payload
+CO (compressed headers):
+    0xE | src (1) | cid (1) | flags (1) | [tos, ttl (2)] | [ip frag (2)] | ip id delta (varint)
+    TCP: tcp flags (1) | seq delta (varint) | ack delta (varint) | [window (2)] | [urg ptr (2)]
+         | [timestamps deltas (2 varints) or options (len + bytes)] | checksum (2)
+    UDP: checksum (2)
+    then payload
+Deltas are relative to last IR of context (not to previous packet): a lost CO
+packet never damages next ones. Packets following an IR carry its headers
+(IR-R, optimistic repetition): any of them received initializes the same context.
+A lost context is detected by generation, context is refreshed every
+HC_REFRESH_PKTS packets or HC_REFRESH_TIME s. TCP/UDP checksum is
+sent verbatim and checked on rebuilt packet (damaged context => packet dropped).
+Static fields (addresses, ports, protocol, DF, ttl) are learnt from IR,
+lengths and IPv4 checksum are computed.
+"""
+HC_CO = 0xe
+HC_IR = 0xf
+
+# default max number of contexts of compressor (least recently used is replaced)
+HC_MAX_CONTEXTS = 64
+
+# context refresh (IR): every HC_REFRESH_PKTS packets or HC_REFRESH_TIME s
+HC_REFRESH_PKTS = 16
+HC_REFRESH_TIME = 10.0
+
+# packets sent with context (IR then IR-R) when a context is created or refreshed
+HC_IR_REPEAT = 3
+
+# generation byte of IR-R
+_IR_REPEAT = 0x80
+
+# larger deltas (retransmissions, long flows): context is refreshed
+HC_MAX_DELTA = 1 << 21
+
+# CO flags
+_F_GEN = 0xc0
+_F_TTL_TOS = 0x20
+_F_WINDOW = 0x10
+_F_OPT = 0x0c
+_F_OPT_TS = 0x04
+_F_OPT_RAW = 0x08
+_F_URG = 0x02
+_F_FRAG = 0x01
+
+# NOP NOP timestamps (TSval, TSecr)
+_TS_PREFIX = b"\x01\x01\x08\x0a"
+_TS_OPT = struct.Struct("!4sII")
+
+_IPV4_HDR = struct.Struct("!BBHHHBBHII")
+_TCP_HDR = struct.Struct("!HHIIBBHHH")
+_UDP_HDR = struct.Struct("!HHHH")
+_U16 = struct.Struct("!H")
+
+
+
+
+def _put_uvarint(out, n):
+    while n >= 0x80:
+        out.append(0x80 | (n & 0x7f))
+        n >>= 7
+    out.append(n)
+
+
+def _get_uvarint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, i
+        shift += 7
+        if shift > 28:
+            raise ValueError("Invalid varint")
+
+
+
+
+"""
+Header fields of a compressible packet (IPv4 without options, not fragmented, TCP or UDP)
+"""
+class _Headers():
+    __slots__ = ("ip", "tcp", "udp", "opts", "ts", "l4_end")
+
+    def __init__(self, ip, tcp, udp):
+        self.ip = ip
+        self.tcp = tcp
+        self.udp = udp
+        self.opts = b""
+        self.ts = None
+        self.l4_end = ip.hdr_len + 8
+        if tcp is not None:
+            self.l4_end = ip.hdr_len + tcp.hdr_len
+            self.opts = bytes(ip.buf[ip.hdr_len + 20:self.l4_end])
+            if len(self.opts) == 12 and self.opts.startswith(_TS_PREFIX):
+                self.ts = _TS_OPT.unpack(self.opts)[1:]
+
+
+"""
+Return _Headers of packet, None if packet is sent as is
+"""
+def _parse(data):
+    ip = libPacket.parse_ipv4(data)
+    if ip is None or ip.hdr_len != 20 or ip.total_len != len(data) or ip.frag & 0x3fff:
+        return None
+    tcp = libPacket.parse_tcp(ip)
+    if tcp is not None:
+        # reserved bits / NS flag are not compressed
+        if data[ip.hdr_len + 12] & 0x0f:
+            return None
+        return _Headers(ip, tcp, None)
+    udp = libPacket.parse_udp(ip)
+    if udp is None or udp.length != ip.total_len - ip.hdr_len:
+        return None
+    return _Headers(ip, None, udp)
+
+
+
+
+class _Context():
+    __slots__ = ("cid", "gen", "ref", "ref_hdr", "static", "count", "repeat", "t_refresh")
+
+    def __init__(self, cid, gen):
+        self.cid = cid
+        self.gen = gen
+        self.ref = None         # _Headers of last IR
+        self.ref_hdr = None     # headers of last IR (sent in IR-R)
+        self.static = None      # bytes never sent in CO
+        self.count = 0
+        self.repeat = 0         # next packets sent in IR-R
+        self.t_refresh = 0
+
+
+"""
+Reference headers sent in IR-R: headers of IR packet, lengths without payload
+"""
+def _ref_headers(h, data):
+    hdr = bytearray(data[:h.l4_end])
+    _U16.pack_into(hdr, 2, len(hdr))
+    if h.udp is not None:
+        _U16.pack_into(hdr, h.ip.hdr_len + 4, 8)
+    return bytes(hdr)
+
+
+"""
+Fields a CO packet can not carry: a change needs an IR
+"""
+def _static(h):
+    ip = h.ip
+    if h.tcp is not None:
+        return (ip.proto, ip.src, ip.dst, h.tcp.sport, h.tcp.dport)
+    return (ip.proto, ip.src, ip.dst, h.udp.sport, h.udp.dport)
+
+
+
+
+"""
+Header compressor of a gateway (src: LoRa address of gateway)
+Contexts are keyed by flow 5-tuple. Not thread safe: packets must be
+compressed by one thread, in the order they are sent.
+"""
+class HeaderCompressor():
+    def __init__(self, src, maxContexts=HC_MAX_CONTEXTS, refreshPkts=HC_REFRESH_PKTS,
+                 refreshTime=HC_REFRESH_TIME, irRepeat=HC_IR_REPEAT):
+        if maxContexts < 1 or maxContexts > 0x100 or refreshPkts < 1 or irRepeat < 1:
+            raise ValueError("Invalid header compression parameters")
+        self._src = src & 0xf
+        self._maxContexts = maxContexts
+        self._refreshPkts = refreshPkts
+        self._refreshTime = refreshTime
+        self._irRepeat = irRepeat
+        self._contexts = collections.OrderedDict()  # flow => _Context (LRU order)
+        self._gens = [0] * maxContexts              # last generation of each cid
+
+        self.nb_ir = 0
+        self.nb_co = 0
+        self.nb_plain = 0
+        self.nb_bytes_in = 0
+        self.nb_bytes_out = 0
+
+
+    def _context(self, flow):
+        ctx = self._contexts.get(flow)
+        if ctx is not None:
+            self._contexts.move_to_end(flow)
+            return ctx
+        if len(self._contexts) < self._maxContexts:
+            cid = len(self._contexts)
+        else:
+            cid = self._contexts.popitem(last=False)[1].cid
+        ctx = _Context(cid, self._gens[cid])
+        self._contexts[flow] = ctx
+        return ctx
+
+
+    """
+    Compress headers of IPv4 packet
+    Return compressed packet or packet itself (not compressible)
+    """
+    def compress(self, data, now=None):
+        h = _parse(data)
+        if h is None or libPacket.ones_complement_sum(memoryview(data)[:20]) != 0:
+            # IPv4 checksum must be valid: receiver computes it
+            self.nb_plain += 1
+            return data
+        if now is None:
+            now = time.monotonic()
+
+        ctx = self._context(libPacket.flow_key(h.ip))
+        out = None
+        if (ctx.ref is not None and ctx.count < self._refreshPkts and now - ctx.t_refresh < self._refreshTime
+                and ctx.static == _static(h)):
+            out = self._compress_co(ctx, h, data)
+
+        if out is None:
+            ctx.gen = (self._gens[ctx.cid] + 1) & 3
+            self._gens[ctx.cid] = ctx.gen
+            ctx.ref = h
+            ctx.ref_hdr = _ref_headers(h, data)
+            ctx.static = _static(h)
+            ctx.count = 0
+            ctx.repeat = self._irRepeat - 1
+            ctx.t_refresh = now
+            out = bytes([(HC_IR << 4) | self._src, ctx.cid, ctx.gen]) + bytes(data)
+            self.nb_ir += 1
+        elif ctx.repeat > 0:
+            # receiver may have lost IR: context goes with packet
+            ctx.repeat -= 1
+            ctx.count += 1
+            out = bytes([(HC_IR << 4) | self._src, ctx.cid, _IR_REPEAT | ctx.gen]) + ctx.ref_hdr + out[2:]
+            self.nb_ir += 1
+        else:
+            ctx.count += 1
+            self.nb_co += 1
+
+        self.nb_bytes_in += len(data)
+        self.nb_bytes_out += len(out)
+        return out
+
+
+    """
+    Packet compressed last is not sent (dropped before radio): next packet of its
+    flow is sent in an IR
+    """
+    def reset(self, data):
+        h = _parse(data)
+        if h is None:
+            return
+        ctx = self._contexts.get(libPacket.flow_key(h.ip))
+        if ctx is not None:
+            ctx.ref = None
+
+
+    """
+    Build CO packet, None if packet needs an IR
+    """
+    def _compress_co(self, ctx, h, data):
+        ref = ctx.ref
+        ip = h.ip
+        flags = ctx.gen << 6
+        fields = bytearray()
+
+        if ip.tos != ref.ip.tos or ip.ttl != ref.ip.ttl:
+            flags |= _F_TTL_TOS
+            fields += bytes((ip.tos, ip.ttl))
+        if ip.frag != ref.ip.frag:
+            flags |= _F_FRAG
+            fields += _U16.pack(ip.frag)
+        _put_uvarint(fields, (ip.ident - ref.ip.ident) & 0xffff)
+
+        tcp = h.tcp
+        if tcp is not None:
+            d_seq = (tcp.seq - ref.tcp.seq) & 0xffffffff
+            d_ack = (tcp.ack - ref.tcp.ack) & 0xffffffff
+            if d_seq >= HC_MAX_DELTA or d_ack >= HC_MAX_DELTA:
+                return None
+            fields.append(tcp.flags)
+            _put_uvarint(fields, d_seq)
+            _put_uvarint(fields, d_ack)
+            if tcp.window != ref.tcp.window:
+                flags |= _F_WINDOW
+                fields += _U16.pack(tcp.window)
+            if tcp.urg_ptr != 0:
+                flags |= _F_URG
+                fields += _U16.pack(tcp.urg_ptr)
+            if h.opts != ref.opts:
+                if h.ts is not None and ref.ts is not None:
+                    d_val = (h.ts[0] - ref.ts[0]) & 0xffffffff
+                    d_ecr = (h.ts[1] - ref.ts[1]) & 0xffffffff
+                    if d_val >= HC_MAX_DELTA or d_ecr >= HC_MAX_DELTA:
+                        return None
+                    flags |= _F_OPT_TS
+                    _put_uvarint(fields, d_val)
+                    _put_uvarint(fields, d_ecr)
+                else:
+                    flags |= _F_OPT_RAW
+                    fields.append(len(h.opts))
+                    fields += h.opts
+            fields += _U16.pack(tcp.chksum)
+        else:
+            fields += _U16.pack(h.udp.chksum)
+
+        return bytes([(HC_CO << 4) | self._src, ctx.cid, flags]) + fields + bytes(data[h.l4_end:])
+
+
+    def get_stats(self):
+        return {
+            "hc_tx_ir": self.nb_ir,
+            "hc_tx_co": self.nb_co,
+            "hc_tx_plain": self.nb_plain,
+            "hc_tx_bytes_in": self.nb_bytes_in,
+            "hc_tx_bytes_out": self.nb_bytes_out,
+            "hc_tx_contexts": len(self._contexts),
+        }
+
+
+
+
+"""
+Header decompressor (contexts of all sources)
+Plain IPv4 packets are returned unchanged.
+"""
+class HeaderDecompressor():
+    def __init__(self):
+        self._contexts = {}     # (src, cid) => (generation, _Headers of IR)
+
+        self.nb_ir = 0
+        self.nb_co = 0
+        self.nb_no_context = 0
+        self.nb_bad_checksum = 0
+
+
+    """
+    Rebuild IPv4 packet
+    Raise ValueError if packet can not be rebuilt
+    """
+    def decompress(self, data):
+        if len(data) == 0 or data[0] >> 4 not in (HC_IR, HC_CO):
+            return data
+        if len(data) < 3:
+            raise ValueError("Truncated compressed header")
+        key = (data[0] & 0xf, data[1])
+
+        if data[0] >> 4 == HC_IR:
+            if data[2] & _IR_REPEAT:
+                return self._decompress_ir_repeat(key, data)
+            pkt = bytes(data[3:])
+            h = _parse(pkt)
+            if h is None:
+                raise ValueError("Invalid IR packet")
+            self._contexts[key] = (data[2], h)
+            self.nb_ir += 1
+            return pkt
+
+        ctx = self._contexts.get(key)
+        flags = data[2]
+        if ctx is None or ctx[0] != flags >> 6:
+            # IR of context lost: wait for refresh
+            self.nb_no_context += 1
+            raise ValueError("No header compression context")
+        try:
+            pkt = self._decompress_co(ctx[1], flags, data)
+        except (IndexError, struct.error):
+            raise ValueError("Truncated compressed header")
+        self.nb_co += 1
+        return pkt
+
+
+    """
+    IR-R: (re)initialize context from reference headers, then rebuild CO body
+    """
+    def _decompress_ir_repeat(self, key, data):
+        if len(data) < 3 + 20:
+            raise ValueError("Truncated compressed header")
+        end = 3 + _U16.unpack_from(data, 5)[0]
+        h = _parse(bytes(data[3:end]))
+        if h is None or end >= len(data):
+            raise ValueError("Invalid IR packet")
+        gen = data[2] & 3
+        self._contexts[key] = (gen, h)
+        try:
+            pkt = self._decompress_co(h, data[end], data, end + 1)
+        except (IndexError, struct.error):
+            raise ValueError("Truncated compressed header")
+        self.nb_ir += 1
+        return pkt
+
+
+    """
+    Rebuild packet from CO fields at offset i (flags already read)
+    """
+    def _decompress_co(self, ref, flags, data, i=3):
+        tos, ttl = ref.ip.tos, ref.ip.ttl
+        if flags & _F_TTL_TOS:
+            tos, ttl = data[i], data[i + 1]
+            i += 2
+        frag = ref.ip.frag
+        if flags & _F_FRAG:
+            frag = _U16.unpack_from(data, i)[0]
+            i += 2
+        d_ident, i = _get_uvarint(data, i)
+
+        if ref.tcp is not None:
+            tcp_flags = data[i]
+            d_seq, i = _get_uvarint(data, i + 1)
+            d_ack, i = _get_uvarint(data, i)
+            window = ref.tcp.window
+            if flags & _F_WINDOW:
+                window = _U16.unpack_from(data, i)[0]
+                i += 2
+            urg_ptr = 0
+            if flags & _F_URG:
+                urg_ptr = _U16.unpack_from(data, i)[0]
+                i += 2
+            opts = ref.opts
+            if flags & _F_OPT == _F_OPT_TS:
+                if ref.ts is None:
+                    raise ValueError("No timestamps in context")
+                d_val, i = _get_uvarint(data, i)
+                d_ecr, i = _get_uvarint(data, i)
+                opts = _TS_OPT.pack(_TS_PREFIX, (ref.ts[0] + d_val) & 0xffffffff, (ref.ts[1] + d_ecr) & 0xffffffff)
+            elif flags & _F_OPT == _F_OPT_RAW:
+                opts = bytes(data[i + 1:i + 1 + data[i]])
+                i += 1 + data[i]
+            chksum = _U16.unpack_from(data, i)[0]
+            i += 2
+            l4 = _TCP_HDR.pack(ref.tcp.sport, ref.tcp.dport, (ref.tcp.seq + d_seq) & 0xffffffff,
+                               (ref.tcp.ack + d_ack) & 0xffffffff, (20 + len(opts)) << 2, tcp_flags,
+                               window, chksum, urg_ptr) + opts
+        else:
+            chksum = _U16.unpack_from(data, i)[0]
+            i += 2
+            l4 = _UDP_HDR.pack(ref.udp.sport, ref.udp.dport, 8 + len(data) - i, chksum)
+
+        if i > len(data):
+            raise ValueError("Truncated compressed header")
+        total_len = 20 + len(l4) + len(data) - i
+        hdr = bytearray(_IPV4_HDR.pack(0x45, tos, total_len, (ref.ip.ident + d_ident) & 0xffff, frag, ttl,
+                                       ref.ip.proto, 0, ref.ip.src, ref.ip.dst))
+        _U16.pack_into(hdr, 10, libPacket.fold_checksum(libPacket.ones_complement_sum(hdr)))
+        pkt = bytes(hdr) + l4 + bytes(data[i:])
+
+        # verbatim checksum checks rebuilt packet (UDP: 0 is no checksum)
+        if ref.tcp is not None or chksum != 0:
+            ip = libPacket.parse_ipv4(pkt)
+            if ip is None or libPacket.ones_complement_sum(ip.l4_view(), ip.pseudo_hdr_sum()) != 0:
+                self.nb_bad_checksum += 1
+                raise ValueError("Bad checksum of rebuilt packet")
+        return pkt
+
+
+    def get_stats(self):
+        return {
+            "hc_rx_ir": self.nb_ir,
+            "hc_rx_co": self.nb_co,
+            "hc_rx_no_context": self.nb_no_context,
+            "hc_rx_bad_checksum": self.nb_bad_checksum,
+            "hc_rx_contexts": len(self._contexts),
+        }
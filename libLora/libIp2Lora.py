@@ -1,75 +1,178 @@
 
 import ipaddress
 import crc16
-from scapy.all import *
-import socket
+import threading
+import os
+import time
+import select
 import netfilterqueue
 import struct
 
 from libUtils import libUtils
+from libLora import libAirtime
+from libLora import libFrameBuf
+from libLora import libPacket
+from libLora import libRawSocket
+from libLora import libRoute
+from libLora import libTxQueue
+from libLora import libClassifier
+from libLora import libFragment
+from libLora import libAggregate
+from libLora import libAckFilter
+from libLora import libPep
+from libLora import libCompress
+from libLora import libHeaderComp
+from libLora import libDutyCycle
 
 
 
 
 MAC_PREFIX = "10:2a:10:2a:10:00"
 
-# force scapy to send to real eth interface
-conf.L3socket = L3RawSocket
+# max bytes added by compression/cipher/header compression to an IP frame of mtu size
+ENVELOPE_MAX_OVERHEAD = 64
+
+# len (2) + addr/flags (1) + crc (2)
+ENVELOPE_OVERHEAD = 5
+
+# default max size of received LoRa data buffer
+RECV_BUF_SZ = 0x2000
+
+# default max number of packets waiting in kernel NFQUEUE
+NFQUEUE_MAX_LEN = 1024
+
+# max wait (s) of radio frames in main loop (stop latency)
+RECV_RADIO_TIMEOUT = 0.2
 
 
 
 
 """
 Use of NFQUEUE to get IP/LORA packet 
+Thread waits (epoll) on NFQUEUE socket and drains all queued packets on wake up.
+copy_range: max bytes of packet copied from kernel (dummy iface mtu)
+bypass: accept packets in kernel (fail-open) when no program is bound to queue
 """
 class RecvIpFromDummy(threading.Thread):
-    def __init__(self, callback_on_recv, iface="dummy0", log=None):
+    def __init__(self, callback_on_recv, iface="dummy0", log=None, copy_range=0xffff, max_len=NFQUEUE_MAX_LEN, bypass=True,
+                 callback_on_timer=None):
         threading.Thread.__init__(self)
         self._name = "RecvIpFromDummy"
         self._callback_on_recv = callback_on_recv
+        self._callback_on_timer = callback_on_timer
         self.log = log
         self._iface = iface
         self._queue_num = 4
+        self._copy_range = copy_range
+        self._max_len = max_len
+        self._bypass = bypass
         self._isRunning = False
+        self._q = None
+
+        # pipe used to wake up thread on stop
+        self._wake_r, self._wake_w = os.pipe()
+
+        self.nb_pkts = 0
+        self.nb_wakeups = 0
+        self.nb_errors = 0
+
 
+    def _nfqueue_target(self):
+        target = "NFQUEUE --queue-num " + str(self._queue_num)
+        if self._bypass:
+            target += " --queue-bypass"
+        return target
 
     def _add_netfilter_queue(self):
-        os.system("iptables -A OUTPUT -o "+self._iface+" -j NFQUEUE --queue-num "+str(self._queue_num))
-        os.system("iptables -A FORWARD -o " + self._iface + " -j NFQUEUE --queue-num " + str(self._queue_num))
+        os.system("iptables -A OUTPUT -o "+self._iface+" -j "+self._nfqueue_target())
+        os.system("iptables -A FORWARD -o " + self._iface + " -j " + self._nfqueue_target())
 
     def _del_netfilter_queue(self):
-        os.system("iptables -D OUTPUT -o "+self._iface+" -j NFQUEUE --queue-num "+str(self._queue_num))
-        os.system("iptables -D FORWARD -o " + self._iface + " -j NFQUEUE --queue-num " + str(self._queue_num))
+        os.system("iptables -D OUTPUT -o "+self._iface+" -j "+self._nfqueue_target())
+        os.system("iptables -D FORWARD -o " + self._iface + " -j " + self._nfqueue_target())
 
-    def run(self):
-        self.log.debug(self._name + ":Starting")
+
+    def _on_pkt(self, pkt):
+        self.nb_pkts += 1
+        try:
+            self._callback_on_recv(pkt)
+        except Exception as e:
+            self.nb_errors += 1
+            self.log.error("%s:Error on packet: %s" % (self._name, str(e)))
+            pkt.accept()
+
+
+    """
+    Add iptables rules and bind queue
+    Return fd to wait on
+    """
+    def open(self):
         self._add_netfilter_queue()
 
-        q = netfilterqueue.NetfilterQueue()
-        q.bind(self._queue_num, self._callback_on_recv)
-        q.run(block=0)
-        s = socket.fromfd(q.get_fd(), socket.AF_UNIX, socket.SOCK_STREAM)
-        s.setblocking(0)
+        self._q = netfilterqueue.NetfilterQueue()
+        self._q.bind(self._queue_num, self._on_pkt, max_len=self._max_len, range=self._copy_range)
+        return self._q.get_fd()
 
 
-        self._isRunning = True
-        while self._isRunning:
-            try:
-                q.run_socket(s)
-            except Exception as e:
-                #self.log.debug(e)
-                pass
+    """
+    Handle all packets already queued (non blocking)
+    """
+    def process(self):
+        self.nb_wakeups += 1
+        self._q.run(block=False)
+
+
+    def close(self):
+        self._q.unbind()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._del_netfilter_queue()
+
+
+    def run(self):
+        self.log.debug(self._name + ":Starting")
+        nfq_fd = self.open()
 
-            time.sleep(0.05)
+        poller = select.epoll()
+        poller.register(nfq_fd, select.EPOLLIN)
+        poller.register(self._wake_r, select.EPOLLIN)
 
-        s.close()
-        q.unbind()
+        self._isRunning = True
+        while self._isRunning:
+            for fd, event in poller.poll(self._timer_delay()):
+                if fd == nfq_fd:
+                    self.process()
+                else:
+                    os.read(self._wake_r, 64)
+
+        poller.close()
+        self.close()
         self.log.debug(self._name + ":End")
 
-        self._del_netfilter_queue()
+    """
+    Call timer callback (timers are handled by the thread which handles packets)
+    Return poll timeout (-1: no timer pending)
+    """
+    def _timer_delay(self):
+        if self._callback_on_timer is None:
+            return -1
+        delay = self._callback_on_timer()
+        if delay is None:
+            return -1
+        return delay
+
 
     def stop(self):
         self._isRunning = False
+        os.write(self._wake_w, b"s")
+
+
+    def get_stats(self):
+        return {
+            "nfqueue_pkts": self.nb_pkts,
+            "nfqueue_wakeups": self.nb_wakeups,
+            "nfqueue_errors": self.nb_errors,
+        }
 
 
 
@@ -79,9 +182,10 @@ class Ip2Lora(threading.Thread):
         threading.Thread.__init__(self)
         self.log = config["log"]
         self._name = config["name"]
+        self._debug = config["debug"]
         config["name"] = config["deviceClass"].__name__
 
-        self._t_dev = config["deviceClass"](config=config)
+        self._t_dev = self._create_device(config)
 
         self._ipAddress = config["ipAddress"]
         self._loraAddress = int(self._ipAddress.split(".")[-1])
@@ -92,6 +196,11 @@ class Ip2Lora(threading.Thread):
         self._ipNetHosts = ipIface.network.hosts()
         self.maxLoraFrameSz = config["maxLoraFrameSz"]
         self.mtu = config["mtu"]
+        self._configTx = config["configTx"]
+        # airtime of frames (shared model of TX configuration, see libAirtime)
+        self._airtime = None
+        if self._configTx is not None:
+            self._airtime = libAirtime.get_model(self._configTx)
 
         self._func_compress = None
         if "func_compress" in config:
@@ -105,6 +214,41 @@ class Ip2Lora(threading.Thread):
         self._func_uncipher = None
         if "func_uncipher" in config:
             self._func_uncipher = config["func_uncipher"]
+        # authenticated cipher: addr/flags byte is given as aad, ciphered envelopes have no crc
+        self._bAead = False
+        if "cipherAead" in config:
+            self._bAead = config["cipherAead"]
+
+        # format of sent frames (both versions are received, see libFrameBuf)
+        self._frameVersion = 1
+        if "frameVersion" in config:
+            self._frameVersion = config["frameVersion"]
+        if self._frameVersion not in (1, 2):
+            raise ValueError("Invalid frame version: %s" % self._frameVersion)
+        self.nb_rx_hdr_bad = 0
+        self.nb_rx_crc_bad = 0
+
+        # length field of envelope (see libFrameBuf): all gateways must use the same envelope
+        self._envelope = libFrameBuf.ENVELOPE_STANDARD
+        if "envelope" in config:
+            self._envelope = config["envelope"]
+        if self._envelope not in (libFrameBuf.ENVELOPE_STANDARD, libFrameBuf.ENVELOPE_COMPACT,
+                                  libFrameBuf.ENVELOPE_COMPACT_NOLEN):
+            raise ValueError("Invalid envelope: %s" % self._envelope)
+        if self._envelope != libFrameBuf.ENVELOPE_STANDARD and self._frameVersion != 1:
+            raise ValueError("Compact envelope needs frame version 1")
+        if self._envelope == libFrameBuf.ENVELOPE_COMPACT_NOLEN and not self._t_dev.FRAME_BOUNDARY:
+            raise ValueError("%s does not give radio frame boundaries: no compact_nolen envelope" % config["name"])
+
+        # radio checks crc (crcOn of radio config): frames have no software crc
+        self._bRadioCrc = False
+        if "radioCrc" in config:
+            self._bRadioCrc = config["radioCrc"]
+        if self._bRadioCrc and not self._t_dev.RADIO_CRC:
+            raise ValueError("Radio CRC can not be set on %s" % config["name"])
+        self._swCrcSz = 2
+        if self._bRadioCrc:
+            self._swCrcSz = 0
 
         #self._routeTable = config["routeTable"] # [[gw1, net1], [gw2, net2], ...]
 
@@ -112,49 +256,260 @@ class Ip2Lora(threading.Thread):
 
         self._isRunning = False
 
-        self._recvBuf = b""
-
-        self._t_recv_ip_from_dummy = RecvIpFromDummy(callback_on_recv=self._cbOnDummyRecvPkt, iface=self._iface, log=self.log)
+        self._maxEnvelopeSz = self.mtu + ENVELOPE_MAX_OVERHEAD
+        recvBufSz = RECV_BUF_SZ
+        if "recvBufSz" in config:
+            recvBufSz = config["recvBufSz"]
+        recvBufSz = max(recvBufSz, 2 * (self._maxEnvelopeSz + 4))
+        # len + addr/flags + 1 byte + crc
+        self._minFrameSz = 4 + self._swCrcSz
+        if self._envelope != libFrameBuf.ENVELOPE_STANDARD:
+            if self._maxEnvelopeSz > libFrameBuf.VARINT_MAX:
+                raise ValueError("mtu too large for compact envelope")
+            self._minFrameSz -= 1
+        self._recvBuf = libFrameBuf.RecvFrameBuffer(parser=self._unserialize, maxSz=recvBufSz,
+                                                    minFrameSz=self._minFrameSz)
+        self._reassembler = libFragment.Reassembler(maxSz=self._maxEnvelopeSz)
+
+        # streaming compression: deflate contexts per peer (see libCompress)
+        self._compressStream = None
+        self._decompressStream = None
+        if "compressStream" in config and config["compressStream"]:
+            epochLen = libCompress.EPOCH_LEN
+            if "compressEpochLen" in config:
+                epochLen = config["compressEpochLen"]
+            self._compressStream = libCompress.StreamCompressor(self._addrLora, epochLen=epochLen)
+            self._decompressStream = libCompress.StreamDecompressor(maxSz=self._maxEnvelopeSz)
+
+        # per packet compression with preset dictionaries (see libCompress)
+        # adaptive compression uses dictionaries as one of its codecs (see below)
+        self._dictCompressor = None
+        if "compressDicts" in config and "compressCodecs" not in config:
+            codec = libCompress.DICT_ZLIB
+            if "compressDictCodec" in config:
+                codec = config["compressDictCodec"]
+            self._dictCompressor = libCompress.DictCompressor(config["compressDicts"], codec=codec,
+                                                              maxSz=self._maxEnvelopeSz)
+            self._func_compress = self._dictCompressor.compress
+            self._func_decompress = self._dictCompressor.decompress
+
+        # adaptive compression: codec of each flow minimizes airtime + CPU time
+        self._codecSelector = None
+        if "compressCodecs" in config:
+            kw = {}
+            if "compressDicts" in config:
+                kw["dicts"] = config["compressDicts"]
+                if "compressDictCodec" in config:
+                    kw["dictCodec"] = config["compressDictCodec"]
+            self._codecSelector = libCompress.CodecSelector(config["compressCodecs"], airtime=self._envelope_airtime,
+                                                            overhead=ENVELOPE_OVERHEAD, maxSz=self._maxEnvelopeSz, **kw)
+            self._func_decompress = self._codecSelector.decompress
+
+        # envelopes larger than a LoRa frame are sent in fragments
+        self._fragPktId = 0
+        self.nb_frag_tx_packets = 0
+        self.nb_frag_tx_fragments = 0
+
+        self._injector = libRawSocket.RawInjector(log=self.log, name=self._name + ":RawInjector")
+        self._routeCache = libRoute.LoraRouteCache(iface=self._iface, mac2lora=self._getLoraAddrFromMac, log=self.log)
+
+        nfqueueMaxLen = NFQUEUE_MAX_LEN
+        if "nfqueueMaxLen" in config:
+            nfqueueMaxLen = config["nfqueueMaxLen"]
+        nfqueueBypass = True
+        if "nfqueueBypass" in config:
+            nfqueueBypass = config["nfqueueBypass"]
+        self._t_recv_ip_from_dummy = RecvIpFromDummy(callback_on_recv=self._cbOnDummyRecvPkt, iface=self._iface, log=self.log,
+                                                     copy_range=self.mtu, max_len=nfqueueMaxLen, bypass=nfqueueBypass,
+                                                     callback_on_timer=self._cbOnTimer)
+
+        # encoded envelopes wait here for radio (NFQUEUE callback never waits airtime)
+        txQueueLen = libTxQueue.TX_QUEUE_LEN
+        if "txQueueLen" in config:
+            txQueueLen = config["txQueueLen"]
+        txQueueDrop = libTxQueue.DROP_TAIL
+        if "txQueueDrop" in config:
+            txQueueDrop = config["txQueueDrop"]
+        txQueueDiscipline = libTxQueue.DISC_FQ_CODEL
+        if "txQueueDiscipline" in config:
+            txQueueDiscipline = config["txQueueDiscipline"]
+        codelTarget = libTxQueue.CODEL_TARGET
+        if "codelTarget" in config:
+            codelTarget = config["codelTarget"]
+        codelInterval = libTxQueue.CODEL_INTERVAL
+        if "codelInterval" in config:
+            codelInterval = config["codelInterval"]
+
+        # optional strict priority classes (rules of config are compiled by classifier)
+        self._classifier = None
+        if "txClasses" in config:
+            rules = []
+            if "txRules" in config:
+                rules = config["txRules"]
+            defaultClass = None
+            if "txDefaultClass" in config:
+                defaultClass = config["txDefaultClass"]
+            self._classifier = libClassifier.Classifier([c["name"] for c in config["txClasses"]], rules, defaultClass)
+            self._txQueue = libTxQueue.create_priority_tx_queue(config["txClasses"], discipline=txQueueDiscipline,
+                                                                maxLen=txQueueLen, dropPolicy=txQueueDrop,
+                                                                target=codelTarget, interval=codelInterval,
+                                                                quantum=self.maxLoraFrameSz)
+        else:
+            self._txQueue = libTxQueue.create_tx_queue(discipline=txQueueDiscipline, maxLen=txQueueLen,
+                                                       dropPolicy=txQueueDrop, target=codelTarget,
+                                                       interval=codelInterval, quantum=self.maxLoraFrameSz)
+        self._t_tx_scheduler = libTxQueue.TxScheduler(txQueue=self._txQueue, send_func=self._send_radio,
+                                                      log=self.log, name=self._name + ":TxScheduler")
+
+        # duty cycle: airtime budget of sub-band of TX channel (see libDutyCycle)
+        # queued data waits until budget of its class allows a LoRa frame, envelopes are
+        # then checked with their exact airtime. Keepalive of device uses the same budget.
+        self._budget = None
+        if "dutyCycle" in config:
+            if self._airtime is None:
+                raise ValueError("Duty cycle needs TX configuration")
+            reserve = libDutyCycle.BUDGET_RESERVE
+            if "dutyCycleReserve" in config:
+                reserve = config["dutyCycleReserve"]
+            self._budgetMaxWait = libDutyCycle.BUDGET_MAX_WAIT
+            if "dutyCycleMaxWait" in config:
+                self._budgetMaxWait = config["dutyCycleMaxWait"]
+            self._budget = libDutyCycle.AirtimeBudget(libDutyCycle.sub_bands(config["dutyCycle"]), reserve=reserve)
+            self._txChannel = self._configTx["channel"]
+            self._budgetFrameAirtime = self._airtime.airtime(self.maxLoraFrameSz)
+            if self._budgetFrameAirtime > self._budget.limit(self._txChannel, cls=1):
+                raise ValueError("Duty cycle budget is smaller than a LoRa frame")
+            self._txQueue.set_gate(self._budget_gate)
+            self._t_dev.budget = self._budget
 
 
         self.bUseRohc = config["rohc_compression"]
+        self._libRohc = None
         if self.bUseRohc:
             from libLora import libRohc
 
+            self._libRohc = libRohc
             self.rohc_comp = libRohc.compressor()
             self.rohc_decomp = libRohc.decompressor()
 
+        # built-in header compression (see libHeaderComp): compressed headers are always decoded
+        self._hdrCompressor = None
+        self._hdrDecompressor = None
+        if not self.bUseRohc:
+            self._hdrDecompressor = libHeaderComp.HeaderDecompressor()
+        if "headerCompression" in config and config["headerCompression"]:
+            if self.bUseRohc:
+                raise ValueError("ROHC and header compression can not be used together")
+            self._hdrCompressor = libHeaderComp.HeaderCompressor(self._addrLora)
+
+        # stateful compression (streaming, header contexts) is done when envelope is sent:
+        # envelopes dropped or superseded in TX queue never desync receiver (see _radio_frames)
+        self._bEncodeOnSend = self._compressStream is not None or self._hdrCompressor is not None
+
+        # queued pure TCP ACKs are replaced by newer ACKs of their flow
+        self._ackFilter = None
+        if "ackThinning" in config and config["ackThinning"]:
+            self._ackFilter = libAckFilter.AckFilter()
+
+        # small packets to the same LoRa destination share one envelope
+        # (ROHC works on single packets: no aggregation)
+        self._aggregator = None
+        if "aggregateHold" in config and config["aggregateHold"] > 0:
+            if self.bUseRohc:
+                self.log.warning("%s: aggregation is disabled with ROHC compression" % self._name)
+            else:
+                self._aggregator = libAggregate.Aggregator(maxSz=self.maxLoraFrameSz - ENVELOPE_OVERHEAD,
+                                                           hold=config["aggregateHold"])
+
+        # optional split-TCP PEP: TCP connections to LoRa networks are terminated here
+        self._t_pep = None
+        if "pep" in config and config["pep"]:
+            if "pepNetworks" not in config or len(config["pepNetworks"]) == 0:
+                raise ValueError("PEP needs networks to intercept (pep_networks)")
+            # relay message (IP/UDP/relay headers + destination) fits in mtu
+            self._t_pep = libPep.TcpPep(ipAddress=self._ipAddress, networks=config["pepNetworks"],
+                                        resolve=self._pepResolve, segmentSz=self.mtu - 20 - 8 - 19, log=self.log)
+
 
 
 
     
+    def _create_device(self, config):
+        return config["deviceClass"](config=config)
+
+
     def _ip2loraAddr(self, ip_gw):
         return int(ip_gw.split(".")[-1])
 
 
+    def _lora2ipAddr(self, addrLora):
+        return ".".join(self._ipAddress.split(".")[:3] + [str(addrLora)])
+
+
+    """
+    Get LoRa IP address of gateway of destination (PEP relay)
+    ip_dst: IPv4 address as int
+    """
+    def _pepResolve(self, ip_dst):
+        addrLora = self._routeCache.lookup(ip_dst)
+        if addrLora is None or addrLora == self._addrLora:
+            return None
+        return self._lora2ipAddr(addrLora)
+
+
     def _uncompress_ip_headers(self, data):
-        if self.bUseRohc:
-            from libLora import libRohc
-            data = libRohc.decompress(self.rohc_decomp, data)
-        return data
+        if self._libRohc is not None:
+            return self._libRohc.decompress(self.rohc_decomp, data)
+        return self._hdrDecompressor.decompress(data)
 
 
-    def _compress_ip_headers(self, data):
-        if self.bUseRohc:
-            from libLora import libRohc
-            data = libRohc.compress(self.rohc_comp, data)
+    """
+    Compress headers of IP packet (aggregates are delimited by IPv4 headers: not compressed)
+    """
+    def _compress_ip_headers(self, data, flags=0):
+        if self._libRohc is not None:
+            data = self._libRohc.compress(self.rohc_comp, data)
+        elif self._hdrCompressor is not None and not flags & libAggregate.FLAG_AGGREGATE:
+            data = self._hdrCompressor.compress(data)
         return data
 
 
 
+    """
+    Airtime (s) of an envelope of sz bytes (fragments if larger than a LoRa frame)
+    """
+    def _envelope_airtime(self, sz):
+        if sz <= self.maxLoraFrameSz:
+            return self._airtime.airtime(sz)
+        chunkSz = self.maxLoraFrameSz - libFragment.FRAG_OVERHEAD
+        nb = (sz - 3 + chunkSz - 1) // chunkSz
+        return nb * self._airtime.airtime(self.maxLoraFrameSz)
+
+
+
     """
     compress and cipher IP frame
+    addrLora: destination (context of streaming compression)
+    flow: key of flow (adaptive codec selection)
+    flags: flags of envelope (compress/cipher flags are added)
     """
-    def _compress_and_cipher(self, data):
-        data = self._compress_ip_headers(data)
-        flags = 0
+    def _compress_and_cipher(self, data, addrLora=None, flow=None, flags=0):
+        data = self._compress_ip_headers(data, flags)
 
-        if self._func_compress:
+        if self._compressStream is not None:
+            data_compress = self._compressStream.compress(addrLora, data)
+            if len(data_compress) >= len(data):
+                # not sent: receiver context would miss it
+                self._compressStream.reset(addrLora)
+            else:
+                data = data_compress
+                flags |= 8
+        elif self._codecSelector is not None:
+            data_compress = self._codecSelector.compress(flow, data)
+            if data_compress is not None:
+                data = data_compress
+                flags |= 8
+        elif self._func_compress:
             data_compress = self._func_compress(data)
             self.log.debug("_compress_and_cipher:%s" % (data_compress))
             if len(data_compress) >= len(data):
@@ -164,8 +519,11 @@ class Ip2Lora(threading.Thread):
                 flags |= 8
 
         if self._func_cipher:
-            data = self._func_cipher(data)
             flags |= 4
+            if self._bAead:
+                data = self._func_cipher(data, bytes([addrLora + (flags << 4)]))
+            else:
+                data = self._func_cipher(data)
 
         return flags, data
 
@@ -174,7 +532,7 @@ class Ip2Lora(threading.Thread):
     """
     uncompress and uncipher IP frame (if needed)
     """
-    def _uncompress_and_uncipher(self, data, flags):
+    def _uncompress_and_uncipher(self, data, flags, addr_flags=None):
         res = False
 
         # check cipher
@@ -183,18 +541,24 @@ class Ip2Lora(threading.Thread):
                 #self.log.debug("%s:uncipher failed: No uncipher function configured" % (self._name))
                 return res, None
             try:
-                data = self._func_uncipher(data)
+                if self._bAead:
+                    data = self._func_uncipher(data, bytes([addr_flags]))
+                else:
+                    data = self._func_uncipher(data)
             except Exception as e:
                 self.log.debug("%s:uncipher failed: %s" % (self._name, str(e)))
                 return res, None
 
         # check compress
         if (flags >> 3) & 1 == 1:
-            if self._func_decompress is None:
+            func_decompress = self._func_decompress
+            if self._decompressStream is not None:
+                func_decompress = self._decompressStream.decompress
+            if func_decompress is None:
                 #self.log.debug("%s:uncompress failed: No uncompress function configured" % (self._name))
                 return res, None
             try:
-                data = self._func_decompress(data)
+                data = func_decompress(data)
             except Exception as e:
                 self.log.debug("%s:uncompress failed: %s" % (self._name, str(e)))
                 return res, None
@@ -261,116 +625,256 @@ class Ip2Lora(threading.Thread):
 
 
     """
-    Send Data on LoRa Radio network
+    Queue Data to send on LoRa Radio network
+    flow: key of flow (fair queueing)
+    cls: traffic class (priority)
+    supersede: key of data replaced by next data of same key (ACK thinning)
     """
-    def _send_lora(self, data):
+    def _send_lora(self, data, flow=None, cls=0, supersede=None):
         if data:
-            nb_seg = math.ceil(len(data) / float(self.maxLoraFrameSz))
-            i = 0
-            while i < nb_seg:
-                self._t_dev.send_radio_frame(data[i * self.maxLoraFrameSz:(i + 1) * self.maxLoraFrameSz])
-                i += 1
+            if not self._txQueue.put(data, flow=flow, cls=cls, supersede=supersede):
+                self.log.debug("%s:send_lora: TX queue full, frame dropped" % self._name)
+        return
+
+
+    """
+    Send Data on LoRa Radio network (TX scheduler)
+    flow: key of flow of data (adaptive codec selection)
+    cls: traffic class of data (airtime budget)
+    """
+    def _send_radio(self, data, flow=None, cls=0):
+        try:
+            frames = self._radio_frames(data, flow)
+            delay = self._budget_delay(data, frames, cls)
+            if delay is None:
+                return
+            if delay > 0:
+                time.sleep(delay)
+            for frame in frames:
+                self._t_dev.send_radio_frame(frame)
+        except Exception:
+            self._discard_radio(data)
+            raise
         return
 
 
+    """
+    Envelope taken from TX queue is not (fully) sent
+    Compression contexts are reset (receiver context would miss it): streaming context
+    of destination, header context of flow of packet (next packet is sent in an IR)
+    """
+    def _discard_radio(self, data):
+        if self._compressStream is not None:
+            self._compressStream.reset(data[2] & 0xf)
+        if self._hdrCompressor is not None and not (data[2] >> 4) & libAggregate.FLAG_AGGREGATE:
+            self._hdrCompressor.reset(data[3:len(data) - self._swCrcSz])
+
+
+    """
+    Gate of TX queue: time (s) before class has budget for a LoRa frame
+    """
+    def _budget_gate(self, cls, now):
+        return self._budget.delay(self._txChannel, self._budgetFrameAirtime, cls, now)
+
+
+    """
+    Time (s) to wait before sending frames of envelope (duty cycle): their airtime is
+    reserved in budget (stays accounted if sending fails)
+    None: envelope is dropped (budget is not available within max wait)
+    """
+    def _budget_delay(self, data, frames, cls=0):
+        if self._budget is None or len(frames) == 0:
+            return 0
+        airtime = 0.0
+        for frame in frames:
+            airtime += self._airtime.airtime(len(frame))
+        delay = self._budget.reserve(self._txChannel, airtime, cls, maxWait=self._budgetMaxWait)
+        if delay is None:
+            self.log.debug("%s:send_radio: airtime budget exhausted, frame dropped" % self._name)
+            self._discard_radio(data)
+        return delay
+
+
+    """
+    Get LoRa frames of envelope (fragments if envelope is larger than a LoRa frame)
+    With stateful compression, envelope is compressed here (in transmit order)
+    """
+    def _radio_frames(self, envelope, flow=None):
+        data = envelope
+        if self._bEncodeOnSend:
+            data = self._encode_envelope(envelope, flow)
+            if data is None:
+                self._discard_radio(envelope)
+                return []
+
+        # compact length is never longer than standard length (none: 2 bytes less)
+        maxFrameSz = self.maxLoraFrameSz
+        if self._envelope == libFrameBuf.ENVELOPE_COMPACT_NOLEN:
+            maxFrameSz += 2
+
+        if len(data) <= maxFrameSz:
+            frames = [data]
+        else:
+            frames = libFragment.build_fragments(data, self._addrLora, self._fragPktId, maxFrameSz,
+                                                 bCrc=not self._bRadioCrc)
+            self._fragPktId = (self._fragPktId + 1) & 0xff
+            if len(frames) == 0:
+                self.log.warning("%s:send_radio: too many fragments, frame dropped" % self._name)
+                self._discard_radio(envelope)
+                return frames
+            self.nb_frag_tx_packets += 1
+            self.nb_frag_tx_fragments += len(frames)
+
+        if self._envelope == libFrameBuf.ENVELOPE_STANDARD:
+            return frames
+        return [self._compact_frame(frame) for frame in frames]
+
+
+    """
+    Replace length (2 bytes) of frame by compact length (see libFrameBuf)
+    """
+    def _compact_frame(self, frame):
+        if self._envelope == libFrameBuf.ENVELOPE_COMPACT_NOLEN:
+            return frame[2:]
+        return libFrameBuf.encode_varint(struct.unpack_from("H", frame)[0]) + frame[2:]
+
+
     
     """
     Send IP frame on LoRa radio network
     """
-    def _send_ip2lora(self, frame):
+    def _send_ip2lora(self, frame, ip, cls=0):
+        #addrLora = self._getLoraAddrFromMac(frame.dst)
+        #if addrLora is None:
+        #    return
+
+
+        # get Lora address of gateway or IP.dst (cached)
+        addrLora = self._routeCache.lookup(ip.dst)
+        if addrLora is None:
+            self.log.warning("%s:_send_ip2lora:No Lora address for %s" % (self._name, ip.dst_str))
+            return
+
+        flow = (addrLora,) + libPacket.flow_key(ip)
+
+        supersede = None
+        if self._ackFilter is not None:
+            tcp = libPacket.parse_tcp(ip)
+            if tcp is not None:
+                supersede = self._ackFilter.supersede_key(flow, ip, tcp)
+
+        if self._aggregator is None:
+            self._send_envelope(addrLora, [bytes(frame)], flow, cls, supersede)
+            return
+
+        for dst, cls, flow, packets in self._aggregator.add(addrLora, cls, flow, bytes(frame), time.monotonic(), supersede):
+            self._send_envelope(dst, packets, flow, cls)
+        return
+
+
+    """
+    Send aggregated packets whose hold time is elapsed
+    Return time (s) before next hold time expires (None if nothing is pending)
+    """
+    def _cbOnTimer(self):
+        if self._aggregator is None:
+            return None
+        now = time.monotonic()
+        for dst, cls, flow, packets in self._aggregator.pop_expired(now):
+            self._send_envelope(dst, packets, flow, cls)
+        return self._aggregator.next_delay(now)
+
+
+    """
+    Build envelope of IP packet(s) and queue it
+    supersede: key of envelope replaced in TX queue by next envelope of same key
+    """
+    def _send_envelope(self, addrLora, packets, flow, cls, supersede=None):
         """
         +0 (2 bytes) sz_data
 
         +2 (1 byte)
             x... .... ip payload 0:uncompress 1:compress
             .x.. .... ip payload 0:uncipher 1:cipher
-            ..x. ....
-            ...x ....
+            ..x. .... fragment (see libFragment)
+            ...x .... aggregate: several IP packets (see libAggregate)
             .... xxxx address Lora
 
         +3 data
         ...
         +sz_frame (2 byte) crc16
         """
-        #addrLora = self._getLoraAddrFromMac(frame.dst)
-        #if addrLora is None:
-        #    return
-
-
-        # get mac address or IP.dst
-        ip_gw = libUtils.get_gateway(frame["IP"].dst)
-        if ip_gw is None:
-            ip_gw = frame["IP"].dst
-
-        mac_dst = libUtils.get_mac(iface=self._iface, ipaddress=ip_gw)
-        if mac_dst is None:
-            self.log.warning("%s:_send_ip2lora:Unable to get mac address for %s" % (self._name, ip_gw))
-            return
+        flags = 0
+        if len(packets) > 1:
+            clear_payload = libAggregate.join_packets(packets)
+            flags = libAggregate.FLAG_AGGREGATE
+        else:
+            clear_payload = packets[0]
 
-        addrLora = self._getLoraAddrFromMac(mac_dst)
-        if addrLora is None:
-            self.log.warning("%s:_send_ip2lora:Not a Lora Mac address %s" % (self._name, addrLora))
+        if self._bEncodeOnSend:
+            # clear envelope (v1): compressed and ciphered when sent (see _radio_frames)
+            data2send = self._build_envelope(addrLora, flags, clear_payload, clear_payload, version=1)
+        else:
+            # Compress and cipher
+            flags, data_compress = self._compress_and_cipher(clear_payload, addrLora, flow, flags)
+            data2send = self._build_envelope(addrLora, flags, clear_payload, data_compress)
+        if data2send is None:
             return
 
+        self._send_lora(data2send, flow=flow, cls=cls, supersede=supersede)
+        return
 
 
-        # Compress and cipher
-        clear_payload = raw(frame)
-        flags, data_compress = self._compress_and_cipher(clear_payload)
-        sz = len(data_compress)
+    """
+    Build envelope: data is clear payload once compressed/ciphered (according to flags)
+    No crc when data is ciphered by an authenticated cipher (tag checks it) or when radio checks crc
+    version: frame format (see libFrameBuf), default: frame version of config
+    """
+    def _build_envelope(self, addrLora, flags, clear_payload, data, version=None):
+        if version is None:
+            version = self._frameVersion
+        sz = len(data)
 
-        if sz > 0xfffe:
+        if sz > libFrameBuf.FRAME_SZ_MASK - 2:
             self.log.warning("_send_ip2lora: lora frame sz overflow!")
-            return
-        sz = struct.pack("H", sz+1)
-
+            return None
 
         addrLora += (flags << 4)
+        if version == 2:
+            head = struct.pack("HB", (sz + 2) | libFrameBuf.FRAME_V2, addrLora)
+            frame = head + bytes([libFrameBuf.header_check(head)]) + data
+            if (self._bAead and flags & 4) or self._bRadioCrc:
+                return frame
+            return frame + struct.pack("<H", crc16.crc16xmodem(frame))
+
+        sz = struct.pack("H", sz+1)
         raw_addr_flags = struct.pack("B", addrLora)
+        if (self._bAead and flags & 4) or self._bRadioCrc:
+            return sz + raw_addr_flags + data
         crc = crc16.crc16xmodem(raw_addr_flags + clear_payload)
 
-        data2send = sz + raw_addr_flags + data_compress + struct.pack("<H", crc)
-
-        self._send_lora(data2send)
-        return
-
-
+        return sz + raw_addr_flags + data + struct.pack("<H", crc)
 
 
-    # To delete
-    def _workWithArp(self, frame):
-        # reply to arp request
-        if frame["ARP"].op != 1: # who-has
-            return
-
-        ip_req = ipaddress.ip_address(frame["ARP"].pdst)
-        if ip_req not in self._ipNetHosts:
-            return
-
-        # Send arp mac response for LoRa device
-        id_ip_req = int(ip_req) % 16
-        mac_req = libUtils.int_to_mac(libUtils.mac_to_int(MAC_PREFIX) + id_ip_arp_req)
+    """
+    Compress (header and streaming contexts) and cipher clear envelope
+    """
+    def _encode_envelope(self, envelope, flow=None):
+        addr_flags = envelope[2]
+        addrLora = addr_flags & 0xf
+        clear_payload = envelope[3:len(envelope) - self._swCrcSz]
+        flags, data = self._compress_and_cipher(clear_payload, addrLora, flow, flags=addr_flags >> 4)
+        return self._build_envelope(addrLora, flags, clear_payload, data)
 
-        arp_resp = ARP(op=2, hwsrc=mac_req, psrc=str(ip_req), hwdst=frame["ARP"].hwsrc, pdrc=frame["ARP"].psrc)
-        sendp(arp_resp)
 
 
 
     # calculate TCP checksum and update frame
-    def _checksum_calc(self, frame):
-        res = False
-        if not frame.haslayer("IP"):
-
-            return res, frame
-
-        if frame.haslayer("TCP"):
-            chksum = in4_chksum(socket.IPPROTO_TCP, frame["IP"], raw(frame["TCP"])[:16] + b'\x00\x00' + raw(frame["TCP"])[18:])
-            frame["TCP"].chksum = chksum
-        else:
-            #self.log.debug("%s:no tcp frame:%s" % (self._name, frame.build()))
-            pass
-        res = True
-        return res, frame
+    def _checksum_calc(self, frame, ip):
+        tcp = libPacket.parse_tcp(ip)
+        if tcp is not None:
+            libPacket.update_tcp_checksum(ip, tcp)
+        return True, frame
 
     
 
@@ -382,8 +886,7 @@ class Ip2Lora(threading.Thread):
 
         if pkt.hw_protocol == 0x800:
             # IPv4 frame
-            frame = IP(pkt.get_payload())
-            self._workWithNetFrame(frame)
+            self._workWithNetFrame(bytearray(pkt.get_payload()))
 
         pkt.accept()
 
@@ -395,122 +898,235 @@ class Ip2Lora(threading.Thread):
     """
     def _workWithNetFrame(self, frame):
 
-        if frame.haslayer("IP"):
-            # force recalculate checksum
-            #   In normal condition, kernel driver will calculate them
-            #   But on frame sent from local machine, we capture frame before kernel driver works....
-            res, frame = self._checksum_calc(frame)
-            if not res:
-                return
+        ip = libPacket.parse_ipv4(frame)
+        if ip is None:
+            return
 
-            self.log.debug("%s:workWithNetFrame:Sending %s" % (self._name, frame.build()))
+        # IP padding (if any) is not sent
+        if ip.total_len < len(frame):
+            del frame[ip.total_len:]
 
-            self._send_ip2lora(frame)
-        else:
+        # force recalculate checksum
+        #   In normal condition, kernel driver will calculate them
+        #   But on frame sent from local machine, we capture frame before kernel driver works....
+        res, frame = self._checksum_calc(frame, ip)
+        if not res:
             return
 
+        if self._debug:
+            self.log.debug("%s:workWithNetFrame:Sending %s" % (self._name, libPacket.debug_decode(frame)))
+
+        cls = 0
+        if self._classifier is not None:
+            cls = self._classifier.classify(ip)
+
+        self._send_ip2lora(frame, ip, cls)
+
 
 
     """
     Extract data (IP frame) from (received) LoRa frame
+    Parser callback of receive buffer: work on offsets of received data view
+    Cheap checks (size, address, v2 header check and crc) are done before any copy or decoding
     """
-    def _unserialize(self, rawdata, i = 1):
-        res = False
-        offset = 0
+    def _unserialize(self, view, offset, end):
+        if end - offset < self._minFrameSz:
+            return libFrameBuf.FRAME_NEED_MORE, None, 0
+
+        # h: offset of addr/flags
+        if self._envelope == libFrameBuf.ENVELOPE_STANDARD:
+            sz = struct.unpack_from("H", view, offset)[0]
+            v2 = sz & libFrameBuf.FRAME_V2
+            sz &= libFrameBuf.FRAME_SZ_MASK
+            h = offset + 2
+        else:
+            sz, n = libFrameBuf.decode_varint(view, offset, end)
+            if n == 0:
+                return libFrameBuf.FRAME_NEED_MORE, None, 0
+            if sz is None:
+                return libFrameBuf.FRAME_BAD, None, 0
+            v2 = 0
+            h = offset + n
+        if sz < 2 or sz > self._maxEnvelopeSz:
+            return libFrameBuf.FRAME_BAD, None, 0
+
+        addr_flags = view[h]
+        addrLora = addr_flags & 0xf
+        if addrLora != self._addrLora:
+            #self.log.debug("%s:unserialize: bad addr: 0x%X" % (self._name, addrLora))
+            return libFrameBuf.FRAME_BAD, None, 0
 
+        if v2 and view[h + 1] != libFrameBuf.header_check(view[offset:h + 1]):
+            self.nb_rx_hdr_bad += 1
+            return libFrameBuf.FRAME_BAD, None, 0
 
-        if len(rawdata) < 5:
-            #xself.log.debug("%s:unserialize:frame to short" % (self._name))
-            return res, None, offset
-        
-        sz = struct.unpack("H", rawdata[0:2])[0]
+        flags = (addr_flags & 0xf0) >> 4
+        crcSz = self._crc_sz(addr_flags)
+
+        frame_end = h + sz + crcSz
+        if frame_end > end:
+            #self.log.debug("%s:unserialize:frame to short. Expected: 0x%X" % (self._name, sz+2))
+            return libFrameBuf.FRAME_NEED_MORE, None, 0
+
+        crc = None
+        if crcSz > 0:
+            crc = struct.unpack_from("<H", view, h + sz)[0]
+            if v2 and crc16.crc16xmodem(bytes(view[offset:h + sz])) != crc:
+                self.nb_rx_crc_bad += 1
+                return libFrameBuf.FRAME_BAD, None, 0
+
+        if flags & libFragment.FLAG_FRAGMENT:
+            return self._unserialize_fragment(view, h, sz, crc, v2, frame_end - offset)
+
+        data_start = h + 1
+        if v2:
+            data_start += 1
+        r, clear_payload = self._uncompress_and_uncipher(bytes(view[data_start:h + sz]), flags, addr_flags)
+        if not r:
+            #self.log.debug("%s:_uncompress_and_uncipher failed" % (self._name))
+            return libFrameBuf.FRAME_BAD, None, 0
 
+        # check crc (v1: crc of clear payload, authenticated cipher: tag is checked, radio crc: checked by radio)
+        if not v2 and crc is not None:
+            crc_data = crc16.crc16xmodem(bytes([addr_flags]) + clear_payload)
+            if crc_data != crc:
+                #self.log.debug("%s:unserialize: bad crc Expected: %X Got: %X" % (self._name, crc, crc_data))
+                self._discard_stream(flags)
+                return libFrameBuf.FRAME_BAD, None, 0
 
-        if sz < 2:
-            return res, None, offset
+        return libFrameBuf.FRAME_OK, self._split_payload(clear_payload, flags), frame_end - offset
 
-        if i == 0:
-            self.log.debug(sz)
 
+    """
+    Size of software crc of frame: none for envelopes of authenticated cipher (not
+    their fragments) or when radio checks crc
+    """
+    def _crc_sz(self, addr_flags):
+        flags = addr_flags >> 4
+        if self._bAead and flags & 4 and not flags & libFragment.FLAG_FRAGMENT:
+            return 0
+        return self._swCrcSz
 
-        rawdata = rawdata[2:]
-        offset += 2
 
+    """
+    Bad packet was decompressed: streaming context of its source is lost
+    """
+    def _discard_stream(self, flags):
+        if self._decompressStream is not None and flags & 8:
+            self._decompressStream.discard_last()
 
-        if len(rawdata) < (sz + 2):
-            #self.log.debug("%s:unserialize:frame to short. Expected: 0x%X" % (self._name, sz+2))
-            return res, None, offset
 
-        data = rawdata[:sz]
-        addr_flags = data[0]
-        crc = struct.unpack("<H", rawdata[sz:sz + 2])[0]
-        offset += sz + 2
+    """
+    Get IP packet(s) of clear payload (list for aggregates)
+    """
+    def _split_payload(self, clear_payload, flags):
+        if not flags & libAggregate.FLAG_AGGREGATE:
+            return clear_payload
+        packets = libAggregate.split_packets(clear_payload)
+        if packets is None:
+            self.log.debug("%s:unserialize: bad aggregate" % self._name)
+        return packets
 
 
-        addrLora = addr_flags & 0xf
-        if i == 0:
-            self.log.debug(addrLora)
-        if addrLora != self._addrLora:
-            #self.log.debug("%s:unserialize: bad addr: 0x%X" % (self._name, addrLora))
-            return res, None, offset
+    """
+    Check fragment (crc on air bytes) and give it to reassembly table
+    On last fragment, packet is decoded as a complete envelope
+    """
+    def _unserialize_fragment(self, view, h, sz, crc, v2, frame_sz):
+        hdrSz = 1
+        if v2:
+            hdrSz += 1
+        if sz < hdrSz + libFragment.FRAG_HDR_SZ + 1:
+            return libFrameBuf.FRAME_BAD, None, 0
+        body = view[h:h + sz]
+        if not v2 and crc is not None and crc16.crc16xmodem(bytes(body)) != crc:
+            return libFrameBuf.FRAME_BAD, None, 0
+
+        addr_flags = body[0] & ~(libFragment.FLAG_FRAGMENT << 4)
+        payload = self._reassembler.add(body[hdrSz] & 0xf, body[hdrSz + 1], body[hdrSz + 2],
+                                        body[hdrSz + libFragment.FRAG_HDR_SZ:])
+        if payload is None:
+            return libFrameBuf.FRAME_OK, None, frame_sz
+
+        return libFrameBuf.FRAME_OK, self._decode_reassembled(addr_flags, payload, v2), frame_sz
+
+
+    """
+    Decode reassembled payload: envelope is rebuilt and parsed as a received frame
+    """
+    def _decode_reassembled(self, addr_flags, payload, v2):
+        crcSz = self._crc_sz(addr_flags)
+        if len(payload) < crcSz + 1:
+            return None
+
+        if v2:
+            head = struct.pack("HB", (2 + len(payload) - crcSz) | libFrameBuf.FRAME_V2, addr_flags)
+            envelope = head + bytes([libFrameBuf.header_check(head)]) + payload
+        elif self._envelope == libFrameBuf.ENVELOPE_STANDARD:
+            envelope = struct.pack("HB", 1 + len(payload) - crcSz, addr_flags) + payload
+        else:
+            envelope = libFrameBuf.encode_varint(1 + len(payload) - crcSz) + bytes([addr_flags]) + payload
+
+        status, packets, frame_sz = self._unserialize(memoryview(envelope), 0, len(envelope))
+        if status != libFrameBuf.FRAME_OK or frame_sz != len(envelope):
+            self.log.debug("%s:unserialize: bad reassembled packet" % self._name)
+            return None
+        return packets
 
-        flags = (addr_flags & 0xf0) >> 4
-        if i == 0:
-            self.log.debug(flags)
-        r, clear_payload = self._uncompress_and_uncipher(data[1:], flags)
-        if not r:
-            #self.log.debug("%s:_uncompress_and_uncipher failed" % (self._name))
-            return res, None, None
-
-        # check crc
-        crc_data = crc16.crc16xmodem(bytes([addr_flags]) + clear_payload)
-        if i == 0:
-            self.log.debug(crc_data)
-            self.log.debug(crc)
-            self.log.debug("")
-        if crc_data != crc:
-            #self.log.debug("%s:unserialize: bad crc Expected: %X Got: %X" % (self._name, crc, crc_data))
-            return res, None, None
 
-        res = True
-        return res, clear_payload, offset
-        
-        
 
 
     """
     Add received LoRa data in received buffer
-    Try to parse received buffer to get a valid Lora/IP frame
-    Send Lora/IP frame on classical IP network 
+    Parse received buffer to get all valid Lora/IP frames
+    Send Lora/IP frames on classical IP network 
     """
     def _workWithSerialFrame(self):
 
-        self._recvBuf += self._t_dev.recv_radio_frame()
+        data = self._t_dev.recv_radio_frame(timeout=RECV_RADIO_TIMEOUT)
+        if len(data) == 0:
+            # nothing new to parse
+            return
 
-        i = 0
-        while i < len(self._recvBuf):
-            res, data, offset_end = self._unserialize(self._recvBuf[i:],)
-            if res:
-                self._recvBuf = self._recvBuf[i + offset_end:]
+        # get all frames already received
+        while len(data) > 0:
+            self._feed_radio(data)
+            data = self._t_dev.recv_radio_frame(timeout=0)
 
-                frame = IP(data)
-                ipdst = frame["IP"].dst
+        self._injectRecvFrames()
+        return
 
-                #send(frame, iface=self._iface)
-                #sendp(frame)
-                s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
-                s.setsockopt(socket.SOL_IP, socket.IP_HDRINCL, 1)
-                s.sendto(raw(frame), (ipdst, 0))
-                s.close()
-                self.log.debug("%s:workWithSerialFrame: net frame sent: %s" % (self._name, raw(frame)))
 
 
-                # exit func => we will work with following received data on next main loop...
+    """
+    Add received radio data to receive buffer
+    Envelope without length: one radio frame is one frame, its length is added here
+    """
+    def _feed_radio(self, data):
+        if self._envelope == libFrameBuf.ENVELOPE_COMPACT_NOLEN and len(data) > 0:
+            sz = len(data) - self._crc_sz(data[0])
+            if sz < 2:
                 return
-            else:
-                # parsing error
-                # try to parse at next byte
-                i += 1
+            data = libFrameBuf.encode_varint(sz) + data
+        self._recvBuf.feed(data)
+
+
+    """
+    Parse received buffer and send Lora/IP frames on classical IP network
+    """
+    def _injectRecvFrames(self):
+        frames = []
+        for data in self._recvBuf.pop_frames():
+            if libPacket.parse_ipv4(data) is None:
+                self.log.debug("%s:workWithSerialFrame: not an IPv4 frame" % (self._name))
+                continue
+            frames.append((data, data[16:20]))
+            if self._debug:
+                self.log.debug("%s:workWithSerialFrame: net frame sent: %s" % (self._name, libPacket.debug_decode(data)))
+
+        # all frames of one read are injected with one call
+        if len(frames) > 0:
+            self._injector.send_frames(frames)
 
         return
 
@@ -527,22 +1143,37 @@ class Ip2Lora(threading.Thread):
 
         # Init dummy iface
         self._init_dummy_eth()
+        self._injector.open()
+        self._routeCache.open()
+        self._routeCache.start()
 
+        self._t_tx_scheduler.start()
         self._t_recv_ip_from_dummy.start()
+        if self._t_pep is not None:
+            self._t_pep.start()
 
         while self._isRunning:
 
             # On recv serial => Send in IP stack
             self._workWithSerialFrame()
-            time.sleep(0.01)
 
 
 
+        if self._t_pep is not None:
+            self._t_pep.stop()
+            self._t_pep.join()
         self._t_recv_ip_from_dummy.stop()
 
         self._rm_dummy_eth()
         self._t_recv_ip_from_dummy.join()
-        
+        self._injector.close()
+
+        self._routeCache.stop()
+        self._routeCache.join()
+
+        self._t_tx_scheduler.stop()
+        self._t_tx_scheduler.join()
+
         self._t_dev.stop()
         self._t_dev.join()
         self.log.debug(self._name + ":End")
@@ -555,6 +1186,51 @@ class Ip2Lora(threading.Thread):
         self._isRunning = False
 
 
+    """
+    Get counters of gateway
+    """
+    def get_stats(self):
+        stats = {}
+        stats.update(self._recvBuf.get_stats())
+        stats.update(self._reassembler.get_stats())
+        if self._aggregator is not None:
+            stats.update(self._aggregator.get_stats())
+        stats["frame_v2_hdr_bad"] = self.nb_rx_hdr_bad
+        stats["frame_v2_crc_bad"] = self.nb_rx_crc_bad
+        stats["frag_tx_packets"] = self.nb_frag_tx_packets
+        stats["frag_tx_fragments"] = self.nb_frag_tx_fragments
+        stats.update(self._injector.get_stats())
+        stats.update(self._routeCache.get_stats())
+        stats.update(self._t_recv_ip_from_dummy.get_stats())
+        stats.update(self._txQueue.get_stats())
+        if self._classifier is not None:
+            stats.update(self._classifier.get_stats())
+        if self._ackFilter is not None:
+            stats.update(self._ackFilter.get_stats())
+            nb_saved = self._txQueue.nb_superseded
+            if self._aggregator is not None:
+                nb_saved += self._aggregator.nb_superseded
+            stats["tcp_ack_saved"] = nb_saved
+        if self._t_pep is not None:
+            stats.update(self._t_pep.get_stats())
+        if self._compressStream is not None:
+            stats.update(self._compressStream.get_stats())
+            stats.update(self._decompressStream.get_stats())
+        if self._dictCompressor is not None:
+            stats.update(self._dictCompressor.get_stats())
+        if self._codecSelector is not None:
+            stats.update(self._codecSelector.get_stats())
+        if self._hdrCompressor is not None:
+            stats.update(self._hdrCompressor.get_stats())
+        if self._budget is not None:
+            stats.update(self._budget.get_stats())
+        if self._hdrDecompressor is not None:
+            stats.update(self._hdrDecompressor.get_stats())
+        stats.update(self._t_tx_scheduler.get_stats())
+        stats.update(self._t_dev.get_stats())
+        return stats
+
+
 
 
 
@@ -0,0 +1,239 @@
+import socket
+import struct
+
+
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+TCP_URG = 0x20
+TCP_ECE = 0x40
+TCP_CWR = 0x80
+
+_IPV4_HDR = struct.Struct("!BBHHHBBHII")
+_TCP_HDR = struct.Struct("!HHIIBBHHH")
+_UDP_HDR = struct.Struct("!HHHH")
+_U16 = struct.Struct("!H")
+_PORTS = struct.Struct("!HH")
+
+TCP_CHKSUM_OFFSET = 16
+UDP_CHKSUM_OFFSET = 6
+
+TCPOPT_EOL = 0
+TCPOPT_NOP = 1
+TCPOPT_TIMESTAMP = 8
+
+
+
+
+"""
+Internet checksum helpers
+A big integer built from data (big endian) modulo 0xffff is the ones' complement
+sum of its 16 bits words (2^16 = 1 mod 0xffff): sum is done in C, without copy.
+"""
+def ones_complement_sum(data, initial=0):
+    s = int.from_bytes(data, "big")
+    if len(data) & 1:
+        s <<= 8
+    return (s + initial) % 0xffff
+
+
+def fold_checksum(s):
+    # 0 mod 0xffff is a ones' complement sum of 0xffff (data is never all zero here)
+    return 0xffff - (s or 0xffff)
+
+
+def ipv4_addr_sum(ip_int):
+    return (ip_int >> 16) + (ip_int & 0xffff)
+
+
+
+
+"""
+IPv4 header view
+Fields are read once with struct from bytes, bytearray or memoryview (no copy)
+"""
+class IPv4View():
+    __slots__ = ("buf", "hdr_len", "total_len", "tos", "ident", "frag", "ttl", "proto", "src", "dst")
+
+    def __init__(self, buf):
+        (ver_ihl, self.tos, self.total_len, self.ident, self.frag, self.ttl, self.proto, _chksum,
+         self.src, self.dst) = _IPV4_HDR.unpack_from(buf, 0)
+        self.buf = buf
+        self.hdr_len = (ver_ihl & 0xf) * 4
+
+    @property
+    def dscp(self):
+        return self.tos >> 2
+
+    @property
+    def src_str(self):
+        return socket.inet_ntoa(struct.pack("!I", self.src))
+
+    @property
+    def dst_str(self):
+        return socket.inet_ntoa(struct.pack("!I", self.dst))
+
+    # True if packet is a first fragment or not fragmented
+    def has_l4_header(self):
+        return (self.frag & 0x1fff) == 0
+
+    def l4_view(self):
+        return memoryview(self.buf)[self.hdr_len:self.total_len]
+
+    def pseudo_hdr_sum(self):
+        return ipv4_addr_sum(self.src) + ipv4_addr_sum(self.dst) + self.proto + (self.total_len - self.hdr_len)
+
+
+
+
+"""
+TCP header view
+"""
+class TcpView():
+    __slots__ = ("buf", "offset", "sport", "dport", "seq", "ack", "hdr_len", "flags", "window", "chksum", "urg_ptr")
+
+    def __init__(self, buf, offset):
+        (self.sport, self.dport, self.seq, self.ack, data_off, self.flags, self.window, self.chksum,
+         self.urg_ptr) = _TCP_HDR.unpack_from(buf, offset)
+        self.buf = buf
+        self.offset = offset
+        self.hdr_len = (data_off >> 4) * 4
+
+
+
+
+"""
+UDP header view
+"""
+class UdpView():
+    __slots__ = ("buf", "offset", "sport", "dport", "length", "chksum")
+
+    def __init__(self, buf, offset):
+        self.sport, self.dport, self.length, self.chksum = _UDP_HDR.unpack_from(buf, offset)
+        self.buf = buf
+        self.offset = offset
+
+
+
+
+"""
+Get IPv4 view of data
+Return None if data is not a valid IPv4 packet
+"""
+def parse_ipv4(buf):
+    if len(buf) < 20 or (buf[0] >> 4) != 4:
+        return None
+    ip = IPv4View(buf)
+    if ip.hdr_len < 20 or ip.total_len < ip.hdr_len or ip.total_len > len(buf):
+        return None
+    return ip
+
+
+"""
+Get TCP view of IPv4 packet (None if not TCP or truncated)
+"""
+def parse_tcp(ip):
+    if ip.proto != IPPROTO_TCP or not ip.has_l4_header():
+        return None
+    if ip.total_len - ip.hdr_len < 20:
+        return None
+    tcp = TcpView(ip.buf, ip.hdr_len)
+    if tcp.hdr_len < 20 or ip.hdr_len + tcp.hdr_len > ip.total_len:
+        return None
+    return tcp
+
+
+"""
+Get UDP view of IPv4 packet (None if not UDP or truncated)
+"""
+def parse_udp(ip):
+    if ip.proto != IPPROTO_UDP or not ip.has_l4_header():
+        return None
+    if ip.total_len - ip.hdr_len < 8:
+        return None
+    return UdpView(ip.buf, ip.hdr_len)
+
+
+
+
+"""
+Get flow key of IPv4 packet: (proto, src, dst, sport, dport)
+Fragments (and protocols without ports) use (proto, src, dst, 0, 0) to keep
+all fragments of a packet in the same flow
+"""
+def flow_key(ip):
+    if (ip.frag & 0x3fff) == 0 and ip.proto in (IPPROTO_TCP, IPPROTO_UDP) and ip.total_len - ip.hdr_len >= 4:
+        sport, dport = _PORTS.unpack_from(ip.buf, ip.hdr_len)
+        return (ip.proto, ip.src, ip.dst, sport, dport)
+    return (ip.proto, ip.src, ip.dst, 0, 0)
+
+
+
+
+"""
+True if TCP segment is a pure ACK: only ACK flag, no data, and options limited
+to NOP/EOL/timestamps (SACK blocks and others options are never pure)
+"""
+def is_pure_ack(ip, tcp):
+    if tcp.flags != TCP_ACK or ip.hdr_len + tcp.hdr_len != ip.total_len:
+        return False
+
+    i = tcp.offset + 20
+    end = tcp.offset + tcp.hdr_len
+    buf = ip.buf
+    while i < end:
+        kind = buf[i]
+        if kind == TCPOPT_EOL:
+            break
+        if kind == TCPOPT_NOP:
+            i += 1
+            continue
+        if kind != TCPOPT_TIMESTAMP:
+            return False
+        i += 10
+    return True
+
+
+"""
+TCP sequence numbers comparison (modulo 2^32): True if a is after b
+"""
+def seq_after(a, b):
+    return 0 < ((a - b) & 0xffffffff) < 0x80000000
+
+
+
+
+"""
+Recalculate TCP checksum in place
+buf must be writable (bytearray)
+"""
+def update_tcp_checksum(ip, tcp):
+    segment = memoryview(ip.buf)[ip.hdr_len:ip.total_len]
+    # old checksum word is removed from sum instead of zeroing it in a copy
+    s = ones_complement_sum(segment, ip.pseudo_hdr_sum() + 0xffff - tcp.chksum)
+    tcp.chksum = fold_checksum(s)
+    _U16.pack_into(ip.buf, tcp.offset + TCP_CHKSUM_OFFSET, tcp.chksum)
+    return tcp.chksum
+
+
+
+
+"""
+Decode packet for debug traces
+Scapy is optional and only used here
+"""
+def debug_decode(data):
+    try:
+        from scapy.layers.inet import IP
+    except ImportError:
+        return bytes(data).hex()
+    try:
+        return repr(IP(bytes(data)))
+    except Exception:
+        return bytes(data).hex()
@@ -0,0 +1,684 @@
+import threading
+import selectors
+import socket
+import struct
+import time
+import os
+
+
+# local port of TPROXY listener (TCP connections to LoRa networks)
+PEP_PORT = 4242
+
+# UDP port of relay between gateways (on LoRa IP addresses)
+PEP_RELAY_PORT = 4243
+
+# fwmark and routing table of TPROXY
+PEP_MARK = 0x1
+PEP_TABLE = 100
+
+# max bytes in flight (and receive window) of a relayed stream (no slow start)
+PEP_WINDOW = 0x8000
+
+# retransmission timeout (s): link-aware (seconds of RTT on LoRa)
+PEP_RTO_INIT = 4.0
+PEP_RTO_MIN = 2.0
+PEP_RTO_MAX = 60.0
+PEP_MAX_RETRIES = 8
+
+# duplicate ACKs (hole at receiver) before first unacked segment is resent
+PEP_DUP_ACKS = 2
+
+# (s) max time an ACK waits for data to piggyback on
+PEP_ACK_DELAY = 0.3
+
+# (s) connection closed without activity
+PEP_IDLE_TIMEOUT = 600
+
+PEP_MAX_CONNS = 64
+
+# IP_TRANSPARENT is missing from socket module of some python versions
+IP_TRANSPARENT = getattr(socket, "IP_TRANSPARENT", 19)
+
+"""
+Relay message: flags (1) | conn id (2) | seq (4) | ack (4) | window (2) | [dst ip (4) | dst port (2)] | data
+"""
+_HDR = struct.Struct("!BHIIH")
+_OPEN = struct.Struct("!4sH")
+
+FLAG_INIT = 0x80    # sender is initiator of connection
+FLAG_OPEN = 0x40    # message carries destination of connection
+FLAG_FIN = 0x20     # stream of sender ends after data of message
+FLAG_RST = 0x10     # connection aborted
+
+SEQ_MASK = 0xffffffff
+
+
+
+
+def _seq_diff(a, b):
+    d = (a - b) & SEQ_MASK
+    if d >= 0x80000000:
+        d -= 0x100000000
+    return d
+
+
+
+
+"""
+Relayed TCP connection
+Local side is a TCP socket, remote side is a reliable stream over relay messages
+(seq/ack are stream offsets, FIN uses one sequence number)
+"""
+class _PepConn():
+    def __init__(self, key, sock, peer_ip, bInit, now):
+        self.key = key
+        self.conn_id = key[1]
+        self.sock = sock
+        self.peer_ip = peer_ip
+        self.bInit = bInit
+        self.dst = None                  # (ip, port) sent in OPEN (initiator)
+        self.bOpened = not bInit         # peer knows connection
+        self.bConnected = bInit          # local socket connected
+        self.bClosed = False
+
+        # send stream
+        self.snd_buf = bytearray()       # data from snd_una
+        self.snd_una = 0
+        self.snd_nxt = 0
+        self.snd_wnd = PEP_WINDOW
+        self.bLocalEof = False
+        self.bFinSent = False
+        self.bFinAcked = False
+        self.rto = PEP_RTO_INIT
+        self.srtt = None
+        self.t_rto = None
+        self.retries = 0
+        self.dup_acks = 0
+        self.rtt_seq = None
+        self.t_rtt = 0.0
+
+        # receive stream
+        self.rcv_nxt = 0
+        self.ooo = {}                    # seq => data (out of order)
+        self.ooo_sz = 0
+        self.out_buf = bytearray()       # data to write on local socket
+        self.bPeerFin = False
+        self.t_ack = None                # ACK to send before this time
+
+        self.t_last = now
+        self.events = 0
+
+
+    def inflight(self):
+        return _seq_diff(self.snd_nxt, self.snd_una)
+
+
+    def rcv_wnd(self):
+        return max(0, PEP_WINDOW - len(self.out_buf) - self.ooo_sz)
+
+
+
+
+"""
+Split-TCP performance enhancing proxy
+TCP connections forwarded to LoRa networks are terminated by the gateway
+(iptables TPROXY): handshake and ACKs of the TCP endpoint stay local.
+Byte streams are relayed in UDP messages between LoRa IP addresses of gateways
+(so they use the LoRa path: classifier, aggregation, compression...) with:
+ - a large fixed window (no slow start)
+ - link-aware retransmission (RTO from measured RTT, seconds scale, one segment
+   resent at a time, cumulative ACKs piggybacked on data)
+The remote gateway connects to the original destination (from its own address).
+Only forwarded connections are intercepted (TPROXY works in PREROUTING).
+"""
+class TcpPep(threading.Thread):
+    def __init__(self, ipAddress, networks, resolve, segmentSz, log=None, port=PEP_PORT, relayPort=PEP_RELAY_PORT):
+        threading.Thread.__init__(self)
+        self._name = "TcpPep"
+        self.log = log
+        self._ipAddress = ipAddress
+        self._networks = networks
+        self._resolve = resolve          # ip (int) => LoRa IP of gateway (str) or None
+        self._segmentSz = segmentSz
+        self._port = port
+        self._relayPort = relayPort
+        self._isRunning = False
+
+        self._sel = None
+        self._listen = None
+        self._relay = None
+        self._conns = {}                 # (peer ip, conn id, bInit) => _PepConn
+        self._nextId = int.from_bytes(os.urandom(2), "big")
+
+        # pipe used to wake up thread on stop
+        self._wake_r, self._wake_w = os.pipe()
+
+        self.nb_conns = 0
+        self.nb_relay_tx = 0
+        self.nb_relay_rx = 0
+        self.nb_retransmits = 0
+        self.nb_bytes_up = 0
+        self.nb_bytes_down = 0
+        self.nb_errors = 0
+
+
+    def _iptables(self, action):
+        for net in self._networks:
+            os.system("iptables -t mangle -" + action + " PREROUTING -p tcp -d " + net +
+                      " -j TPROXY --on-port " + str(self._port) + " --tproxy-mark " + hex(PEP_MARK) + "/" + hex(PEP_MARK))
+
+    def _add_tproxy(self):
+        self._iptables("A")
+        os.system("ip rule add fwmark " + hex(PEP_MARK) + "/" + hex(PEP_MARK) + " lookup " + str(PEP_TABLE))
+        os.system("ip route add local 0.0.0.0/0 dev lo table " + str(PEP_TABLE))
+
+    def _del_tproxy(self):
+        self._iptables("D")
+        os.system("ip rule del fwmark " + hex(PEP_MARK) + "/" + hex(PEP_MARK) + " lookup " + str(PEP_TABLE))
+        os.system("ip route del local 0.0.0.0/0 dev lo table " + str(PEP_TABLE))
+
+
+    def open(self):
+        self._sel = selectors.DefaultSelector()
+
+        self._listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listen.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+        self._listen.bind(("0.0.0.0", self._port))
+        self._listen.listen(16)
+        self._listen.setblocking(False)
+        self._sel.register(self._listen, selectors.EVENT_READ, None)
+
+        self._relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._relay.bind((self._ipAddress, self._relayPort))
+        self._relay.setblocking(False)
+        self._sel.register(self._relay, selectors.EVENT_READ, None)
+
+        self._sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self._add_tproxy()
+
+
+    def close(self):
+        self._del_tproxy()
+        for c in list(self._conns.values()):
+            self._abort(c, bSendRst=True)
+        self._sel.close()
+        self._listen.close()
+        self._relay.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+    def run(self):
+        self.log.debug(self._name + ":Starting")
+        try:
+            self.open()
+        except OSError as e:
+            self.log.error("%s:Unable to start PEP: %s" % (self._name, str(e)))
+            return
+
+        self._isRunning = True
+        while self._isRunning:
+            for key, mask in self._sel.select(self._next_timeout(time.monotonic())):
+                if key.fileobj is self._listen:
+                    self._accept()
+                elif key.fileobj is self._relay:
+                    self._recv_relay()
+                elif key.fileobj == self._wake_r:
+                    os.read(self._wake_r, 64)
+                else:
+                    self._on_local(key.data, mask)
+            self._on_timers(time.monotonic())
+
+        self.close()
+        self.log.debug(self._name + ":End")
+
+
+    def stop(self):
+        self._isRunning = False
+        os.write(self._wake_w, b"s")
+
+
+
+
+    """
+    Local TCP side
+    """
+    def _accept(self):
+        try:
+            sock, src = self._listen.accept()
+        except OSError:
+            return
+        # transparent socket: local address is original destination
+        dst = sock.getsockname()
+        peer_ip = self._resolve(struct.unpack("!I", socket.inet_aton(dst[0]))[0])
+        if peer_ip is None or len(self._conns) >= PEP_MAX_CONNS:
+            self.log.warning("%s:No LoRa gateway for %s (or too many connections)" % (self._name, dst[0]))
+            self._reset_sock(sock)
+            return
+
+        sock.setblocking(False)
+        self._nextId = (self._nextId + 1) & 0xffff
+        now = time.monotonic()
+        c = _PepConn((peer_ip, self._nextId, True), sock, peer_ip, True, now)
+        c.dst = dst
+        self._conns[c.key] = c
+        self.nb_conns += 1
+        self.log.debug("%s:%s:%d => %s:%d via %s" % (self._name, src[0], src[1], dst[0], dst[1], peer_ip))
+
+        # OPEN now: remote connect overlaps with first request of client
+        self._send_msg(c, c.snd_nxt, b"", 0)
+        c.t_rto = now + c.rto
+        self._update_events(c)
+
+
+    def _reset_sock(self, sock):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        except OSError:
+            pass
+        sock.close()
+
+
+    def _update_events(self, c):
+        if c.bClosed:
+            return
+        events = 0
+        if not c.bConnected:
+            events = selectors.EVENT_WRITE
+        else:
+            if not c.bLocalEof and len(c.snd_buf) < c.snd_wnd:
+                events |= selectors.EVENT_READ
+            if len(c.out_buf) > 0:
+                events |= selectors.EVENT_WRITE
+
+        if events == c.events:
+            return
+        if c.events == 0:
+            self._sel.register(c.sock, events, c)
+        elif events == 0:
+            self._sel.unregister(c.sock)
+        else:
+            self._sel.modify(c.sock, events, c)
+        c.events = events
+
+
+    def _on_local(self, c, mask):
+        now = time.monotonic()
+        c.t_last = now
+
+        if not c.bConnected:
+            err = c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                self.log.debug("%s:connect to %s failed: %s" % (self._name, c.dst, os.strerror(err)))
+                self._abort(c, bSendRst=True)
+                return
+            c.bConnected = True
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = c.sock.recv(max(1, c.snd_wnd - len(c.snd_buf)))
+            except BlockingIOError:
+                data = None
+            except OSError:
+                self._abort(c, bSendRst=True)
+                return
+            if data is not None:
+                if len(data) == 0:
+                    c.bLocalEof = True
+                else:
+                    c.snd_buf += data
+                    self.nb_bytes_up += len(data)
+
+        if mask & selectors.EVENT_WRITE and len(c.out_buf) > 0:
+            try:
+                n = c.sock.send(c.out_buf)
+                del c.out_buf[:n]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._abort(c, bSendRst=True)
+                return
+
+        self._flush_local(c)
+        self._output(c, now)
+        self._update_events(c)
+
+
+
+
+    """
+    Relay side
+    """
+    def _send_msg(self, c, seq, data, flags):
+        if c.bInit:
+            flags |= FLAG_INIT
+            if not c.bOpened:
+                flags |= FLAG_OPEN
+        msg = _HDR.pack(flags, c.conn_id, seq & SEQ_MASK, c.rcv_nxt & SEQ_MASK, min(c.rcv_wnd(), 0xffff))
+        if flags & FLAG_OPEN:
+            msg += _OPEN.pack(socket.inet_aton(c.dst[0]), c.dst[1])
+        try:
+            self._relay.sendto(msg + data, (c.peer_ip, self._relayPort))
+        except OSError as e:
+            self.nb_errors += 1
+            self.log.debug("%s:relay send failed: %s" % (self._name, str(e)))
+            return
+        self.nb_relay_tx += 1
+        c.t_ack = None
+
+
+    """
+    Send new data (window permitting), FIN and delayed ACK
+    """
+    def _output(self, c, now):
+        if c.bClosed:
+            return
+        bSent = False
+        while True:
+            off = c.inflight()
+            avail = len(c.snd_buf) - off
+            room = min(PEP_WINDOW, c.snd_wnd) - off
+            n = min(avail, room, self._segmentSz)
+            if n <= 0:
+                break
+            bFin = c.bLocalEof and n == avail
+            flags = 0
+            if bFin:
+                flags = FLAG_FIN
+            self._send_msg(c, c.snd_nxt, bytes(c.snd_buf[off:off + n]), flags)
+            if c.rtt_seq is None:
+                c.rtt_seq = (c.snd_nxt + n) & SEQ_MASK
+                c.t_rtt = now
+            c.snd_nxt = (c.snd_nxt + n) & SEQ_MASK
+            if bFin:
+                c.snd_nxt = (c.snd_nxt + 1) & SEQ_MASK
+                c.bFinSent = True
+            bSent = True
+
+        if c.bLocalEof and not c.bFinSent and len(c.snd_buf) == c.inflight():
+            self._send_msg(c, c.snd_nxt, b"", FLAG_FIN)
+            c.snd_nxt = (c.snd_nxt + 1) & SEQ_MASK
+            c.bFinSent = True
+            bSent = True
+
+        if bSent and c.t_rto is None:
+            c.t_rto = now + c.rto
+        if c.t_ack is not None and now >= c.t_ack:
+            self._send_msg(c, c.snd_nxt, b"", 0)
+
+
+    def _recv_relay(self):
+        while True:
+            try:
+                msg, addr = self._relay.recvfrom(0x10000)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.nb_errors += 1
+                return
+            if len(msg) < _HDR.size:
+                continue
+            self.nb_relay_rx += 1
+            self._on_msg(addr[0], msg)
+
+
+    def _on_msg(self, peer_ip, msg):
+        flags, conn_id, seq, ack, wnd = _HDR.unpack_from(msg, 0)
+        data = memoryview(msg)[_HDR.size:]
+        now = time.monotonic()
+
+        key = (peer_ip, conn_id, not (flags & FLAG_INIT))
+        c = self._conns.get(key)
+        if flags & FLAG_RST:
+            if c is not None:
+                self._abort(c, bSendRst=False)
+            return
+
+        if flags & FLAG_OPEN:
+            if len(data) < _OPEN.size:
+                return
+            dst_ip, dst_port = _OPEN.unpack_from(data, 0)
+            data = data[_OPEN.size:]
+            if c is None:
+                c = self._connect(key, peer_ip, (socket.inet_ntoa(dst_ip), dst_port), now)
+                if c is None:
+                    return
+        if c is None:
+            # unknown connection (gateway restarted...)
+            try:
+                self._relay.sendto(_HDR.pack(FLAG_RST | (0 if key[2] else FLAG_INIT), conn_id, 0, 0, 0),
+                                   (peer_ip, self._relayPort))
+            except OSError as e:
+                self.nb_errors += 1
+                self.log.debug("%s:relay send failed: %s" % (self._name, str(e)))
+            return
+
+        c.t_last = now
+        c.bOpened = True
+        self._on_ack(c, ack, wnd, len(data) == 0 and not flags & FLAG_FIN, now)
+        self._on_data(c, seq, data, flags & FLAG_FIN, now)
+        if flags & FLAG_OPEN and c.t_ack is None:
+            # OPEN has no sequence number: ACK it (initiator stops resending it)
+            c.t_ack = now + PEP_ACK_DELAY
+        self._flush_local(c)
+        self._output(c, now)
+        self._update_events(c)
+        self._check_done(c)
+
+
+    def _connect(self, key, peer_ip, dst, now):
+        if len(self._conns) >= PEP_MAX_CONNS:
+            return None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(dst)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.log.debug("%s:connect to %s failed: %s" % (self._name, dst, str(e)))
+            sock.close()
+            return None
+        c = _PepConn(key, sock, peer_ip, False, now)
+        c.dst = dst
+        self._conns[key] = c
+        self.nb_conns += 1
+        self.log.debug("%s:relay from %s => %s:%d" % (self._name, peer_ip, dst[0], dst[1]))
+        self._update_events(c)
+        return c
+
+
+    def _on_ack(self, c, ack, wnd, bPureAck, now):
+        c.snd_wnd = wnd
+        acked = _seq_diff(ack, c.snd_una)
+        if acked == 0 and bPureAck and c.inflight() > 0:
+            # peer received data after a hole: resend it without waiting RTO
+            c.dup_acks += 1
+            if c.dup_acks == PEP_DUP_ACKS:
+                self._retransmit(c)
+                c.rtt_seq = None
+            return
+        if acked == 0 and c.inflight() == 0:
+            # peer answered OPEN and nothing is in flight: nothing to resend
+            c.retries = 0
+            c.t_rto = None
+            return
+        if acked <= 0 or acked > c.inflight():
+            return
+        c.dup_acks = 0
+
+        # FIN uses one sequence number
+        nb_data = min(acked, len(c.snd_buf))
+        del c.snd_buf[:nb_data]
+        if c.bFinSent and ack == c.snd_nxt:
+            c.bFinAcked = True
+        c.snd_una = ack
+
+        if c.rtt_seq is not None and _seq_diff(ack, c.rtt_seq) >= 0:
+            rtt = now - c.t_rtt
+            if c.srtt is None:
+                c.srtt = rtt
+            else:
+                c.srtt = 0.875 * c.srtt + 0.125 * rtt
+            c.rtt_seq = None
+        c.rto = PEP_RTO_INIT
+        if c.srtt is not None:
+            c.rto = min(PEP_RTO_MAX, max(PEP_RTO_MIN, 2 * c.srtt))
+        c.retries = 0
+        c.t_rto = None
+        if c.inflight() > 0:
+            c.t_rto = now + c.rto
+
+
+    def _on_data(self, c, seq, data, bFin, now):
+        if len(data) == 0 and not bFin:
+            return
+
+        d = _seq_diff(seq, c.rcv_nxt)
+        if d > 0:
+            # out of order: keep it (bounded) and ACK at once (peer resends hole)
+            if seq not in c.ooo and len(data) <= c.rcv_wnd():
+                c.ooo[seq] = (bytes(data), bFin)
+                c.ooo_sz += len(data)
+            c.t_ack = now
+            return
+        if d + len(data) < 0 or (d + len(data) == 0 and not bFin):
+            # duplicate: ACK was lost
+            c.t_ack = now
+            return
+
+        self._deliver(c, data[-d:] if d < 0 else data, bFin)
+        while c.rcv_nxt in c.ooo:
+            data, bFin = c.ooo.pop(c.rcv_nxt)
+            c.ooo_sz -= len(data)
+            self._deliver(c, data, bFin)
+
+        if c.t_ack is None:
+            c.t_ack = now + PEP_ACK_DELAY
+
+
+    def _deliver(self, c, data, bFin):
+        if c.bPeerFin:
+            return
+        c.out_buf += data
+        self.nb_bytes_down += len(data)
+        c.rcv_nxt = (c.rcv_nxt + len(data)) & SEQ_MASK
+        if bFin:
+            c.rcv_nxt = (c.rcv_nxt + 1) & SEQ_MASK
+            c.bPeerFin = True
+
+
+    """
+    Write received data on local socket, close its write side after peer FIN
+    """
+    def _flush_local(self, c):
+        if c.bClosed or not c.bConnected:
+            return
+        if len(c.out_buf) > 0:
+            try:
+                n = c.sock.send(c.out_buf)
+                del c.out_buf[:n]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._abort(c, bSendRst=True)
+                return
+        if c.bPeerFin and len(c.out_buf) == 0:
+            try:
+                c.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+
+    def _check_done(self, c):
+        if c.bClosed:
+            return
+        if c.bFinAcked and c.bPeerFin and len(c.out_buf) == 0:
+            if c.t_ack is not None:
+                self._send_msg(c, c.snd_nxt, b"", 0)
+            self._close_conn(c)
+
+
+    def _close_conn(self, c):
+        c.bClosed = True
+        if c.events != 0:
+            self._sel.unregister(c.sock)
+        c.sock.close()
+        self._conns.pop(c.key, None)
+
+
+    def _abort(self, c, bSendRst):
+        if c.bClosed:
+            return
+        if bSendRst:
+            self._send_msg(c, c.snd_nxt, b"", FLAG_RST)
+        if c.events != 0:
+            self._sel.unregister(c.sock)
+            c.events = 0
+        self._reset_sock(c.sock)
+        c.bClosed = True
+        self._conns.pop(c.key, None)
+
+
+
+
+    """
+    Timers: retransmission, delayed ACK, idle connections
+    """
+    def _next_timeout(self, now):
+        t = None
+        for c in self._conns.values():
+            for d in (c.t_rto, c.t_ack):
+                if d is not None and (t is None or d < t):
+                    t = d
+        if t is None:
+            return 1.0
+        return min(1.0, max(0.0, t - now))
+
+
+    def _on_timers(self, now):
+        for c in list(self._conns.values()):
+            if now - c.t_last > PEP_IDLE_TIMEOUT:
+                self._abort(c, bSendRst=True)
+                continue
+
+            if c.t_rto is not None and now >= c.t_rto:
+                c.retries += 1
+                if c.retries > PEP_MAX_RETRIES:
+                    self.log.debug("%s:connection %d: too many retransmissions" % (self._name, c.conn_id))
+                    self._abort(c, bSendRst=True)
+                    continue
+                self._retransmit(c)
+                c.rto = min(PEP_RTO_MAX, c.rto * 2)
+                c.t_rto = now + c.rto
+                # Karn: no RTT sample from retransmitted data
+                c.rtt_seq = None
+
+            self._output(c, now)
+            self._check_done(c)
+
+
+    """
+    Resend first unacked segment (or OPEN/FIN alone)
+    """
+    def _retransmit(self, c):
+        self.nb_retransmits += 1
+        n = min(len(c.snd_buf), self._segmentSz)
+        flags = 0
+        if c.bFinSent and n == len(c.snd_buf):
+            flags = FLAG_FIN
+        self._send_msg(c, c.snd_una, bytes(c.snd_buf[:n]), flags)
+
+
+    def get_stats(self):
+        return {
+            "pep_conns": len(self._conns),
+            "pep_conns_total": self.nb_conns,
+            "pep_relay_tx": self.nb_relay_tx,
+            "pep_relay_rx": self.nb_relay_rx,
+            "pep_retransmits": self.nb_retransmits,
+            "pep_bytes_up": self.nb_bytes_up,
+            "pep_bytes_down": self.nb_bytes_down,
+            "pep_errors": self.nb_errors,
+        }
@@ -0,0 +1,177 @@
+import ctypes
+import ctypes.util
+import os
+import socket
+
+
+# max number of frames sent with one sendmmsg call
+MAX_BATCH = 32
+
+
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_uint8 * 4),
+                ("sin_zero", ctypes.c_uint8 * 8)]
+
+
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        f = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    f.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    f.restype = ctypes.c_int
+    return f
+
+
+
+
+"""
+Long-lived raw socket (IP_HDRINCL) used to inject IP frames received on LoRa
+in the IP stack.
+Several frames are sent with one sendmmsg call (if available in libc).
+Errors are counted, never raised to caller.
+"""
+class RawInjector():
+    def __init__(self, log=None, name="RawInjector"):
+        self.log = log
+        self._name = name
+        self._sock = None
+        self._sendmmsg = _load_sendmmsg()
+
+        # preallocated message headers of one batch
+        self._msgs = (_mmsghdr * MAX_BATCH)()
+        self._iovs = (_iovec * MAX_BATCH)()
+        self._addrs = (_sockaddr_in * MAX_BATCH)()
+        for i in range(MAX_BATCH):
+            self._addrs[i].sin_family = socket.AF_INET
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(ctypes.byref(self._addrs[i]), ctypes.c_void_p)
+            hdr.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+        self.nb_sent = 0
+        self.nb_batches = 0
+        self.nb_errors = 0
+        self.nb_dropped = 0
+
+
+    def open(self):
+        if self._sock is not None:
+            return
+        try:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+            self._sock.setsockopt(socket.SOL_IP, socket.IP_HDRINCL, 1)
+        except OSError as e:
+            self.log.error("%s:open:Failed to open raw socket: %s" % (self._name, str(e)))
+            self._sock = None
+
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+    """
+    Send IP frames
+    frames: list of (data, ip_dst) - ip_dst as 4 bytes (network order)
+    Return number of frames sent
+    """
+    def send_frames(self, frames):
+        if self._sock is None:
+            self.open()
+            if self._sock is None:
+                self.nb_errors += 1
+                self.nb_dropped += len(frames)
+                return 0
+
+        nb = 0
+        i = 0
+        while i < len(frames):
+            batch = frames[i:i + MAX_BATCH]
+            if self._sendmmsg is not None and len(batch) > 1:
+                nb += self._send_batch(batch)
+            else:
+                for data, ip_dst in batch:
+                    nb += self._send_one(data, ip_dst)
+            i += MAX_BATCH
+
+        return nb
+
+
+    def _send_one(self, data, ip_dst):
+        try:
+            self._sock.sendto(data, (socket.inet_ntoa(ip_dst), 0))
+        except OSError as e:
+            self.nb_errors += 1
+            self.nb_dropped += 1
+            self.log.debug("%s:send:Failed to inject frame: %s" % (self._name, str(e)))
+            return 0
+        self.nb_sent += 1
+        return 1
+
+
+    def _send_batch(self, batch):
+        # keep references on buffers until sendmmsg returns
+        bufs = []
+        for j, (data, ip_dst) in enumerate(batch):
+            buf = ctypes.create_string_buffer(bytes(data), len(data))
+            bufs.append(buf)
+            self._iovs[j].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            self._iovs[j].iov_len = len(data)
+            ctypes.memmove(self._addrs[j].sin_addr, ip_dst, 4)
+
+        nb = 0
+        j = 0
+        while j < len(batch):
+            r = self._sendmmsg(self._sock.fileno(), ctypes.byref(self._msgs[j]), len(batch) - j, 0)
+            self.nb_batches += 1
+            if r <= 0:
+                # frame j is rejected by kernel: drop it and continue with following frames
+                self.nb_errors += 1
+                self.nb_dropped += 1
+                self.log.debug("%s:send:sendmmsg failed: %s" % (self._name, os.strerror(ctypes.get_errno())))
+                j += 1
+                continue
+            nb += r
+            j += r
+
+        self.nb_sent += nb
+        return nb
+
+
+    def get_stats(self):
+        return {
+            "inject_sent": self.nb_sent,
+            "inject_batches": self.nb_batches,
+            "inject_errors": self.nb_errors,
+            "inject_dropped": self.nb_dropped,
+        }
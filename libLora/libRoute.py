@@ -0,0 +1,188 @@
+import threading
+import select
+import socket
+import struct
+import pyroute2
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE, RTMGRP_NEIGH
+
+
+# max number of destinations in cache (cache is flushed when full)
+MAX_CACHE_SZ = 4096
+
+INVALIDATE_EVENTS = ("RTM_NEWROUTE", "RTM_DELROUTE", "RTM_NEWNEIGH", "RTM_DELNEIGH")
+
+
+
+
+"""
+Cache of destination IP => LoRa address
+Neighbours (mac) of LoRa interface are loaded once from netlink,
+gateway of each destination is asked once to kernel (persistent netlink socket).
+Cache is invalidated on route/neighbour netlink events.
+"""
+class LoraRouteCache(threading.Thread):
+    def __init__(self, iface, mac2lora, log=None):
+        threading.Thread.__init__(self)
+        self._name = "LoraRouteCache"
+        self._iface = iface
+        self._mac2lora = mac2lora
+        self.log = log
+        self._isRunning = False
+
+        self._ipr = None
+        self._ipr_mon = None
+        self._ipr_lock = threading.Lock()
+        self._ifindex = None
+        self._neighbours = {}   # ip => mac
+        self._cache = {}        # ip (int) => LoRa address (or None)
+
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_reloads = 0
+
+
+    """
+    Load neighbours of LoRa interface
+    """
+    def _load_neighbours(self):
+        neighbours = {}
+        with self._ipr_lock:
+            idx = self._ipr.link_lookup(ifname=self._iface)
+            if len(idx) == 0:
+                self.log.warning("%s:Interface %s not found" % (self._name, self._iface))
+                self._ifindex = None
+            else:
+                self._ifindex = idx[0]
+                for n in self._ipr.get_neighbours(ifindex=idx[0], family=socket.AF_INET):
+                    ip = n.get_attr("NDA_DST")
+                    mac = n.get_attr("NDA_LLADDR")
+                    if ip is not None and mac is not None:
+                        neighbours[ip] = mac
+
+        self._neighbours = neighbours
+        self._cache = {}
+        self.nb_reloads += 1
+
+
+    """
+    Get gateway of destination (None if destination is on link)
+    """
+    def _get_gateway(self, ip_dst):
+        with self._ipr_lock:
+            try:
+                m = self._ipr.route("get", dst=ip_dst)[0]
+            except Exception as e:
+                self.log.debug("%s:route get %s failed: %s" % (self._name, ip_dst, str(e)))
+                return None
+        return m.get_attr("RTA_GATEWAY")
+
+
+    def _resolve(self, ip_dst):
+        ip_gw = self._get_gateway(ip_dst)
+        if ip_gw is None:
+            ip_gw = ip_dst
+
+        mac_dst = self._neighbours.get(ip_gw)
+        if mac_dst is None:
+            self.log.warning("%s:Unable to get mac address for %s" % (self._name, ip_gw))
+            return None
+
+        return self._mac2lora(mac_dst)
+
+
+    """
+    Get LoRa address of destination
+    ip_dst: IPv4 address as int
+    Return None if destination is not reachable on LoRa network
+    """
+    def lookup(self, ip_dst):
+        cache = self._cache
+        if ip_dst in cache:
+            self.nb_hits += 1
+            return cache[ip_dst]
+
+        self.nb_misses += 1
+        addrLora = self._resolve(socket.inet_ntoa(struct.pack("!I", ip_dst)))
+        if len(cache) >= MAX_CACHE_SZ:
+            cache.clear()
+        cache[ip_dst] = addrLora
+        return addrLora
+
+
+    def open(self):
+        self._ipr = pyroute2.IPRoute()
+        self._load_neighbours()
+
+
+    """
+    Subscribe to route/neighbour netlink events
+    Return fd to wait on
+    """
+    def open_monitor(self):
+        self._ipr_mon = pyroute2.IPRoute()
+        self._ipr_mon.bind(groups=RTMGRP_IPV4_ROUTE | RTMGRP_NEIGH)
+        return self._ipr_mon.fileno()
+
+
+    """
+    Is netlink event about LoRa interface (neighbour ifindex or route output interface)
+    Any event is relevant while LoRa interface is not found
+    """
+    def _is_lora_event(self, msg):
+        if self._ifindex is None:
+            return True
+        if msg.get("event") in ("RTM_NEWNEIGH", "RTM_DELNEIGH"):
+            return msg.get("ifindex") == self._ifindex
+        return msg.get_attr("RTA_OIF") == self._ifindex
+
+
+    """
+    Read pending netlink events and invalidate cache if needed
+    Events of other interfaces are ignored (no neighbour dump on the event loop
+    for each change on host interfaces)
+    """
+    def process_events(self):
+        bInvalidate = False
+        for msg in self._ipr_mon.get():
+            if msg.get("event") in INVALIDATE_EVENTS and self._is_lora_event(msg):
+                bInvalidate = True
+
+        if bInvalidate:
+            self.log.debug("%s:route/neighbour change => reload" % self._name)
+            self._load_neighbours()
+
+
+    def close(self):
+        if self._ipr_mon is not None:
+            self._ipr_mon.close()
+            self._ipr_mon = None
+        with self._ipr_lock:
+            self._ipr.close()
+
+
+    def run(self):
+        self.log.debug(self._name + ":Starting")
+
+        mon_fd = self.open_monitor()
+
+        self._isRunning = True
+        while self._isRunning:
+            r, _, _ = select.select([mon_fd], [], [], 0.5)
+            if len(r) > 0:
+                self.process_events()
+
+        self.close()
+        self.log.debug(self._name + ":End")
+
+
+    def stop(self):
+        self._isRunning = False
+
+
+    def get_stats(self):
+        return {
+            "route_cache_sz": len(self._cache),
+            "route_cache_hits": self.nb_hits,
+            "route_cache_misses": self.nb_misses,
+            "route_cache_reloads": self.nb_reloads,
+        }
@@ -0,0 +1,613 @@
+import threading
+import collections
+import time
+import math
+
+from libLora import libDevice
+
+
+# default max number of LoRa envelopes waiting to be sent
+TX_QUEUE_LEN = 64
+
+"""
+Drop policies when TX queue is full
+"""
+DROP_TAIL = "tail"     # new data is dropped
+DROP_HEAD = "head"     # oldest data is dropped (fresh data is more useful on a slow link)
+
+DROP_POLICIES = (DROP_TAIL, DROP_HEAD)
+
+"""
+Queue disciplines
+"""
+DISC_FIFO = "fifo"
+DISC_FQ_CODEL = "fq_codel"
+
+DISCIPLINES = (DISC_FIFO, DISC_FQ_CODEL)
+
+# CoDel defaults, scaled for LoRa (one 255 bytes frame is ~0.4s at SF7/125kHz)
+CODEL_TARGET = 1.0       # (s) acceptable standing queue delay
+CODEL_INTERVAL = 10.0    # (s) window to observe a standing queue delay
+FQ_QUANTUM = 256         # (bytes) sent by a flow on each round
+FQ_FLOWS = 1024          # number of flow buckets
+
+
+
+
+"""
+Bounded TX queue between packet encoding (NFQUEUE callback) and radio
+put() never blocks: callers get a verdict on their packet immediately.
+Consumers wait with get() (thread) or use pop() (event loop).
+Queue delay is time between put and get.
+Queued data put with a supersede key is replaced in place by next data put with
+the same key (ex: TCP ACK thinning) until it is dequeued.
+Entries are [data, enqueue time, supersede key, flow, cls]: consumers get (data, flow, cls).
+An optional gate holds data back (airtime budget, see set_gate).
+"""
+class TxQueue():
+    def __init__(self, maxLen=TX_QUEUE_LEN, dropPolicy=DROP_TAIL):
+        if maxLen < 1:
+            raise ValueError("Invalid TX queue length")
+        if dropPolicy not in DROP_POLICIES:
+            raise ValueError("Invalid TX queue drop policy: %s" % dropPolicy)
+
+        self._maxLen = maxLen
+        self._dropPolicy = dropPolicy
+        self._queue = collections.deque()
+        self._len = 0
+        self._cond = threading.Condition()
+        self._supersede = {}    # supersede key => queued entry
+        self._gate = None
+
+        self.nb_enqueued = 0
+        self.nb_dropped = 0
+        self.nb_superseded = 0
+        self.max_len = 0
+        self._delay = libDevice.LatencyStats()
+
+
+    def __len__(self):
+        return self._len
+
+
+    """
+    Queue data to send
+    flow: key of flow of data (used by fair queueing disciplines)
+    cls: traffic class of data (used by priority queue)
+    supersede: key of data replaced by next data of same key (None: never replaced)
+    Return False if data (or older data) is dropped
+    """
+    def put(self, data, flow=None, cls=0, supersede=None):
+        with self._cond:
+            nb_dropped = self.nb_dropped
+            if not self._enqueue(data, flow, time.monotonic(), cls, supersede):
+                return False
+            self.nb_enqueued += 1
+            if self._len > self.max_len:
+                self.max_len = self._len
+            self._cond.notify()
+            return self.nb_dropped == nb_dropped
+
+
+    """
+    Store data (lock is held)
+    Return False if data is not stored
+    """
+    def _enqueue(self, data, flow, now, cls=0, supersede=None):
+        if self._try_supersede(data, supersede) is not None:
+            return True
+        if self._len >= self._maxLen:
+            self.nb_dropped += 1
+            if self._dropPolicy == DROP_TAIL:
+                return False
+            self._removed(self._queue.popleft())
+            self._len -= 1
+
+        self._queue.append(self._new_entry(data, now, supersede, flow, cls))
+        self._len += 1
+        return True
+
+
+    def _new_entry(self, data, now, supersede, flow, cls):
+        entry = [data, now, supersede, flow, cls]
+        if supersede is not None:
+            self._supersede[supersede] = entry
+        return entry
+
+
+    """
+    Replace data of queued entry of same supersede key
+    Return replaced data (None if there is no such entry)
+    """
+    def _try_supersede(self, data, supersede):
+        if supersede is None:
+            return None
+        entry = self._supersede.get(supersede)
+        if entry is None:
+            return None
+        old = entry[0]
+        entry[0] = data
+        self.nb_superseded += 1
+        return old
+
+
+    """
+    Entry leaves queue (sent or dropped): it can not be superseded anymore
+    """
+    def _removed(self, entry):
+        if entry[2] is not None:
+            if self._supersede.get(entry[2]) is entry:
+                del self._supersede[entry[2]]
+            entry[2] = None
+
+
+    """
+    Get next (data, flow, cls) to send without waiting (None if queue is empty)
+    """
+    def pop(self):
+        with self._cond:
+            return self._pop()
+
+
+    """
+    Get next (data, flow, cls) to send
+    Wait until timeout (s) - Return None if no data is ready
+    """
+    def get(self, timeout=None):
+        with self._cond:
+            item = self._pop()
+            if item is None:
+                delay = self._ready_delay(time.monotonic())
+                if delay is None or (timeout is not None and delay > timeout):
+                    delay = timeout
+                self._cond.wait(delay)
+                item = self._pop()
+            return item
+
+
+    """
+    Set gate of queue: gate(cls, now) returns time (s) before data of traffic
+    class can be sent (0: now)
+    """
+    def set_gate(self, gate):
+        with self._cond:
+            self._gate = gate
+
+
+    def _gate_delay(self, cls, now):
+        if self._gate is None:
+            return 0
+        return self._gate(cls, now)
+
+
+    """
+    Time (s) before queued data can be sent (None if queue is empty)
+    """
+    def ready_delay(self):
+        with self._cond:
+            return self._ready_delay(time.monotonic())
+
+
+    def _ready_delay(self, now):
+        if self._len == 0:
+            return None
+        return self._gate_delay(0, now)
+
+
+    def _pop(self):
+        if self._len == 0:
+            return None
+        now = time.monotonic()
+        if self._gate_delay(0, now) > 0:
+            return None
+        item = self._dequeue(now)
+        if item is None:
+            return None
+        self._delay.add(now - item[1])
+        return item[0], item[3], item[4]
+
+
+    """
+    Get next (data, enqueue time) to send (lock is held)
+    """
+    def _dequeue(self, now):
+        self._len -= 1
+        item = self._queue.popleft()
+        self._removed(item)
+        return item
+
+
+    """
+    Wake up consumers waiting in get()
+    """
+    def wakeup(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+    def get_stats(self):
+        stats = {
+            "tx_queue_len": self._len,
+            "tx_queue_max_len": self.max_len,
+            "tx_queue_enqueued": self.nb_enqueued,
+            "tx_queue_dropped": self.nb_dropped,
+            "tx_queue_superseded": self.nb_superseded,
+        }
+        stats.update(self._delay.get_stats("tx_queue"))
+        return stats
+
+
+
+
+class _FqFlow():
+    __slots__ = ("queue", "backlog", "deficit", "active", "first_above_time", "drop_next", "count", "lastcount", "dropping")
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.backlog = 0              # bytes
+        self.deficit = 0
+        self.active = False           # in new or old flows list
+        # CoDel state
+        self.first_above_time = 0.0
+        self.drop_next = 0.0
+        self.count = 0
+        self.lastcount = 0
+        self.dropping = False
+
+
+
+
+"""
+FQ-CoDel TX queue (RFC 8290)
+Data is hashed per flow (flow key includes destination LoRa address) in buckets
+served by deficit round robin: a bulk flow can not delay small flows (Modbus polls,
+ACKs...) and frames to an unreachable or slow peer do not block others peers.
+Each bucket runs CoDel on sojourn time: stale data is dropped before radio instead
+of spending airtime on it.
+When queue is full, head data of the fattest bucket is dropped.
+"""
+class FqCodelQueue(TxQueue):
+    def __init__(self, maxLen=TX_QUEUE_LEN, target=CODEL_TARGET, interval=CODEL_INTERVAL,
+                 quantum=FQ_QUANTUM, nbFlows=FQ_FLOWS):
+        TxQueue.__init__(self, maxLen=maxLen)
+        if target <= 0 or interval <= 0 or quantum < 1 or nbFlows < 1:
+            raise ValueError("Invalid FQ-CoDel parameters")
+
+        self._target = target
+        self._interval = interval
+        self._quantum = quantum
+        self._nbFlows = nbFlows
+        self._flows = {}            # bucket => _FqFlow
+        self._new_flows = collections.deque()
+        self._old_flows = collections.deque()
+
+        self.nb_codel_dropped = 0
+        self.nb_overflow_dropped = 0
+
+
+    def _get_flow(self, flow):
+        bucket = hash(flow) % self._nbFlows
+        f = self._flows.get(bucket)
+        if f is None:
+            f = _FqFlow()
+            self._flows[bucket] = f
+        return f
+
+
+    def _enqueue(self, data, flow, now, cls=0, supersede=None):
+        old = self._try_supersede(data, supersede)
+        if old is not None:
+            self._get_flow(flow).backlog += len(data) - len(old)
+            return True
+        f = self._get_flow(flow)
+        f.queue.append(self._new_entry(data, now, supersede, flow, cls))
+        f.backlog += len(data)
+        self._len += 1
+        if not f.active:
+            f.active = True
+            f.deficit = self._quantum
+            self._new_flows.append(f)
+
+        if self._len > self._maxLen:
+            fat = max(self._flows.values(), key=lambda x: x.backlog)
+            self._drop_head(fat)
+            self.nb_overflow_dropped += 1
+            if fat is f and len(f.queue) == 0:
+                return False
+        return True
+
+
+    def _drop_head(self, f):
+        entry = f.queue.popleft()
+        self._removed(entry)
+        f.backlog -= len(entry[0])
+        self._len -= 1
+        self.nb_dropped += 1
+        return entry[0]
+
+
+    def _control_law(self, t, count):
+        return t + self._interval / math.sqrt(count)
+
+
+    """
+    Dequeue head of flow and tell if CoDel allows to drop it
+    """
+    def _codel_do_dequeue(self, f, now):
+        if len(f.queue) == 0:
+            f.first_above_time = 0.0
+            return None, False
+
+        item = f.queue.popleft()
+        self._removed(item)
+        f.backlog -= len(item[0])
+        self._len -= 1
+
+        if now - item[1] < self._target or f.backlog <= self._quantum:
+            f.first_above_time = 0.0
+            return item, False
+
+        if f.first_above_time == 0.0:
+            f.first_above_time = now + self._interval
+            return item, False
+        return item, now >= f.first_above_time
+
+
+    def _codel_dequeue(self, f, now):
+        item, bOkToDrop = self._codel_do_dequeue(f, now)
+        if f.dropping:
+            if not bOkToDrop:
+                f.dropping = False
+            while f.dropping and item is not None and now >= f.drop_next:
+                self._codel_drop()
+                f.count += 1
+                item, bOkToDrop = self._codel_do_dequeue(f, now)
+                if not bOkToDrop:
+                    f.dropping = False
+                else:
+                    f.drop_next = self._control_law(f.drop_next, f.count)
+        elif bOkToDrop:
+            self._codel_drop()
+            item, bOkToDrop = self._codel_do_dequeue(f, now)
+            f.dropping = True
+            delta = f.count - f.lastcount
+            if delta > 1 and now - f.drop_next < 16 * self._interval:
+                f.count = delta
+            else:
+                f.count = 1
+            f.drop_next = self._control_law(now, f.count)
+            f.lastcount = f.count
+        return item
+
+
+    def _codel_drop(self):
+        self.nb_dropped += 1
+        self.nb_codel_dropped += 1
+
+
+    def _dequeue(self, now):
+        while True:
+            if len(self._new_flows) > 0:
+                flows = self._new_flows
+            elif len(self._old_flows) > 0:
+                flows = self._old_flows
+            else:
+                return None
+
+            f = flows[0]
+            if f.deficit <= 0:
+                f.deficit += self._quantum
+                flows.popleft()
+                self._old_flows.append(f)
+                continue
+
+            item = self._codel_dequeue(f, now)
+            if item is None:
+                flows.popleft()
+                # an emptied new flow goes once in old flows (avoid starvation of old flows)
+                if flows is self._new_flows and len(self._old_flows) > 0:
+                    self._old_flows.append(f)
+                else:
+                    f.active = False
+                continue
+
+            f.deficit -= len(item[0])
+            return item
+
+
+    def get_stats(self):
+        stats = TxQueue.get_stats(self)
+        stats.update({
+            "tx_queue_flows": len(self._new_flows) + len(self._old_flows),
+            "tx_queue_codel_dropped": self.nb_codel_dropped,
+            "tx_queue_overflow_dropped": self.nb_overflow_dropped,
+        })
+        return stats
+
+
+
+
+class _TxClass():
+    __slots__ = ("name", "queue", "rate", "burst", "tokens", "t_update", "nb_sent_bytes")
+
+    def __init__(self, name, queue, rate, burst):
+        self.name = name
+        self.queue = queue
+        self.rate = rate          # bytes/s (0: no cap)
+        self.burst = burst
+        self.tokens = burst
+        self.t_update = time.monotonic()
+        self.nb_sent_bytes = 0
+
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.t_update) * self.rate)
+        self.t_update = now
+
+
+
+
+"""
+Strict priority TX queue
+classes: list of (name, queue, rate) by priority (first is the highest)
+    queue: TxQueue (own limit and discipline) used without its lock
+    rate: cap in bytes/s (0: no cap) - token bucket of burst bytes
+Data of a class is sent only when higher classes have no data ready.
+A class over its rate cap (or held by gate) lets lower classes send.
+"""
+class PriorityTxQueue(TxQueue):
+    def __init__(self, classes, burst=FQ_QUANTUM):
+        if len(classes) == 0:
+            raise ValueError("No traffic class")
+        maxLen = 0
+        for name, queue, rate in classes:
+            maxLen += queue._maxLen
+        TxQueue.__init__(self, maxLen=maxLen)
+        self._classes = [_TxClass(name, queue, rate, max(burst, rate)) for name, queue, rate in classes]
+
+
+    def _enqueue(self, data, flow, now, cls=0, supersede=None):
+        c = self._classes[cls]
+        n, nb_dropped, nb_superseded = len(c.queue), c.queue.nb_dropped, c.queue.nb_superseded
+        bQueued = c.queue._enqueue(data, flow, now, cls=cls, supersede=supersede)
+        if bQueued:
+            c.queue.nb_enqueued += 1
+            c.queue.max_len = max(c.queue.max_len, len(c.queue))
+        self._len += len(c.queue) - n
+        self.nb_dropped += c.queue.nb_dropped - nb_dropped
+        self.nb_superseded += c.queue.nb_superseded - nb_superseded
+        return bQueued
+
+
+    def _dequeue(self, now):
+        for cls, c in enumerate(self._classes):
+            if len(c.queue) == 0:
+                continue
+            c.refill(now)
+            if c.rate > 0 and c.tokens < 0:
+                continue
+            if cls > 0 and self._gate_delay(cls, now) > 0:
+                continue
+            n, nb_dropped = len(c.queue), c.queue.nb_dropped
+            item = c.queue._dequeue(now)
+            self._len += len(c.queue) - n
+            self.nb_dropped += c.queue.nb_dropped - nb_dropped
+            if item is None:
+                continue
+            c.queue._delay.add(now - item[1])
+            c.tokens -= len(item[0])
+            c.nb_sent_bytes += len(item[0])
+            return item
+        return None
+
+
+    def _ready_delay(self, now):
+        delay = None
+        for cls, c in enumerate(self._classes):
+            if len(c.queue) == 0:
+                continue
+            c.refill(now)
+            d = 0
+            if c.rate > 0 and c.tokens < 0:
+                d = -c.tokens / c.rate
+            d = max(d, self._gate_delay(cls, now))
+            if delay is None or d < delay:
+                delay = d
+        return delay
+
+
+    def get_stats(self):
+        stats = TxQueue.get_stats(self)
+        for c in self._classes:
+            for k, v in c.queue.get_stats().items():
+                stats[k.replace("tx_queue", "tx_class_" + c.name)] = v
+            stats["tx_class_" + c.name + "_sent_bytes"] = c.nb_sent_bytes
+        return stats
+
+
+
+
+"""
+Create TX queue of discipline
+"""
+def create_tx_queue(discipline=DISC_FQ_CODEL, maxLen=TX_QUEUE_LEN, dropPolicy=DROP_TAIL,
+                    target=CODEL_TARGET, interval=CODEL_INTERVAL, quantum=FQ_QUANTUM):
+    if discipline == DISC_FIFO:
+        return TxQueue(maxLen=maxLen, dropPolicy=dropPolicy)
+    if discipline == DISC_FQ_CODEL:
+        return FqCodelQueue(maxLen=maxLen, target=target, interval=interval, quantum=quantum)
+    raise ValueError("Invalid TX queue discipline: %s" % discipline)
+
+
+"""
+Create strict priority TX queue
+txClasses: list of dict by priority: {"name": str, "queue_len": int, "rate": bytes/s}
+Each class has its own queue of discipline
+"""
+def create_priority_tx_queue(txClasses, discipline=DISC_FQ_CODEL, maxLen=TX_QUEUE_LEN, dropPolicy=DROP_TAIL,
+                             target=CODEL_TARGET, interval=CODEL_INTERVAL, quantum=FQ_QUANTUM):
+    classes = []
+    for c in txClasses:
+        if "name" not in c:
+            raise ValueError("Traffic class without name: %s" % c)
+        queueLen = maxLen
+        if "queue_len" in c:
+            queueLen = c["queue_len"]
+        rate = 0
+        if "rate" in c:
+            rate = c["rate"]
+        if rate < 0:
+            raise ValueError("Invalid rate of traffic class %s" % c["name"])
+        queue = create_tx_queue(discipline=discipline, maxLen=queueLen, dropPolicy=dropPolicy,
+                                target=target, interval=interval, quantum=quantum)
+        classes.append((c["name"], queue, rate))
+    return PriorityTxQueue(classes, burst=quantum)
+
+
+
+
+"""
+TX scheduler thread
+Send data of TX queue on radio: send_func(data, flow, cls) handles airtime waits
+"""
+class TxScheduler(threading.Thread):
+    def __init__(self, txQueue, send_func, log=None, name="TxScheduler"):
+        threading.Thread.__init__(self)
+        self._name = name
+        self._txQueue = txQueue
+        self._send_func = send_func
+        self.log = log
+        self._isRunning = False
+
+        self.nb_sent = 0
+        self.nb_errors = 0
+
+
+    def run(self):
+        self.log.debug(self._name + ":Starting")
+        self._isRunning = True
+        while self._isRunning:
+            item = self._txQueue.get(timeout=0.5)
+            if item is None:
+                continue
+            try:
+                self._send_func(*item)
+            except Exception as e:
+                self.nb_errors += 1
+                self.log.error("%s:Error on send: %s" % (self._name, str(e)))
+                continue
+            self.nb_sent += 1
+        self.log.debug(self._name + ":End")
+
+
+    def stop(self):
+        self._isRunning = False
+        self._txQueue.wakeup()
+
+
+    def get_stats(self):
+        return {
+            "tx_sent": self.nb_sent,
+            "tx_errors": self.nb_errors,
+        }
@@ -0,0 +1,128 @@
+import zlib
+
+import pytest
+
+from libLora import libCompress
+
+
+def packets(n):
+    return [b"E\x00\x00\x30 modbus read holding registers unit 1 addr %d" % i for i in range(n)]
+
+
+def transfer(pkts, lost=(), epochLen=4):
+    c = libCompress.StreamCompressor(1, epochLen=epochLen)
+    d = libCompress.StreamDecompressor()
+    out = []
+    for i, pkt in enumerate(pkts):
+        z = c.compress(2, pkt)
+        if i in lost:
+            continue
+        try:
+            out.append(d.decompress(z))
+        except (ValueError, zlib.error):
+            out.append(None)
+    return out
+
+
+
+
+def test_stream_round_trip():
+    pkts = packets(20)
+    c = libCompress.StreamCompressor(1, epochLen=8)
+    d = libCompress.StreamDecompressor()
+    sizes = []
+    for pkt in pkts:
+        z = c.compress(2, pkt)
+        sizes.append(len(z))
+        assert d.decompress(z) == pkt
+    # next packets of an epoch use previous ones as dictionary
+    assert max(sizes[1:8]) < len(pkts[0]) // 2
+    assert c.get_stats()["zstream_tx_epochs"] == 3
+
+
+def test_stream_lost_packet_resync_on_next_epoch():
+    pkts = packets(12)
+    out = transfer(pkts, lost={1})
+    # rest of epoch 0 is dropped, epochs 1 and 2 are decoded
+    assert out == [pkts[0], None, None] + pkts[4:]
+
+
+def test_stream_reset_starts_new_epoch():
+    pkts = packets(6)
+    c = libCompress.StreamCompressor(1, epochLen=32)
+    d = libCompress.StreamDecompressor()
+    assert d.decompress(c.compress(2, pkts[0])) == pkts[0]
+    # not sent: receiver never sees it
+    c.compress(2, pkts[1])
+    c.reset(2)
+    z = c.compress(2, pkts[2])
+    assert z[1] == 0
+    assert d.decompress(z) == pkts[2]
+
+
+def test_stream_truncated_and_out_of_sync():
+    c = libCompress.StreamCompressor(1)
+    d = libCompress.StreamDecompressor()
+    with pytest.raises(ValueError):
+        d.decompress(b"\x10")
+    c.compress(2, b"first")
+    with pytest.raises(ValueError):
+        d.decompress(c.compress(2, b"second"))
+    assert d.get_stats()["zstream_rx_desync"] == 1
+
+
+def test_stream_discard_last():
+    pkts = packets(3)
+    c = libCompress.StreamCompressor(1)
+    d = libCompress.StreamDecompressor()
+    assert d.decompress(c.compress(2, pkts[0])) == pkts[0]
+    # envelope crc of this packet failed
+    d.decompress(c.compress(2, pkts[1]))
+    d.discard_last()
+    with pytest.raises(ValueError):
+        d.decompress(c.compress(2, pkts[2]))
+
+
+def test_stream_packet_too_large():
+    c = libCompress.StreamCompressor(1)
+    d = libCompress.StreamDecompressor(maxSz=16)
+    with pytest.raises(ValueError):
+        d.decompress(c.compress(2, b"x" * 64))
+
+
+def test_stream_invalid_epoch_length():
+    for epochLen in (0, libCompress.MAX_EPOCH_LEN + 1):
+        with pytest.raises(ValueError):
+            libCompress.StreamCompressor(1, epochLen=epochLen)
+
+
+def test_dict_round_trip():
+    dicts = [b"unrelated dictionary content" * 4, b" modbus read holding registers unit 1 addr " * 4]
+    c = libCompress.DictCompressor(dicts)
+    for pkt in packets(10):
+        z = c.compress(pkt)
+        # best dictionary is chosen
+        assert z[0] == 1
+        assert len(z) < len(pkt) // 2
+        assert c.decompress(z) == pkt
+
+
+def test_dict_bad_input():
+    c = libCompress.DictCompressor([b"dictionary"], maxSz=16)
+    with pytest.raises(ValueError):
+        c.decompress(b"")
+    with pytest.raises(ValueError):
+        c.decompress(b"\x05" + c.compress(b"data")[1:])
+    with pytest.raises(ValueError):
+        c.decompress(c.compress(b"x" * 64))
+    with pytest.raises(zlib.error):
+        c.decompress(b"\x00\xff\xff\xff")
+
+
+def test_dict_invalid_parameters():
+    with pytest.raises(ValueError):
+        libCompress.DictCompressor([])
+    with pytest.raises(ValueError):
+        libCompress.DictCompressor([b"x" * (libCompress.ZLIB_MAX_DICT_SZ + 1)])
+    with pytest.raises(ValueError):
+        libCompress.DictCompressor([b"dictionary"], codec="lz77")
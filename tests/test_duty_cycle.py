@@ -0,0 +1,96 @@
+import pytest
+
+from libLora import libDutyCycle
+
+
+CHANNEL = 868100000
+
+
+# 1% of a 100 s window: 1 s of airtime, 0.8 s for classes > 0
+def make_budget():
+    return libDutyCycle.AirtimeBudget(libDutyCycle.sub_bands(0.01), window=100.0, reserve=0.2)
+
+
+
+
+def test_sub_bands():
+    assert libDutyCycle.sub_bands("eu868") is libDutyCycle.EU868_SUB_BANDS
+    assert libDutyCycle.sub_bands(0.1) == [("all", 0, 0xffffffff, 0.1)]
+    for dutyCycle in ("us915", 0, 1.5):
+        with pytest.raises(ValueError):
+            libDutyCycle.sub_bands(dutyCycle)
+
+
+def test_eu868_limits():
+    budget = libDutyCycle.AirtimeBudget()
+    assert budget.limit(868100000) == pytest.approx(36.0)
+    assert budget.limit(869525000) == pytest.approx(360.0)
+    assert budget.limit(868800000) == pytest.approx(3.6)
+    with pytest.raises(ValueError):
+        budget.limit(870500000)
+
+
+def test_invalid_parameters():
+    with pytest.raises(ValueError):
+        libDutyCycle.AirtimeBudget(window=0)
+    with pytest.raises(ValueError):
+        libDutyCycle.AirtimeBudget(reserve=1)
+
+
+def test_reserve_of_priority_class():
+    budget = make_budget()
+    assert budget.limit(CHANNEL, 0) == pytest.approx(1.0)
+    assert budget.limit(CHANNEL, 1) == pytest.approx(0.8)
+
+    for i in range(7):
+        budget.charge(CHANNEL, 0.1, now=1000.0 + i)
+    # 0.7 s used: class 1 reaches its limit before class 0
+    assert budget.delay(CHANNEL, 0.1, 1, now=1010.0) == 0
+    assert budget.delay(CHANNEL, 0.2, 1, now=1010.0) == pytest.approx(90.0)
+    assert budget.delay(CHANNEL, 0.3, 0, now=1010.0) == 0
+
+
+def test_delay_until_oldest_leave_window():
+    budget = make_budget()
+    for i in range(8):
+        budget.charge(CHANNEL, 0.1, now=1000.0 + i)
+    # 0.3 s more needs 0.1 s freed: first transmission leaves window at 1100
+    assert budget.delay(CHANNEL, 0.3, 0, now=1010.0) == pytest.approx(90.0)
+    # 0.4 s needs two transmissions to leave
+    assert budget.delay(CHANNEL, 0.4, 0, now=1010.0) == pytest.approx(91.0)
+    # larger than budget: never
+    assert budget.delay(CHANNEL, 2.0, 0, now=1010.0) is None
+    # window elapsed: everything is available again
+    assert budget.delay(CHANNEL, 1.0, 0, now=1200.0) == 0
+
+
+def test_reserve_reject_and_delay_counters():
+    budget = make_budget()
+    for i in range(8):
+        budget.charge(CHANNEL, 0.1, now=1000.0 + i)
+
+    assert budget.reserve(CHANNEL, 0.3, 0, maxWait=10, now=1010.0) is None
+    # class 1 waits until 1102 (its limit is lower), class 0 until 1100
+    assert budget.reserve(CHANNEL, 0.3, 1, maxWait=91, now=1010.0) is None
+    assert budget.reserve(CHANNEL, 0.3, 0, maxWait=91, now=1010.0) == pytest.approx(90.0)
+    stats = budget.get_stats()
+    assert stats["budget_rejected"] == 2
+    assert stats["budget_delayed"] == 1
+
+
+def test_reserve_holds_budget_while_waiting():
+    budget = make_budget()
+    budget.charge(CHANNEL, 0.9, now=0.0)
+    # reserved airtime is accounted when it is sent (t=100): keepalive can not use it
+    assert budget.reserve(CHANNEL, 0.3, 0, maxWait=200, now=10.0) == pytest.approx(90.0)
+    assert not budget.try_charge(CHANNEL, 0.05, now=50.0)
+    assert budget.delay(CHANNEL, 0.8, 0, now=150.0) == pytest.approx(50.0)
+
+
+def test_try_charge_uses_lowest_priority_budget():
+    budget = make_budget()
+    assert budget.try_charge(CHANNEL, 0.75, now=0.0)
+    assert not budget.try_charge(CHANNEL, 0.1, now=1.0)
+    # class 0 still has the reserve
+    assert budget.delay(CHANNEL, 0.2, 0, now=1.0) == 0
+    assert budget.try_charge(CHANNEL, 0.1, now=101.0)
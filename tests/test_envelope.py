@@ -0,0 +1,143 @@
+import logging
+import struct
+
+import pytest
+
+for module in ("crc16", "netfilterqueue", "pyroute2", "getmac", "serial"):
+    pytest.importorskip(module)
+
+from libLora import libDevice
+from libLora import libIp2Lora
+
+
+MAX_FRAME_SZ = 60
+
+
+class FakeDevice():
+    FRAME_BOUNDARY = True
+    RADIO_CRC = True
+
+    def __init__(self, config):
+        self.sent = []
+
+    def send_radio_frame(self, data):
+        self.sent.append(bytes(data))
+
+    def get_stats(self):
+        return {}
+
+
+class Gateway(libIp2Lora.Ip2Lora):
+    def _create_device(self, config):
+        return FakeDevice(config)
+
+
+def make_gateway(ip, **extra):
+    config = {"name": "ip2lora", "log": logging.getLogger("test"), "debug": False, "deviceClass": libDevice.L072Z,
+              "ipAddress": ip, "maxLoraFrameSz": MAX_FRAME_SZ, "mtu": 128, "configSerial": {},
+              "configRx": None, "configTx": None, "rohc_compression": False}
+    config.update(extra)
+    return Gateway(config)
+
+
+def udp_packet(sz, ident=1, payload=None):
+    if payload is None:
+        payload = bytes((ident + i) & 0xff for i in range(sz - 20))
+    hdr = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), ident, 0, 64, 17, 0, bytes([172, 16, 10, 1]),
+                      bytes([172, 16, 10, 2]))
+    return hdr + payload
+
+
+# frames sent by tx for each packet
+def radio_frames(tx, pkts):
+    frames = []
+    for pkt in pkts:
+        tx._send_envelope(2, [pkt], None, 0)
+        while len(tx._txQueue):
+            tx._send_radio(*tx._txQueue.pop())
+        frames.append(tx._t_dev.sent)
+        tx._t_dev.sent = []
+    return frames
+
+
+def receive(rx, frames):
+    for frame in frames:
+        rx._feed_radio(frame)
+    return rx._recvBuf.pop_frames()
+
+
+FORMATS = [
+    {},
+    {"radioCrc": True},
+    {"frameVersion": 2},
+    {"frameVersion": 2, "radioCrc": True},
+    {"envelope": "compact"},
+    {"envelope": "compact_nolen"},
+    {"envelope": "compact_nolen", "radioCrc": True},
+    {"compressStream": True},
+    {"headerCompression": True, "envelope": "compact"},
+]
+
+
+
+
+@pytest.mark.parametrize("extra", FORMATS)
+def test_round_trip(extra):
+    tx = make_gateway("172.16.10.1", **extra)
+    rx = make_gateway("172.16.10.2", **extra)
+    # small packets, packets of one frame, fragmented packets
+    pkts = [udp_packet(sz, i) for i, sz in enumerate([21, 40, 57, 100, 128, 28] * 3)]
+    for pkt, frames in zip(pkts, radio_frames(tx, pkts)):
+        sz = MAX_FRAME_SZ
+        if extra.get("envelope") == "compact_nolen":
+            sz += 2
+        assert all(len(frame) <= sz for frame in frames)
+        assert receive(rx, frames) == [pkt]
+
+
+@pytest.mark.parametrize("extra", [{}, {"frameVersion": 2}, {"envelope": "compact"}])
+def test_corrupted_frame_is_dropped(extra):
+    tx = make_gateway("172.16.10.1", **extra)
+    rx = make_gateway("172.16.10.2", **extra)
+    pkts = [udp_packet(40, i) for i in range(3)]
+    frames = radio_frames(tx, pkts)
+    bad = bytearray(frames[1][0])
+    bad[len(bad) // 2] ^= 0x10
+    assert receive(rx, [frames[0][0], bytes(bad), frames[2][0]]) == [pkts[0], pkts[2]]
+
+
+def test_truncated_frame_in_stream_resync():
+    tx = make_gateway("172.16.10.1")
+    rx = make_gateway("172.16.10.2")
+    pkts = [udp_packet(40, i) for i in range(3)]
+    frames = radio_frames(tx, pkts)
+    assert receive(rx, [frames[0][0][:20], frames[1][0], frames[2][0]]) == pkts[1:]
+
+
+def test_lost_fragment_drops_packet_only():
+    tx = make_gateway("172.16.10.1")
+    rx = make_gateway("172.16.10.2")
+    pkts = [udp_packet(128, i) for i in range(3)]
+    frames = radio_frames(tx, pkts)
+    assert len(frames[1]) > 1
+    assert receive(rx, frames[0] + frames[1][1:] + frames[2]) == [pkts[0], pkts[2]]
+
+
+def test_stream_lost_frame_resync():
+    tx = make_gateway("172.16.10.1", compressStream=True, compressEpochLen=4)
+    rx = make_gateway("172.16.10.2", compressStream=True, compressEpochLen=4)
+    # repeated content: every packet, first one of an epoch too, is compressed
+    pkts = [udp_packet(0, i, b"unit 1 register %d;" % i * 4) for i in range(12)]
+    frames = radio_frames(tx, pkts)
+    out = receive(rx, [f for i, fs in enumerate(frames) if i != 1 for f in fs])
+    # packets 2 and 3 (rest of epoch) are dropped
+    assert out == [pkts[0]] + pkts[4:]
+
+
+def test_header_compression_lost_ir():
+    extra = {"headerCompression": True}
+    tx = make_gateway("172.16.10.1", **extra)
+    rx = make_gateway("172.16.10.2", **extra)
+    pkts = [udp_packet(40, i) for i in range(20)]
+    frames = radio_frames(tx, pkts)
+    assert receive(rx, [f for fs in frames[1:] for f in fs]) == pkts[1:]
@@ -0,0 +1,109 @@
+import pytest
+
+pytest.importorskip("crc16")
+
+from libLora import libFrameBuf
+
+
+MAGIC = 0xa5
+
+
+# test frame: magic (1) | len (1) | payload | sum of payload (1)
+def frame(payload):
+    return bytes([MAGIC, len(payload)]) + payload + bytes([sum(payload) & 0xff])
+
+
+def parser(view, offset, end):
+    if view[offset] != MAGIC:
+        return libFrameBuf.FRAME_BAD, None, 0
+    if end - offset < 2:
+        return libFrameBuf.FRAME_NEED_MORE, None, 0
+    sz = view[offset + 1]
+    if end - offset < sz + 3:
+        return libFrameBuf.FRAME_NEED_MORE, None, 0
+    payload = bytes(view[offset + 2:offset + 2 + sz])
+    if sum(payload) & 0xff != view[offset + 2 + sz]:
+        return libFrameBuf.FRAME_BAD, None, 0
+    return libFrameBuf.FRAME_OK, payload, sz + 3
+
+
+def make_buffer(maxSz=0x2000):
+    return libFrameBuf.RecvFrameBuffer(parser=parser, maxSz=maxSz, minFrameSz=3)
+
+
+
+
+@pytest.mark.parametrize("n", [0, 1, 0x7f, 0x80, 300, libFrameBuf.VARINT_MAX])
+def test_varint_round_trip(n):
+    data = libFrameBuf.encode_varint(n)
+    assert len(data) == (1 if n < 0x80 else 2)
+    assert libFrameBuf.decode_varint(data, 0, len(data)) == (n, len(data))
+
+
+def test_varint_truncated_and_invalid():
+    assert libFrameBuf.decode_varint(b"\x85", 0, 1) == (0, 0)
+    # not the shortest encoding, or longer than 2 bytes
+    assert libFrameBuf.decode_varint(b"\x85\x00", 0, 2)[0] is None
+    assert libFrameBuf.decode_varint(b"\x85\x80", 0, 2)[0] is None
+
+
+def test_header_check():
+    hdr = b"\x10\x80\x21"
+    assert libFrameBuf.header_check(hdr) == libFrameBuf.header_check(bytearray(hdr))
+    assert libFrameBuf.header_check(hdr) != libFrameBuf.header_check(b"\x10\x80\x22")
+
+
+def test_frames_in_one_feed():
+    buf = make_buffer()
+    buf.feed(frame(b"one") + frame(b"two") + frame(b""))
+    assert buf.pop_frames() == [b"one", b"two", b""]
+    assert len(buf) == 0
+    assert buf.get_stats()["recv_frames"] == 3
+
+
+def test_incomplete_frame_is_kept():
+    data = frame(b"split frame")
+    buf = make_buffer()
+    buf.feed(data[:5])
+    assert buf.pop_frames() == []
+    assert len(buf) == 5
+    buf.feed(data[5:])
+    assert buf.pop_frames() == [b"split frame"]
+    assert buf.get_stats()["recv_garbage_bytes"] == 0
+
+
+def test_resync_on_garbage():
+    buf = make_buffer()
+    buf.feed(b"\x00\x01garbage" + frame(b"one") + b"\xff\xfe" + frame(b"two"))
+    assert buf.pop_frames() == [b"one", b"two"]
+    assert buf.get_stats()["recv_garbage_bytes"] == 11
+
+
+def test_resync_after_corrupted_frame():
+    bad = bytearray(frame(b"corrupted"))
+    bad[4] ^= 0x40
+    buf = make_buffer()
+    buf.feed(bytes(bad) + frame(b"good"))
+    assert buf.pop_frames() == [b"good"]
+    assert buf.get_stats()["recv_garbage_bytes"] == len(bad)
+
+
+def test_bad_length_does_not_block_next_frames():
+    # candidate announces a long frame: following frames are found once it is known bad
+    buf = make_buffer()
+    buf.feed(bytes([MAGIC, 200]) + frame(b"one"))
+    assert buf.pop_frames() == [b"one"]
+
+
+def test_memory_cap():
+    buf = make_buffer(maxSz=32)
+    buf.feed(b"\x00" * 100)
+    assert len(buf) == 32
+    assert buf.get_stats()["recv_overflow_bytes"] == 68
+    buf.feed(frame(b"after overflow"))
+    assert buf.pop_frames() == [b"after overflow"]
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        libFrameBuf.RecvFrameBuffer(parser=parser, maxSz=2, minFrameSz=3)
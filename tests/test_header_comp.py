@@ -0,0 +1,183 @@
+import struct
+
+import pytest
+
+from libLora import libHeaderComp
+from libLora import libPacket
+
+
+SRC = 0xac100a01
+DST = 0xac100a02
+
+
+def ip_header(proto, l4_len, ident, tos=0, ttl=64):
+    hdr = bytearray(struct.pack("!BBHHHBBHII", 0x45, tos, 20 + l4_len, ident, 0x4000, ttl, proto, 0, SRC, DST))
+    struct.pack_into("!H", hdr, 10, libPacket.fold_checksum(libPacket.ones_complement_sum(hdr)))
+    return hdr
+
+
+def tcp_packet(seq, ack, ident, payload=b"", flags=0x10, ts=None, window=502):
+    opts = b""
+    if ts is not None:
+        opts = struct.pack("!4sII", b"\x01\x01\x08\x0a", *ts)
+    tcp = struct.pack("!HHIIBBHHH", 40000, 502, seq, ack, (20 + len(opts)) << 2, flags, window, 0, 0) + opts + payload
+    pkt = ip_header(6, len(tcp), ident) + tcp
+    ip = libPacket.parse_ipv4(pkt)
+    libPacket.update_tcp_checksum(ip, libPacket.parse_tcp(ip))
+    return bytes(pkt)
+
+
+def udp_packet(ident, payload, bChecksum=True):
+    udp = bytearray(struct.pack("!HHHH", 5000, 5001, 8 + len(payload), 0) + payload)
+    pkt = ip_header(17, len(udp), ident) + udp
+    if bChecksum:
+        ip = libPacket.parse_ipv4(pkt)
+        s = libPacket.ones_complement_sum(udp, ip.pseudo_hdr_sum())
+        struct.pack_into("!H", pkt, 26, libPacket.fold_checksum(s) or 0xffff)
+    return bytes(pkt)
+
+
+# Modbus/TCP like flow: requests with timestamps, growing seq/ack
+def tcp_flow(n):
+    pkts = []
+    seq, ack = 1000, 5000
+    for i in range(n):
+        payload = bytes([1, 3, 0, i & 0xff, 0, 10]) * (1 + i % 3)
+        pkts.append(tcp_packet(seq, ack, 100 + i, payload, flags=0x18, ts=(7000 + 3 * i, 9000 + i),
+                               window=502 if i % 5 else 600))
+        seq += len(payload)
+        ack += 25
+    return pkts
+
+
+# one packet every 0.1 s: context is refreshed on packet count
+def transfer(pkts, lost=(), **kw):
+    c = libHeaderComp.HeaderCompressor(1, **kw)
+    d = libHeaderComp.HeaderDecompressor()
+    out = []
+    for i, pkt in enumerate(pkts):
+        z = c.compress(pkt, now=i * 0.1)
+        if i in lost:
+            continue
+        try:
+            out.append(d.decompress(z))
+        except ValueError:
+            out.append(None)
+    return out
+
+
+
+
+def test_tcp_round_trip():
+    pkts = tcp_flow(40)
+    c = libHeaderComp.HeaderCompressor(1)
+    d = libHeaderComp.HeaderDecompressor()
+    sizes = []
+    for i, pkt in enumerate(pkts):
+        z = c.compress(pkt, now=i * 0.1)
+        sizes.append(len(z) - len(pkt))
+        assert d.decompress(z) == pkt
+    # CO packets save most of 52 bytes of headers
+    assert max(sizes[libHeaderComp.HC_IR_REPEAT:libHeaderComp.HC_REFRESH_PKTS]) < -35
+
+
+def test_udp_round_trip():
+    pkts = [udp_packet(10 + i, b"modbus%d" % i, bChecksum=i % 2 == 0) for i in range(20)]
+    assert transfer(pkts) == pkts
+
+
+def test_plain_packets_unchanged():
+    icmp = bytes(ip_header(1, 8, 1) + b"\x08\x00\xf7\xff\x00\x00\x00\x00")
+    c = libHeaderComp.HeaderCompressor(1)
+    d = libHeaderComp.HeaderDecompressor()
+    assert c.compress(icmp) == icmp
+    assert d.decompress(icmp) == icmp
+    # bad IPv4 checksum: sent as is
+    bad = bytearray(tcp_packet(1, 2, 3))
+    bad[10] ^= 0xff
+    assert c.compress(bytes(bad)) == bytes(bad)
+
+
+def test_truncated_packets_are_rejected():
+    pkts = tcp_flow(6)
+    c = libHeaderComp.HeaderCompressor(1)
+    d = libHeaderComp.HeaderDecompressor()
+    for i, pkt in enumerate(pkts):
+        z = c.compress(pkt, now=float(i))
+        if i < 5:
+            assert d.decompress(z) == pkt
+    # last one is a CO
+    assert z[0] >> 4 == libHeaderComp.HC_CO
+    for sz in range(1, len(z)):
+        with pytest.raises(ValueError):
+            d.decompress(z[:sz])
+    assert d.decompress(z) == pkts[-1]
+
+
+def test_truncated_repeated_context_is_rejected():
+    pkts = tcp_flow(2)
+    c = libHeaderComp.HeaderCompressor(1)
+    c.compress(pkts[0], now=0.0)
+    z = c.compress(pkts[1], now=0.1)
+    assert z[0] >> 4 == libHeaderComp.HC_IR and z[2] & 0x80
+    for sz in range(1, len(z)):
+        with pytest.raises(ValueError):
+            libHeaderComp.HeaderDecompressor().decompress(z[:sz])
+    assert libHeaderComp.HeaderDecompressor().decompress(z) == pkts[1]
+
+
+def test_corrupted_packets_are_rejected():
+    pkts = tcp_flow(10)
+    c = libHeaderComp.HeaderCompressor(1)
+    d = libHeaderComp.HeaderDecompressor()
+    for i, pkt in enumerate(pkts):
+        z = bytearray(c.compress(pkt, now=float(i)))
+        if i == 8:
+            # seq delta of CO
+            z[5] ^= 0x01
+            with pytest.raises(ValueError):
+                d.decompress(bytes(z))
+        else:
+            assert d.decompress(bytes(z)) == pkt
+    assert d.get_stats()["hc_rx_bad_checksum"] == 1
+
+
+def test_lost_co_does_not_damage_next_packets():
+    pkts = tcp_flow(30)
+    lost = {5, 6, 11, 20}
+    out = transfer(pkts, lost)
+    assert out == [pkt for i, pkt in enumerate(pkts) if i not in lost]
+
+
+@pytest.mark.parametrize("lost", [{0}, {1}, {2}, {0, 1}, {0, 2}, {1, 2}])
+def test_lost_ir_recovered_by_repeated_context(lost):
+    pkts = tcp_flow(40)
+    out = transfer(pkts, lost)
+    assert out == [pkt for i, pkt in enumerate(pkts) if i not in lost]
+
+
+def test_lost_context_recovered_on_refresh():
+    pkts = tcp_flow(20)
+    lost = set(range(libHeaderComp.HC_IR_REPEAT))
+    out = transfer(pkts, lost, refreshPkts=8)
+    # no context until refresh (IR after 8 packets), then every packet is rebuilt
+    refresh = 9 - len(lost)
+    received = [pkt for i, pkt in enumerate(pkts) if i not in lost]
+    assert out[:refresh] == [None] * refresh
+    assert out[refresh:] == received[refresh:]
+
+
+def test_reset_sends_context_again():
+    pkts = tcp_flow(10)
+    c = libHeaderComp.HeaderCompressor(1)
+    for i in range(5):
+        c.compress(pkts[i], now=float(i))
+    assert c.compress(pkts[5], now=5.0)[0] >> 4 == libHeaderComp.HC_CO
+    c.reset(pkts[5])
+    assert c.compress(pkts[6], now=6.0)[0] >> 4 == libHeaderComp.HC_IR
+
+
+def test_invalid_parameters():
+    for kw in ({"maxContexts": 0}, {"maxContexts": 0x101}, {"refreshPkts": 0}, {"irRepeat": 0}):
+        with pytest.raises(ValueError):
+            libHeaderComp.HeaderCompressor(1, **kw)